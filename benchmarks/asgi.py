@@ -0,0 +1,145 @@
+"""
+Compara quantas requisições de saldo com o SaldoAPI lento um único processo consegue manter em andamento
+no modo atual (gunicorn + eventlet) e no modo ASGI (gunicorn + uvicorn com as views assíncronas).
+
+    python benchmarks/asgi.py [requisicoes_simultaneas] [atraso_do_saldo_api_em_segundos]
+
+Requer gunicorn, eventlet, uvicorn e httpx instalados.
+"""
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock
+from time import sleep, perf_counter
+
+import httpx
+
+from comum import SRC, configurar_django, imprimir_tabela
+
+SIMULTANEAS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+ATRASO = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+
+SERVIDORES = {
+    'wsgi (eventlet)': ['boticario.wsgi', '--worker-class', 'eventlet', '--threads', '4'],
+    'asgi (uvicorn)': ['boticario.asgi:application', '--worker-class', 'uvicorn.workers.UvicornWorker'],
+}
+
+
+class SaldoAPILento:
+    """SaldoAPI local que demora ATRASO segundos para responder e registra o pico de requisições simultâneas"""
+
+    def __init__(self):
+        self.em_andamento = 0
+        self.pico = 0
+        self.lock = Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with stub.lock:
+                    stub.em_andamento += 1
+                    stub.pico = max(stub.pico, stub.em_andamento)
+                sleep(ATRASO)
+                with stub.lock:
+                    stub.em_andamento -= 1
+                body = json.dumps({"statusCode": 200, "body": {"credit": 1000}}).encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.server.request_queue_size = 1024
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+def porta_livre():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def aguardar_servidor(url):
+    for _ in range(100):
+        try:
+            httpx.get(url)
+            return
+        except httpx.HTTPError:
+            sleep(0.1)
+    raise RuntimeError(f'Servidor não iniciou em {url}')
+
+
+def gerar_cpf(numero):
+    from cashback.utils import digito_mod11
+
+    algarismos = list(map(int, f'{numero:09}'))
+    for _ in range(2):
+        algarismos.append(digito_mod11(algarismos))
+    return ''.join(map(str, algarismos))
+
+
+async def disparar(base_url, vendedores):
+    limites = httpx.Limits(max_connections=SIMULTANEAS)
+    async with httpx.AsyncClient(timeout=60, limits=limites) as client:
+        inicio = perf_counter()
+        respostas = await asyncio.gather(*(
+            client.get(f'{base_url}/v1/vendedor/{cpf}/saldo', headers={'Authorization': token})
+            for cpf, token in vendedores
+        ), return_exceptions=True)
+        duracao = perf_counter() - inicio
+    sucesso = sum(1 for response in respostas if not isinstance(response, Exception) and response.status_code == 200)
+    return sucesso, duracao
+
+
+def main():
+    configurar_django()
+
+    from cashback.authentication import VendedorRefreshToken
+    from cashback.models import Vendedor
+
+    # Um vendedor por requisição, para que as consultas não sejam agrupadas pelo single-flight
+    vendedores = []
+    for i in range(SIMULTANEAS):
+        vendedor = Vendedor.objects.create(username=f'benchmark{i}', cpf=gerar_cpf(100000000 + i))
+        vendedores.append((vendedor.cpf, f'Bearer {VendedorRefreshToken.for_user(vendedor).access_token}'))
+
+    linhas = []
+    for nome, argumentos in SERVIDORES.items():
+        saldo_api = SaldoAPILento()
+        porta = porta_livre()
+        env = dict(os.environ, SALDO_API=saldo_api.url, SALDO_CACHE_TTL='0', SALDO_API_POOL_SIZE=str(SIMULTANEAS),
+                   SALDO_API_TIMEOUT_LEITURA='60', DEBUG='False')
+        env.pop('VIEWS_ASSINCRONAS', None)
+        processo = subprocess.Popen(
+            ['gunicorn', *argumentos, '--workers', '1', '--worker-connections', '1000', '--backlog', '2048',
+             '--bind', f'127.0.0.1:{porta}', '--log-level', 'warning'],
+            cwd=SRC, env=env, stdout=subprocess.DEVNULL,
+        )
+        try:
+            base_url = f'http://127.0.0.1:{porta}'
+            aguardar_servidor(base_url)
+            sucesso, duracao = asyncio.run(disparar(base_url, vendedores))
+        finally:
+            processo.terminate()
+            processo.wait()
+            saldo_api.server.shutdown()
+        vazao = sucesso / duracao
+        linhas.append([nome, f'{sucesso}/{SIMULTANEAS}', f'{duracao:.2f}', f'{vazao:.1f}', saldo_api.pico])
+
+    print(f'{SIMULTANEAS} requisições simultâneas de saldo, 1 processo, SaldoAPI com {ATRASO}s de atraso')
+    imprimir_tabela(['modo', 'sucesso', 'tempo (s)', 'req/s', 'pico no SaldoAPI'], linhas)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Utilitários compartilhados pelos benchmarks.
+
+Os benchmarks rodam fora da suíte de testes, contra um banco SQLite temporário:
+
+    python benchmarks/<benchmark>.py
+"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+SRC = Path(__file__).resolve().parent.parent / 'src'
+
+
+def configurar_django():
+    """Configura o Django apontando para um banco SQLite temporário já migrado"""
+    sys.path.insert(0, str(SRC))
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'boticario.settings')
+    os.environ.setdefault('DEBUG', 'False')
+
+    _, banco = tempfile.mkstemp(suffix='.sqlite3')
+    os.environ['DATABASE_NAME'] = banco
+
+    import django
+    from django.core.management import call_command
+
+    django.setup()
+    call_command('migrate', verbosity=0)
+    return banco
+
+
+def medir(funcao, repeticoes=20):
+    """Executa a função repetidas vezes e retorna a média em milissegundos"""
+    funcao()  # Aquecimento
+    inicio = perf_counter()
+    for _ in range(repeticoes):
+        funcao()
+    return (perf_counter() - inicio) * 1000 / repeticoes
+
+
+def imprimir_tabela(cabecalho, linhas):
+    larguras = [max(len(str(valor)) for valor in coluna) for coluna in zip(cabecalho, *linhas)]
+    for linha in [cabecalho] + linhas:
+        print('  '.join(str(valor).rjust(largura) for valor, largura in zip(linha, larguras)))
@@ -0,0 +1,78 @@
+"""
+Micro-benchmark da validação de CPF: algoritmo original, caminho memoizado e validação em lote (com e sem numpy).
+
+    python benchmarks/cpf.py [quantidade_de_cpfs]
+"""
+import random
+import sys
+from string import digits
+from time import perf_counter
+
+from comum import SRC, imprimir_tabela
+
+sys.path.insert(0, str(SRC))
+
+from cashback.utils import digito_mod11, sanitizar_cpf, validar_cpfs, numpy  # noqa: E402
+
+QUANTIDADE = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+
+def sanitizar_cpf_original(cpf):
+    if not cpf:
+        return None
+    algarismos = list(map(int, filter(lambda c: c in digits, cpf)))
+    if len(algarismos) != 11:
+        return None
+    cpf_calculado = algarismos[:9]
+    for i in range(9, 11):
+        digito = digito_mod11(cpf_calculado)
+        cpf_calculado.append(digito)
+        if digito != algarismos[i]:
+            return None
+    return ''.join(map(str, cpf_calculado))
+
+
+def gerar_cpfs(quantidade):
+    aleatorio = random.Random(0)
+    cpfs = []
+    for _ in range(quantidade):
+        base = [aleatorio.randint(0, 9) for _ in range(9)]
+        base.append(digito_mod11(base))
+        base.append(digito_mod11(base))
+        cpf = ''.join(map(str, base))
+        cpfs.append(f'{cpf[:3]}.{cpf[3:6]}.{cpf[6:9]}-{cpf[9:]}' if aleatorio.random() < 0.5 else cpf)
+    return cpfs
+
+
+def medir(nome, funcao):
+    inicio = perf_counter()
+    resultado = funcao()
+    duracao = perf_counter() - inicio
+    return resultado, [nome, f'{duracao:.3f}', f'{QUANTIDADE / duracao:,.0f}']
+
+
+def main():
+    cpfs = gerar_cpfs(QUANTIDADE)
+    esperado, original = medir('original', lambda: [sanitizar_cpf_original(cpf) for cpf in cpfs])
+    linhas = [original]
+
+    sanitizar_cpf.cache_clear()
+    casos = [
+        ('memoizado (cache frio)', lambda: [sanitizar_cpf(cpf) for cpf in cpfs]),
+        ('memoizado (mesmo CPF)', lambda: [sanitizar_cpf(cpfs[0]) for _ in cpfs]),
+        ('lote sem numpy', lambda: validar_cpfs(cpfs, vetorizar=False)),
+    ]
+    if numpy is not None:
+        casos.append(('lote com numpy', lambda: validar_cpfs(cpfs, vetorizar=True)))
+    for nome, funcao in casos:
+        resultado, linha = medir(nome, funcao)
+        if nome != 'memoizado (mesmo CPF)':
+            assert resultado == esperado, nome
+        linhas.append(linha)
+
+    print(f'Validação de {QUANTIDADE:,} CPFs')
+    imprimir_tabela(['implementação', 'tempo (s)', 'CPFs/s'], linhas)
+
+
+if __name__ == '__main__':
+    main()
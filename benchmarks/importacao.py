@@ -0,0 +1,70 @@
+"""
+Compara a importação do histórico de compras com Compra.save linha a linha e com o comando importar_compras,
+em linhas por segundo. O save é medido em uma amostra das linhas, já que é ordens de grandeza mais lento.
+
+    python benchmarks/importacao.py [linhas] [vendedores]
+"""
+import csv
+import io
+import os
+import sys
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from time import perf_counter
+
+from comum import configurar_django, imprimir_tabela
+
+LINHAS = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+VENDEDORES = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+AMOSTRA_SAVE = min(LINHAS, 2000)
+
+
+def main():
+    configurar_django()
+
+    from django.core.management import call_command
+    from django.utils.timezone import now
+
+    from cashback.models import Vendedor, Compra
+    from cashback.utils import digito_mod11
+
+    cpfs = []
+    for i in range(VENDEDORES):
+        algarismos = [int(algarismo) for algarismo in f'{100000000 + i:09}']
+        algarismos.append(digito_mod11(algarismos))
+        algarismos.append(digito_mod11(algarismos))
+        cpfs.append(''.join(map(str, algarismos)))
+    Vendedor.objects.bulk_create(Vendedor(username=f'vendedor-{i}', cpf=cpf) for i, cpf in enumerate(cpfs))
+    vendedores = Vendedor.objects.in_bulk(cpfs, field_name='cpf')
+    inicio = now()
+    linhas = [(f'{i:06}', f'{(i % 2000) + 1}.50', inicio - timedelta(minutes=i * 365 * 24 * 60 // LINHAS),
+               cpfs[i % VENDEDORES]) for i in range(LINHAS)]
+
+    comeco = perf_counter()
+    for codigo, valor, data, cpf in linhas[:AMOSTRA_SAVE]:
+        Compra(codigo=f'S{codigo[1:]}', valor=Decimal(valor), data=data,
+               vendedor=vendedores[cpf]).save()
+    duracao_save = perf_counter() - comeco
+    Compra.objects.all().delete()
+
+    _, arquivo = tempfile.mkstemp(suffix='.csv')
+    with open(arquivo, 'w', newline='') as saida:
+        writer = csv.writer(saida)
+        writer.writerow(['codigo', 'valor', 'data', 'cpf'])
+        writer.writerows((codigo, valor, data.isoformat(), cpf) for codigo, valor, data, cpf in linhas)
+    comeco = perf_counter()
+    call_command('importar_compras', arquivo, stdout=io.StringIO())
+    duracao_comando = perf_counter() - comeco
+    os.remove(arquivo)
+    assert Compra.objects.count() == LINHAS
+
+    print(f'Importação de compras de {VENDEDORES} vendedores distribuídas em um ano')
+    imprimir_tabela(['importacao', 'linhas', 's', 'linhas/s'], [
+        ['Compra.save', AMOSTRA_SAVE, f'{duracao_save:.2f}', f'{AMOSTRA_SAVE / duracao_save:.0f}'],
+        ['importar_compras', LINHAS, f'{duracao_comando:.2f}', f'{LINHAS / duracao_comando:.0f}'],
+    ])
+
+
+if __name__ == '__main__':
+    main()
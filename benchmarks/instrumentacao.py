@@ -0,0 +1,59 @@
+"""
+Compara o tempo da listagem de compras com e sem o TempoRequisicaoMiddleware (TEMPO_REQUISICAO),
+em milissegundos por requisição, com os logs descartados para medir apenas a instrumentação.
+
+    python benchmarks/instrumentacao.py [requisicoes]
+"""
+import logging
+import sys
+from datetime import timedelta
+from decimal import Decimal
+
+from comum import configurar_django, medir, imprimir_tabela
+
+REQUISICOES = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+
+def main():
+    configurar_django()
+
+    from django.test.utils import override_settings
+    from django.utils.timezone import now
+    from rest_framework.test import APIClient
+
+    from cashback.authentication import VendedorRefreshToken
+    from cashback.models import Vendedor, Compra
+
+    logging.getLogger('core').handlers = [logging.NullHandler()]
+    logging.getLogger('core').propagate = False
+
+    vendedor = Vendedor.objects.create_user(username='benchmark', password='benchmark', cpf='15350946056')
+    data = now()
+    Compra.objects.bulk_create(
+        Compra(codigo=f"{i:06}", vendedor=vendedor, valor=Decimal(i + 1), data=data - timedelta(minutes=i),
+               status='V', percentual_cashback=10, valor_cashback=Decimal(i + 1) / 10) for i in range(50)
+    )
+    token = f'Bearer {VendedorRefreshToken.for_user(vendedor).access_token}'
+
+    def requisicoes():
+        # Um client novo por medição, já que o middleware é carregado na primeira requisição
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=token)
+
+        def executar():
+            for _ in range(REQUISICOES):
+                client.get(f'/v1/vendedor/{vendedor.cpf}/compras')
+        return executar
+
+    linhas = []
+    for nome, habilitado in (('sem instrumentação', False), ('TempoRequisicaoMiddleware', True)):
+        with override_settings(TEMPO_REQUISICAO=habilitado, ALLOWED_HOSTS=['*']):
+            ms = medir(requisicoes(), repeticoes=5)
+        linhas.append([nome, f'{ms / REQUISICOES:.3f}'])
+
+    print(f'Listagem de uma página de compras ({REQUISICOES} requisições)')
+    imprimir_tabela(['middleware', 'ms/requisicao'], linhas)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Compara a serialização da listagem de compras pelo CompraSerializer (instâncias do model)
+com o caminho somente leitura sobre .values(), em linhas serializadas por segundo.
+
+    python benchmarks/listagem.py [linhas_por_pagina]
+"""
+import sys
+from datetime import timedelta
+from decimal import Decimal
+
+from comum import configurar_django, medir, imprimir_tabela
+
+PAGE_SIZE = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+
+def main():
+    configurar_django()
+
+    from django.utils.timezone import now
+    from rest_framework.renderers import JSONRenderer
+
+    from cashback.api import CompraSerializer, CompraListagemSerializer
+    from cashback.models import Vendedor, Compra
+
+    vendedor = Vendedor.objects.create_user(username='benchmark', password='benchmark', cpf='15350946056')
+    data = now()
+    Compra.objects.bulk_create(
+        Compra(codigo=f"{i:06}", vendedor=vendedor, valor=Decimal(i + 1), data=data - timedelta(minutes=i),
+               status='V', percentual_cashback=10, valor_cashback=Decimal(i + 1) / 10) for i in range(PAGE_SIZE)
+    )
+
+    def modelo():
+        compras = vendedor.compras.order_by('-data')[:PAGE_SIZE]
+        return JSONRenderer().render(CompraSerializer(compras, many=True).data)
+
+    def listagem():
+        compras = CompraListagemSerializer.queryset(vendedor)[:PAGE_SIZE]
+        return JSONRenderer().render(CompraListagemSerializer(compras, vendedor.cpf).data)
+
+    assert modelo() == listagem()
+    linhas = []
+    for nome, funcao in (('CompraSerializer', modelo), ('CompraListagemSerializer', listagem)):
+        ms = medir(funcao, repeticoes=200)
+        linhas.append([nome, f'{ms:.2f}', f'{PAGE_SIZE * 1000 / ms:.0f}'])
+
+    print(f'Serialização de uma página de {PAGE_SIZE} compras (consulta + JSON)')
+    imprimir_tabela(['serializacao', 'ms', 'linhas/s'], linhas)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Latência do login sob concorrência, gravando o last_login em todo login e com LOGIN_INTERVALO_ULTIMO_ACESSO.
+O hash de senha é trocado por MD5 para que o custo medido seja o acesso ao banco e não o PBKDF2.
+
+    python benchmarks/login.py [threads] [logins_por_thread]
+"""
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from statistics import quantiles
+from time import perf_counter
+
+from comum import configurar_django, imprimir_tabela
+
+THREADS = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+LOGINS = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+
+def main():
+    configurar_django()
+
+    from django.db import connection
+    from django.test import override_settings
+    from rest_framework.test import APIClient
+
+    from cashback.models import Vendedor
+
+    with override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher']):
+        for i in range(THREADS):
+            Vendedor.objects.create_user(username=f'vendedor{i}', password='senha', cpf=f'{i:011}')
+
+        def logar(indice):
+            client = APIClient()
+            duracoes = []
+            falhas = 0
+            for _ in range(LOGINS):
+                inicio = perf_counter()
+                try:
+                    response = client.post('/v1/vendedor/login', {"login": f"vendedor{indice}", "senha": "senha"},
+                                           format='json')
+                    falhas += response.status_code != 200
+                except Exception:
+                    falhas += 1
+                duracoes.append((perf_counter() - inicio) * 1000)
+            connection.close()
+            return duracoes, falhas
+
+        linhas = []
+        for intervalo in (0, 300):
+            with override_settings(LOGIN_INTERVALO_ULTIMO_ACESSO=intervalo):
+                Vendedor.objects.update(last_login=None)
+                with ThreadPoolExecutor(THREADS) as executor:
+                    resultados = list(executor.map(logar, range(THREADS)))
+            duracoes = [duracao for parcial, _ in resultados for duracao in parcial]
+            falhas = sum(falhas for _, falhas in resultados)
+            percentis = quantiles(duracoes, n=100)
+            linhas.append([intervalo, f'{percentis[49]:.2f}', f'{percentis[98]:.2f}', falhas])
+
+    print(f'{THREADS} threads com {LOGINS} logins cada (ms por login)')
+    imprimir_tabela(['intervalo', 'p50', 'p99', 'falhas'], linhas)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Mede o custo dos logs na thread da requisição, em microssegundos de CPU (thread_time) por requisição, com a escrita
+síncrona no stream (json da biblioteca padrão e orjson) e com o FilaHandler, cuja formatação e escrita ficam
+na thread do listener, além do log de debug do SaldoAPI com o nível DEBUG desabilitado, com e sem a verificação
+do nível antes de montar o extra.
+
+    python benchmarks/logs.py [registros_por_requisicao]
+"""
+import logging
+import sys
+import tempfile
+from time import thread_time
+from unittest.mock import patch
+
+from comum import configurar_django, imprimir_tabela
+
+REGISTROS = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+REQUISICOES = 2000
+
+
+def medir_thread(funcao, repeticoes):
+    """Média em milissegundos do tempo de CPU da thread atual, sem contar a espera pelas demais threads"""
+    funcao()  # Aquecimento
+    inicio = thread_time()
+    for _ in range(repeticoes):
+        funcao()
+    return (thread_time() - inicio) * 1000 / repeticoes
+
+
+def main():
+    configurar_django()
+
+    from log_request_id.filters import RequestIDFilter
+
+    from boticario import logging as boticario_logging
+    from boticario.logging import BoticarioJSONFormatter, FilaHandler
+
+    arquivo = tempfile.TemporaryFile('w')
+
+    def configurar(handler):
+        handler.setFormatter(BoticarioJSONFormatter())
+        handler.addFilter(RequestIDFilter())
+        logger = logging.Logger('benchmark', logging.INFO)
+        logger.addHandler(handler)
+        return logger
+
+    def requisicoes(logger):
+        def executar():
+            for _ in range(REQUISICOES):
+                for i in range(REGISTROS):
+                    logger.info("Lote de compras inserido", extra={"cpf": "15350946056", "inseridas": i, "erros": 0})
+        return executar
+
+    linhas = []
+    with patch.object(boticario_logging, 'orjson', None):
+        ms = medir_thread(requisicoes(configurar(logging.StreamHandler(arquivo))), repeticoes=5)
+        linhas.append(['StreamHandler (json)', f'{ms * 1000 / REQUISICOES:.1f}'])
+    if boticario_logging.orjson is not None:
+        ms = medir_thread(requisicoes(configurar(logging.StreamHandler(arquivo))), repeticoes=5)
+        linhas.append(['StreamHandler (orjson)', f'{ms * 1000 / REQUISICOES:.1f}'])
+    # Fila grande o bastante para não descartar registros durante a medição
+    fila = FilaHandler(arquivo, tamanho=REQUISICOES * REGISTROS * 10)
+    ms = medir_thread(requisicoes(configurar(fila)), repeticoes=5)
+    fila.close()
+    linhas.append(['FilaHandler', f'{ms * 1000 / REQUISICOES:.1f}'])
+
+    print(f'Custo na thread da requisição com {REGISTROS} registros INFO por requisição')
+    imprimir_tabela(['handler', 'us/requisicao'], linhas)
+
+    logger = configurar(logging.StreamHandler(arquivo))
+    corpo = b'{"statusCode": 500, "body": "erro"}' * 20
+
+    def sem_verificacao():
+        for _ in range(REQUISICOES):
+            logger.debug("Consulta ao SaldoAPI", extra={"method": "GET", "url": "http://saldo/v1/cashback?cpf=1",
+                                                        "status": 500, "body": bytes(corpo), "duration": 0.1})
+
+    def com_verificacao():
+        for _ in range(REQUISICOES):
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Consulta ao SaldoAPI", extra={"method": "GET", "url": "http://saldo/v1/cashback?cpf=1",
+                                                            "status": 500, "body": bytes(corpo), "duration": 0.1})
+
+    print()
+    print('Log de debug do SaldoAPI com o nível DEBUG desabilitado')
+    imprimir_tabela(['extra', 'us/requisicao'], [
+        ['sempre montado', f'{medir_thread(sem_verificacao, repeticoes=20) * 1000 / REQUISICOES:.2f}'],
+        ['após isEnabledFor', f'{medir_thread(com_verificacao, repeticoes=20) * 1000 / REQUISICOES:.2f}'],
+    ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Mede o custo de registrar as métricas de uma requisição (contador e histograma da rota), em microssegundos,
+com o armazenamento em memória e com o arquivo mapeado em memória usado pelos workers (METRICAS_DIRETORIO),
+além do tempo da exportação do /metrics somando os arquivos de 4 workers.
+
+    python benchmarks/metricas.py [requisicoes]
+"""
+import sys
+import tempfile
+from unittest.mock import patch
+
+from comum import configurar_django, medir, imprimir_tabela
+
+REQUISICOES = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+ROTAS = ['vendedor-saldo', 'vendedor-compras', 'compra-list', 'compra-detail']
+
+
+def main():
+    configurar_django()
+
+    from django.test.utils import override_settings
+
+    from cashback import metricas
+
+    def registrar():
+        for i in range(REQUISICOES):
+            rota = ROTAS[i % len(ROTAS)]
+            metricas.requisicoes.incrementar(rota=rota, metodo='GET', status=200)
+            metricas.duracao_requisicoes.observar(0.004 * (i % 10), rota=rota, metodo='GET')
+
+    linhas = []
+    with override_settings(METRICAS_DIRETORIO=''):
+        ms = medir(registrar, repeticoes=3)
+    linhas.append(['memória', f'{ms * 1000 / REQUISICOES:.2f}'])
+
+    with tempfile.TemporaryDirectory() as diretorio, override_settings(METRICAS_DIRETORIO=diretorio):
+        ms = medir(registrar, repeticoes=3)
+        linhas.append(['arquivo (mmap)', f'{ms * 1000 / REQUISICOES:.2f}'])
+        # Outros 3 workers com as mesmas séries
+        for pid in range(1, 4):
+            with patch('cashback.metricas.os.getpid', return_value=-pid):
+                registrar()
+        exportacao = medir(metricas.exportar, repeticoes=20)
+
+    print(f'Registro das métricas de {REQUISICOES} requisições')
+    imprimir_tabela(['armazenamento', 'us/requisicao'], linhas)
+    print()
+    print(f'Exportação do /metrics com 4 workers: {exportacao:.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Compara a paginação por página (COUNT + OFFSET) com a paginação por cursor da listagem de compras
+para um vendedor com muitas compras.
+
+    python benchmarks/paginacao.py [quantidade_de_compras]
+"""
+import sys
+from datetime import timedelta
+from decimal import Decimal
+
+from comum import configurar_django, medir, imprimir_tabela
+
+QUANTIDADE = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+PAGE_SIZE = 50
+
+
+def main():
+    configurar_django()
+
+    from django.utils.timezone import now
+    from rest_framework.test import APIClient
+
+    from cashback.api import ComprasCursorPagination
+    from cashback.authentication import VendedorRefreshToken
+    from cashback.models import Vendedor, Compra
+
+    cpf = '15350946056'
+    vendedor = Vendedor.objects.create_user(username='benchmark', password='benchmark', cpf=cpf)
+    data = now()
+    Compra.objects.bulk_create(
+        (Compra(codigo=f"{i:06}", vendedor=vendedor, valor=Decimal(10), data=data - timedelta(minutes=i),
+                status='V', percentual_cashback=10) for i in range(QUANTIDADE)),
+        batch_size=5000,
+    )
+
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f'Bearer {VendedorRefreshToken.for_user(vendedor).access_token}')
+    url = f'/v1/vendedor/{cpf}/compras?page_size={PAGE_SIZE}'
+    ordenadas = Compra.objects.filter(vendedor=vendedor).order_by('-data', '-id').values('data', 'id')
+
+    linhas = []
+    ultima_pagina = QUANTIDADE // PAGE_SIZE
+    for pagina in (1, ultima_pagina // 2, ultima_pagina):
+        por_pagina = medir(lambda: client.get(f'{url}&page={pagina}'))
+        if pagina == 1:
+            cursor_url = f'{url}&paginacao=cursor'
+        else:
+            # Cursor equivalente ao link "next" da página anterior
+            anterior = ordenadas[(pagina - 1) * PAGE_SIZE - 1]
+            cursor = ComprasCursorPagination.encode_cursor(anterior, reverso=False)
+            cursor_url = f'{url}&cursor={cursor}'
+        por_cursor = medir(lambda: client.get(cursor_url))
+        linhas.append([pagina, f'{por_pagina:.2f}', f'{por_cursor:.2f}'])
+
+    print(f'Listagem de compras com {QUANTIDADE} compras, {PAGE_SIZE} por página (ms por requisição)')
+    imprimir_tabela(['pagina', 'page_number', 'cursor'], linhas)
+
+
+if __name__ == '__main__':
+    main()
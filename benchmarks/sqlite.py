@@ -0,0 +1,65 @@
+"""
+Vazão de escrita de vários processos no mesmo arquivo SQLite, com e sem o modo de concorrência (SQLITE_WAL).
+Cada processo insere compras (livro diário e recálculo da janela) e registra logins do seu vendedor.
+
+    python benchmarks/sqlite.py [processos] [compras_por_processo]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+from comum import SRC, imprimir_tabela
+
+PROCESSOS = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+COMPRAS = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+ESCRITOR = """
+import sys
+from time import time
+import django
+django.setup()
+from decimal import Decimal
+from django.db import OperationalError
+from cashback.models import Vendedor, Compra
+indice, quantidade = int(sys.argv[1]), int(sys.argv[2])
+vendedor = Vendedor.objects.create(username=f"vendedor{indice}", cpf=f"{indice:011}")
+falhas = 0
+inicio = time()
+for i in range(quantidade):
+    try:
+        Compra.objects.create(codigo=f"{indice:02}{i:04}", vendedor=vendedor, valor=Decimal(100))
+        vendedor.registrar_login()
+    except OperationalError:
+        falhas += 1
+print(falhas, inicio, time())
+"""
+
+
+def executar(wal):
+    _, banco = tempfile.mkstemp(suffix='.sqlite3')
+    env = dict(os.environ, DATABASE_NAME=banco, SQLITE_WAL=str(wal), DJANGO_SETTINGS_MODULE='boticario.settings',
+               DEBUG='False')
+    subprocess.run([sys.executable, 'manage.py', 'migrate', '-v', '0'], cwd=SRC, env=env, check=True)
+
+    processos = [subprocess.Popen([sys.executable, '-W', 'ignore', '-c', ESCRITOR, str(indice), str(COMPRAS)],
+                                  cwd=SRC, env=env, stdout=subprocess.PIPE, text=True)
+                 for indice in range(PROCESSOS)]
+    # O tempo vai do início do primeiro escritor ao fim do último, sem a inicialização do Django
+    # A última linha da saída é o resultado do escritor, as anteriores são logs
+    resultados = [processo.communicate()[0].splitlines()[-1].split() for processo in processos]
+    falhas = sum(int(falhas) for falhas, _, _ in resultados)
+    duracao = max(float(fim) for _, _, fim in resultados) - min(float(inicio) for _, inicio, _ in resultados)
+    os.remove(banco)
+    escritas = PROCESSOS * COMPRAS - falhas
+    return [wal, escritas, falhas, f'{duracao:.2f}', f'{escritas / duracao:.0f}']
+
+
+def main():
+    linhas = [executar(wal) for wal in (False, True)]
+    print(f'{PROCESSOS} processos inserindo {COMPRAS} compras cada')
+    imprimir_tabela(['SQLITE_WAL', 'compras', 'falhas', 'tempo (s)', 'compras/s'], linhas)
+
+
+if __name__ == '__main__':
+    main()
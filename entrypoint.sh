@@ -3,6 +3,26 @@
 PORT=8080
 WORKERS=4
 THREADS=4
+# wsgi (gunicorn + eventlet) ou asgi (gunicorn + uvicorn, com as views assíncronas de saldo e compras)
+SERVER_MODE=${SERVER_MODE:-wsgi}
+# WAL, pragmas e retentativas do SQLite para os workers concorrentes (ver boticario/sqlite3/base.py)
+export SQLITE_WAL=${SQLITE_WAL:-True}
+# Arquivos das métricas de cada worker, somados no /metrics. Os arquivos da execução anterior são descartados
+export METRICAS_DIRETORIO=${METRICAS_DIRETORIO:-/tmp/metricas}
+rm -rf "$METRICAS_DIRETORIO" && mkdir -p "$METRICAS_DIRETORIO"
+# Token exigido pelo /metrics. Se não for informado é gerado um aleatório, legível apenas dentro do container
+if [ -z "$METRICAS_TOKEN" ]; then
+  METRICAS_TOKEN=$(python -c 'import secrets; print(secrets.token_urlsafe(32))')
+  (umask 077 && echo "$METRICAS_TOKEN" > /tmp/metricas_token)
+fi
+export METRICAS_TOKEN
 
 python manage.py migrate # Essa etapa pode ser executada em outro lugar (ci/pipeline), deixei aqui por praticidade
-gunicorn boticario.wsgi --workers $WORKERS --threads $THREADS --worker-class eventlet --bind=0.0.0.0:$PORT
+if [ "$SERVER_MODE" = "asgi" ]; then
+  # O ORM roda em uma única thread por worker (sync_to_async thread_sensitive), então a conexão persistente é
+  # reaproveitada entre as requisições. No eventlet cada greenlet teria a própria conexão, que ficaria aberta
+  export DATABASE_CONN_MAX_AGE=${DATABASE_CONN_MAX_AGE:-60}
+  gunicorn boticario.asgi:application --workers $WORKERS --worker-class uvicorn.workers.UvicornWorker --bind=0.0.0.0:$PORT
+else
+  gunicorn boticario.wsgi --workers $WORKERS --threads $THREADS --worker-class eventlet --bind=0.0.0.0:$PORT
+fi
@@ -9,8 +9,10 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+from boticario.handlers import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'boticario.settings')
+# No modo ASGI as rotas de I/O (saldo e compras) são atendidas pelas views assíncronas de cashback.views
+os.environ.setdefault('VIEWS_ASSINCRONAS', 'True')
 
 application = get_asgi_application()
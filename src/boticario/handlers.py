@@ -0,0 +1,55 @@
+"""
+Handler ASGI com suporte a respostas em streaming que utilizam o ORM (ex: exportação de compras).
+
+O ASGIHandler do Django 3.1 percorre o iterador das respostas em streaming dentro do event loop, onde o ORM lança
+SynchronousOnlyOperation depois dos headers já enviados. Aqui cada parte é obtida via sync_to_async, na mesma
+thread (thread_sensitive) para que o cursor do QuerySet.iterator() continue na conexão que o abriu.
+"""
+import django
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler
+
+_FIM = object()
+
+
+def proxima_parte(partes):
+    return next(partes, _FIM)
+
+
+class BoticarioASGIHandler(ASGIHandler):
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+
+        # Mesmos headers e cookies do ASGIHandler.send_response
+        response_headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            response_headers.append((bytes(header), bytes(value)))
+        for c in response.cookies.values():
+            response_headers.append((b'Set-Cookie', c.output(header='').encode('ascii').strip()))
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': response_headers,
+        })
+
+        partes = await sync_to_async(iter, thread_sensitive=True)(response)
+        while True:
+            part = await sync_to_async(proxima_parte, thread_sensitive=True)(partes)
+            if part is _FIM:
+                break
+            for chunk, _ in self.chunk_bytes(part):
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body'})
+        await sync_to_async(response.close, thread_sensitive=True)()
+
+
+def get_asgi_application():
+    """Equivalente ao django.core.asgi.get_asgi_application, com o BoticarioASGIHandler"""
+    django.setup(set_prefix=False)
+    return BoticarioASGIHandler()
@@ -1,5 +1,22 @@
+import atexit
+import logging
+import os
+import queue
+import random
+import sys
+import zlib
+from datetime import datetime, timezone as dt_timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from django.conf import settings
 from django.utils import timezone
-from json_log_formatter import JSONFormatter
+from json_log_formatter import JSONFormatter, _json_serializable
+from log_request_id import DEFAULT_NO_REQUEST_ID, LOG_REQUESTS_NO_SETTING
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
 
 
 class BoticarioJSONFormatter(JSONFormatter):
@@ -18,7 +35,9 @@ class BoticarioJSONFormatter(JSONFormatter):
     def json_record(self, message, extra, record):
         extra['message'] = message
         if 'time' not in extra:
-            extra['time'] = timezone.now()
+            # Horário de criação do registro, que pode ser formatado depois pelo FilaHandler
+            created = getattr(record, 'created', None)
+            extra['time'] = datetime.fromtimestamp(created, dt_timezone.utc) if created else timezone.now()
         if record:
             self.add_record_field(extra, record, 'levelname',
                                   destination_name='level')
@@ -28,3 +47,88 @@ class BoticarioJSONFormatter(JSONFormatter):
         if 'request' in extra:
             del extra['request']  # Nao e serializavel
         return extra
+
+    def mutate_json_record(self, json_record):
+        # O orjson converte os datetime para ISO 8601 no mesmo formato do isoformat
+        if orjson is not None:
+            return json_record
+        return super(BoticarioJSONFormatter, self).mutate_json_record(json_record)
+
+    def to_json(self, record):
+        # Com o orjson instalado a serialização é feita por ele, mantendo o json da biblioteca padrão como alternativa
+        if orjson is not None:
+            try:
+                return orjson.dumps(record, default=_json_serializable).decode()
+            except TypeError:
+                record = super(BoticarioJSONFormatter, self).mutate_json_record(record)
+        return super(BoticarioJSONFormatter, self).to_json(record)
+
+
+class FilaHandler(QueueHandler):
+    """
+    Handler que apenas enfileira o registro na thread da requisição. A formatação e a escrita no stream são feitas
+    por uma thread (ou greenlet, com o eventlet) em background. Com a fila cheia o registro é descartado,
+    sem bloquear a requisição
+    """
+
+    def __init__(self, stream=None, tamanho=10000):
+        super(FilaHandler, self).__init__(None)
+        self.tamanho = tamanho
+        self.destino = logging.StreamHandler(stream or sys.stdout)
+        self.descartados = 0
+        self.listener = None
+        self.pid = None
+        self.iniciar()
+        atexit.register(self.parar)
+
+    def iniciar(self):
+        # Fila e listener novos no processo filho, já que a thread não sobrevive ao fork dos workers
+        self.pid = os.getpid()
+        self.queue = queue.Queue(self.tamanho)
+        self.listener = QueueListener(self.queue, self.destino)
+        self.listener.start()
+
+    def parar(self):
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+        self.listener = None
+
+    def setFormatter(self, fmt):
+        super(FilaHandler, self).setFormatter(fmt)
+        self.destino.setFormatter(fmt)
+
+    def prepare(self, record):
+        # A formatação fica para o listener, o registro segue como foi criado
+        return record
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            self.iniciar()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.descartados += 1
+
+    def close(self):
+        self.parar()
+        super(FilaHandler, self).close()
+
+
+class AmostragemFilter(logging.Filter):
+    """
+    Mantém apenas a fração `taxa` dos registros até o `nivel` informado (avisos e erros acima dele sempre passam).
+    A decisão é tomada pelo request_id, mantendo ou descartando todos os registros de uma mesma requisição
+    """
+
+    def __init__(self, taxa=1.0, nivel='INFO'):
+        super(AmostragemFilter, self).__init__()
+        self.taxa = taxa
+        self.nivel = logging.getLevelName(nivel) if isinstance(nivel, str) else nivel
+
+    def filter(self, record):
+        if self.taxa >= 1 or record.levelno > self.nivel:
+            return True
+        request_id = getattr(record, 'request_id', None)
+        if request_id and request_id != getattr(settings, LOG_REQUESTS_NO_SETTING, DEFAULT_NO_REQUEST_ID):
+            return zlib.crc32(request_id.encode()) % 10000 < self.taxa * 10000
+        return random.random() < self.taxa
@@ -30,11 +30,13 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'django_nose',
     'rest_framework',
-    'cashback',
+    'django_filters',
+    'cashback.apps.CashbackConfig',
 ]
 
 MIDDLEWARE = [
     'log_request_id.middleware.RequestIDMiddleware',
+    'cashback.instrumentacao.TempoRequisicaoMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -64,6 +66,9 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'boticario.wsgi.application'
 
+# Habilitado pelo boticario/asgi.py: as rotas de saldo e compras passam a ser atendidas pelas views assíncronas
+VIEWS_ASSINCRONAS = config('VIEWS_ASSINCRONAS', default=False, cast=bool)
+
 
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
@@ -71,11 +76,50 @@ WSGI_APPLICATION = 'boticario.wsgi.application'
 # Aqui entraria uma configuração para o endereço do banco
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'ENGINE': 'boticario.sqlite3',
+        'NAME': config('DATABASE_NAME', default=str(BASE_DIR / 'db.sqlite3')),
+        # Segundos que a conexão é mantida aberta entre requisições (0 fecha ao fim de cada requisição). Habilitado
+        # pelo entrypoint.sh apenas no modo asgi: com eventlet as conexões são por greenlet e se acumulariam abertas
+        'CONN_MAX_AGE': config('DATABASE_CONN_MAX_AGE', default=0, cast=int),
+    },
+    # Réplica de leitura da listagem de compras, utilizada apenas com DATABASE_REPLICA_HABILITADA
+    'replica': {
+        'ENGINE': 'boticario.sqlite3',
+        'NAME': config('DATABASE_REPLICA_NAME', default=config('DATABASE_NAME', default=str(BASE_DIR / 'db.sqlite3'))),
+        'CONN_MAX_AGE': config('DATABASE_CONN_MAX_AGE', default=0, cast=int),
+    },
 }
 
+DATABASE_ROUTERS = ['cashback.routers.ReplicaRouter']
+DATABASE_REPLICA_HABILITADA = config('DATABASE_REPLICA_HABILITADA', default=False, cast=bool)
+DATABASE_REPLICA_ALIAS = 'replica'
+# Após uma escrita as leituras do vendedor ficam no primário por esse tempo (segundos), cobrindo o atraso da replicação
+DATABASE_REPLICA_JANELA_ESCRITA = config('DATABASE_REPLICA_JANELA_ESCRITA', default=5, cast=int)
+# Alias de um cache em CACHES compartilhado entre os workers. "memoria" (por processo) não é aceito com a réplica
+# habilitada, pois a escrita recebida por um worker não fixaria as leituras feitas pelos demais
+DATABASE_REPLICA_BACKEND = config('DATABASE_REPLICA_BACKEND', default='compartilhado')
+
+# Aqui entraria um cache externo (ex: Redis) compartilhado entre as instâncias. O cache em arquivos é compartilhado
+# entre os workers do gunicorn no mesmo container
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'compartilhado': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': config('CACHE_COMPARTILHADO_DIRETORIO', default='/tmp/boticario_cache'),
+    },
+}
+
+# Modo de concorrência do SQLite (ver boticario/sqlite3/base.py): WAL, pragmas por conexão, BEGIN IMMEDIATE
+# e retentativa dos comandos que falham com "database is locked"
+SQLITE_WAL = config('SQLITE_WAL', default=False, cast=bool)
+SQLITE_SYNCHRONOUS = config('SQLITE_SYNCHRONOUS', default='NORMAL')
+SQLITE_BUSY_TIMEOUT = config('SQLITE_BUSY_TIMEOUT', default=5000, cast=int)  # Milissegundos
+SQLITE_CACHE_SIZE = config('SQLITE_CACHE_SIZE', default=-20000, cast=int)  # Negativo em KiB
+SQLITE_LOCK_RETENTATIVAS = config('SQLITE_LOCK_RETENTATIVAS', default=3, cast=int)
+SQLITE_LOCK_BACKOFF = config('SQLITE_LOCK_BACKOFF', default=0.05, cast=float)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -125,10 +169,16 @@ NOSE_ARGS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'cashback.authentication.VendedorJWTAuthentication',
     ],
 }
 
+# Cache por worker do vendedor carregado do banco na autenticação (0 desabilita)
+AUTENTICACAO_CACHE_TTL = config('AUTENTICACAO_CACHE_TTL', default=0, cast=int)
+AUTENTICACAO_CACHE_MAX_ITENS = config('AUTENTICACAO_CACHE_MAX_ITENS', default=10000, cast=int)
+# Logins com last_login mais recente que o intervalo (em segundos) não gravam no banco (0 grava sempre)
+LOGIN_INTERVALO_ULTIMO_ACESSO = config('LOGIN_INTERVALO_ULTIMO_ACESSO', default=0, cast=int)
+
 AUTH_USER_MODEL = 'cashback.Vendedor'
 APPEND_SLASH = False
 
@@ -138,6 +188,60 @@ REQUEST_ID_RESPONSE_HEADER = "X-Request-ID"
 
 SALDO_API = config('SALDO_API', default="https://mdaqk8ek5j.execute-api.us-east-1.amazonaws.com")
 SALDO_API_TOKEN = config('SALDO_API_TOKEN', default="ZXPURQOARHiMc6Y0flhRC1LVlZQVFRnm")
+# Conexões mantidas por processo, deve acompanhar a quantidade de threads/greenlets do worker
+SALDO_API_POOL_SIZE = config('SALDO_API_POOL_SIZE', default=10, cast=int)
+# Timeouts em segundos
+SALDO_API_TIMEOUT_CONEXAO = config('SALDO_API_TIMEOUT_CONEXAO', default=3.05, cast=float)
+SALDO_API_TIMEOUT_LEITURA = config('SALDO_API_TIMEOUT_LEITURA', default=5, cast=float)
+SALDO_API_RETENTATIVAS = config('SALDO_API_RETENTATIVAS', default=2, cast=int)
+SALDO_API_BACKOFF = config('SALDO_API_BACKOFF', default=0.2, cast=float)
+# Circuit breaker: falhas consecutivas para abrir, segundos aberto e chamadas de teste no estado semiaberto
+SALDO_API_CIRCUITO_FALHAS = config('SALDO_API_CIRCUITO_FALHAS', default=5, cast=int)
+SALDO_API_CIRCUITO_TEMPO_ABERTO = config('SALDO_API_CIRCUITO_TEMPO_ABERTO', default=30, cast=float)
+SALDO_API_CIRCUITO_TENTATIVAS_SEMIABERTO = config('SALDO_API_CIRCUITO_TENTATIVAS_SEMIABERTO', default=1, cast=int)
+# Com o circuito aberto retorna o último saldo conhecido do CPF (até o TTL em segundos) em vez de erro
+SALDO_API_CIRCUITO_ULTIMO_SALDO = config('SALDO_API_CIRCUITO_ULTIMO_SALDO', default=True, cast=bool)
+SALDO_API_CIRCUITO_ULTIMO_SALDO_TTL = config('SALDO_API_CIRCUITO_ULTIMO_SALDO_TTL', default=3600, cast=int)
+
+# Consulta de saldos em lote: máximo de CPFs, consultas simultâneas por worker e prazo do lote em segundos
+SALDO_LOTE_TAMANHO_MAXIMO = config('SALDO_LOTE_TAMANHO_MAXIMO', default=100, cast=int)
+SALDO_LOTE_CONCORRENCIA = config('SALDO_LOTE_CONCORRENCIA', default=10, cast=int)
+SALDO_LOTE_PRAZO = config('SALDO_LOTE_PRAZO', default=8, cast=float)
+
+# Cache do saldo por CPF (em segundos). TTL 0 desabilita o cache
+SALDO_CACHE_TTL = config('SALDO_CACHE_TTL', default=60, cast=int)
+# Tempo após o TTL em que o saldo antigo ainda é retornado enquanto é atualizado em background
+SALDO_CACHE_STALE = config('SALDO_CACHE_STALE', default=300, cast=int)
+# "memoria" para cache por processo (LRU) ou o alias de um cache em CACHES para compartilhar entre os workers.
+# Em memória a invalidação após uma compra vale apenas para o worker que a recebeu, e os demais servem o saldo
+# anterior até o TTL expirar
+SALDO_CACHE_BACKEND = config('SALDO_CACHE_BACKEND', default='memoria')
+SALDO_CACHE_MAX_ITENS = config('SALDO_CACHE_MAX_ITENS', default=10000, cast=int)
+
+# Quando habilitado o recálculo do percentual de cashback é feito pelo comando processar_recalculos
+CASHBACK_RECALCULO_ASSINCRONO = config('CASHBACK_RECALCULO_ASSINCRONO', default=False, cast=bool)
+
+COMPRA_LOTE_TAMANHO_MAXIMO = config('COMPRA_LOTE_TAMANHO_MAXIMO', default=500, cast=int)
+# Compras lidas do banco (e enviadas) por vez na exportação do histórico
+EXPORTACAO_TAMANHO_BLOCO = config('EXPORTACAO_TAMANHO_BLOCO', default=2000, cast=int)
+
+# Tempo por fase e consultas SQL de cada requisição no log e no header Server-Timing
+TEMPO_REQUISICAO = config('TEMPO_REQUISICAO', default=True, cast=bool)
+TEMPO_REQUISICAO_SERVER_TIMING = config('TEMPO_REQUISICAO_SERVER_TIMING', default=True, cast=bool)
+
+# Métricas no formato do Prometheus em /metrics. Com METRICAS_DIRETORIO cada worker grava as métricas em um arquivo
+# próprio nesse diretório (que deve ser limpo antes de iniciar o servidor) e o endpoint soma todos os workers.
+# O endpoint exige o header Authorization: Bearer <METRICAS_TOKEN> e, sem o token configurado, nega todo acesso
+METRICAS = config('METRICAS', default=True, cast=bool)
+METRICAS_DIRETORIO = config('METRICAS_DIRETORIO', default='')
+METRICAS_TOKEN = config('METRICAS_TOKEN', default='')
+
+# Logs enfileirados na requisição e escritos por uma thread em background (até LOG_FILA_TAMANHO registros pendentes)
+LOG_ASSINCRONO = config('LOG_ASSINCRONO', default=True, cast=bool)
+LOG_FILA_TAMANHO = config('LOG_FILA_TAMANHO', default=10000, cast=int)
+# Fração das requisições com os logs até LOG_AMOSTRAGEM_NIVEL mantidos (avisos e erros são sempre mantidos)
+LOG_AMOSTRAGEM = config('LOG_AMOSTRAGEM', default=1.0, cast=float)
+LOG_AMOSTRAGEM_NIVEL = config('LOG_AMOSTRAGEM_NIVEL', default='INFO')
 
 LOGGING = {
     'version': 1,
@@ -150,9 +254,10 @@ LOGGING = {
     },
     'handlers': {
         'console': {
-            'class': 'logging.StreamHandler',
+            **({'()': 'boticario.logging.FilaHandler', 'tamanho': LOG_FILA_TAMANHO} if LOG_ASSINCRONO
+               else {'class': 'logging.StreamHandler'}),
             'formatter': 'json',
-            'filters': ['request_id'],
+            'filters': ['request_id', 'amostragem'],
             'stream': stdout,
         },
         'null': {
@@ -164,6 +269,11 @@ LOGGING = {
         'request_id': {
             '()': 'log_request_id.filters.RequestIDFilter',
         },
+        'amostragem': {
+            '()': 'boticario.logging.AmostragemFilter',
+            'taxa': LOG_AMOSTRAGEM,
+            'nivel': LOG_AMOSTRAGEM_NIVEL,
+        },
     },
     'loggers': {
         'core': {
@@ -0,0 +1,74 @@
+"""
+Backend SQLite com o modo de concorrência habilitado por SQLITE_WAL:
+
+* journal WAL (leituras não bloqueiam a escrita) e pragmas de synchronous, busy_timeout e cache em toda conexão
+* transações iniciadas com BEGIN IMMEDIATE, reservando a escrita no início da transação em vez de falhar
+  ao promover uma leitura para escrita no meio dela
+* retentativa com backoff exponencial das escritas que falham com "database is locked" fora de uma transação
+  (o próprio BEGIN IMMEDIATE ou um comando em autocommit), onde repetir o comando é seguro
+
+Com SQLITE_WAL desabilitado se comporta exatamente como o backend sqlite3 do Django.
+"""
+import logging
+import random
+import sqlite3
+from time import sleep
+
+from django.conf import settings
+from django.db.backends.sqlite3 import base
+
+logger = logging.getLogger('core')
+
+
+def bloqueado(ex):
+    return isinstance(ex, sqlite3.OperationalError) and 'locked' in str(ex)
+
+
+class SQLiteCursorWrapper(base.SQLiteCursorWrapper):
+
+    def repetir_se_bloqueado(self, executar, *args):
+        # Dentro de uma transação o comando não pode ser repetido isoladamente
+        if self.connection.in_transaction:
+            return executar(*args)
+
+        retentativas = settings.SQLITE_LOCK_RETENTATIVAS
+        for tentativa in range(retentativas + 1):
+            try:
+                return executar(*args)
+            except sqlite3.OperationalError as ex:
+                if not bloqueado(ex) or tentativa == retentativas:
+                    raise
+                espera = random.uniform(0, settings.SQLITE_LOCK_BACKOFF * 2 ** tentativa)
+                logger.warning("Banco de dados bloqueado, repetindo o comando",
+                               extra={"tentativa": tentativa + 1, "espera": espera})
+                sleep(espera)
+
+    def execute(self, query, params=None):
+        return self.repetir_se_bloqueado(super(SQLiteCursorWrapper, self).execute, query, params)
+
+    def executemany(self, query, param_list):
+        return self.repetir_se_bloqueado(super(SQLiteCursorWrapper, self).executemany, query, param_list)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_new_connection(self, conn_params):
+        conn = super(DatabaseWrapper, self).get_new_connection(conn_params)
+        if settings.SQLITE_WAL:
+            # O busy_timeout vem antes para que a troca do journal também aguarde outras conexões
+            conn.execute(f'PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT)}')
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(f'PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}')
+            conn.execute(f'PRAGMA cache_size={int(settings.SQLITE_CACHE_SIZE)}')
+        return conn
+
+    def create_cursor(self, name=None):
+        if settings.SQLITE_WAL:
+            return self.connection.cursor(factory=SQLiteCursorWrapper)
+        return super(DatabaseWrapper, self).create_cursor(name)
+
+    def _start_transaction_under_autocommit(self):
+        if settings.SQLITE_WAL:
+            self.cursor().execute('BEGIN IMMEDIATE')
+        else:
+            super(DatabaseWrapper, self)._start_transaction_under_autocommit()
@@ -1,9 +1,27 @@
-from datetime import datetime
+import io
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+from decimal import Decimal
+from threading import Timer
 from types import SimpleNamespace
+from unittest import skipUnless
+from unittest.mock import patch
 
+from django.conf import settings
+from django.db import connection, OperationalError
 from django.test import TestCase
 
-from boticario.logging import BoticarioJSONFormatter
+from boticario import logging as boticario_logging
+from boticario.logging import BoticarioJSONFormatter, FilaHandler, AmostragemFilter
+from boticario.sqlite3.base import DatabaseWrapper
 
 
 class BoticarioJSONFormatterTest(TestCase):
@@ -81,3 +99,193 @@ class BoticarioJSONFormatterTest(TestCase):
         self.assertEqual(return_value["lineno"], 42)
         self.assertIn("request_id", return_value)
         self.assertEqual(return_value["request_id"], "xpto")
+
+    def test_json_record_time_da_criacao_do_registro(self):
+        record = logging.LogRecord('core', logging.INFO, 'foo.py', 42, "Foo", None, None)
+        record.created = 1600000000.5
+        return_value = self.formatter.json_record("Foo", {}, record)
+        self.assertEqual(return_value["time"], datetime(2020, 9, 13, 12, 26, 40, 500000, tzinfo=timezone.utc))
+
+    def test_format_mesmo_conteudo_com_e_sem_orjson(self):
+        extra = {"body": b"erro", "valor": Decimal("10.50"), "cpf": "Jo\u00e3o", "duration": 0.25, "status": 400}
+        for created in [1600000000.5, 1600000000]:
+            record = logging.makeLogRecord({"msg": "Consulta ao SaldoAPI", "levelname": "DEBUG", "created": created,
+                                            **extra})
+            json_orjson = self.formatter.format(record)
+            with patch.object(boticario_logging, 'orjson', None):
+                json_padrao = self.formatter.format(record)
+            self.assertEqual(json.loads(json_orjson), json.loads(json_padrao))
+
+    @skipUnless(boticario_logging.orjson, "Requer o orjson")
+    def test_to_json_com_orjson_chaves_nao_textuais(self):
+        record = {1: "foo", "time": datetime(2020, 9, 13, 12, 26, 40, tzinfo=timezone.utc)}
+        self.assertEqual(json.loads(self.formatter.to_json(record)), {"1": "foo", "time": "2020-09-13T12:26:40+00:00"})
+
+
+class FilaHandlerTest(TestCase):
+
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.handler = FilaHandler(self.stream, tamanho=10)
+        self.addCleanup(self.handler.close)
+        self.logger = logging.Logger('fila')
+        self.logger.addHandler(self.handler)
+
+    def test_formata_e_escreve_em_background(self):
+        threads = []
+
+        class Formatter(BoticarioJSONFormatter):
+            def format(self, record):
+                threads.append(threading.get_ident())
+                return super(Formatter, self).format(record)
+
+        self.handler.setFormatter(Formatter())
+        self.logger.info("Foo %s", "bar", extra={"cpf": "12345678909"})
+        self.handler.parar()
+        registro = json.loads(self.stream.getvalue())
+        self.assertEqual(registro["message"], "Foo bar")
+        self.assertEqual(registro["cpf"], "12345678909")
+        self.assertEqual(registro["level"], "INFO")
+        self.assertNotIn(threading.get_ident(), threads)
+
+    def test_descarta_com_a_fila_cheia_sem_bloquear(self):
+        self.handler.parar()
+        self.handler.queue = queue.Queue(2)
+        for i in range(5):
+            self.logger.info("Foo %s", i)
+        self.assertEqual(self.handler.descartados, 3)
+        self.assertEqual(self.handler.queue.qsize(), 2)
+
+    def test_reinicia_listener_em_outro_processo(self):
+        listener = self.handler.listener
+        self.addCleanup(listener.stop)
+        self.handler.pid = -1
+        self.handler.setFormatter(BoticarioJSONFormatter())
+        self.logger.info("Foo")
+        self.assertEqual(self.handler.pid, os.getpid())
+        self.assertIsNot(self.handler.listener, listener)
+        self.handler.parar()
+        self.assertEqual(json.loads(self.stream.getvalue())["message"], "Foo")
+
+
+class AmostragemFilterTest(TestCase):
+
+    def registro(self, nivel=logging.INFO, request_id=None):
+        record = logging.LogRecord('core', nivel, 'foo.py', 42, "Foo", None, None)
+        if request_id:
+            record.request_id = request_id
+        return record
+
+    def test_sem_amostragem_mantem_todos(self):
+        filtro = AmostragemFilter()
+        self.assertTrue(all(filtro.filter(self.registro(request_id=f"{i}")) for i in range(100)))
+
+    def test_mantem_avisos_e_erros(self):
+        filtro = AmostragemFilter(taxa=0)
+        self.assertFalse(filtro.filter(self.registro(logging.INFO, "abc")))
+        self.assertFalse(filtro.filter(self.registro(logging.DEBUG)))
+        self.assertTrue(filtro.filter(self.registro(logging.WARNING, "abc")))
+        self.assertTrue(filtro.filter(self.registro(logging.ERROR)))
+
+    def test_mesma_decisao_para_a_requisicao(self):
+        filtro = AmostragemFilter(taxa=0.5, nivel='DEBUG')
+        mantidas = [filtro.filter(self.registro(logging.DEBUG, f"req-{i}")) for i in range(1000)]
+        self.assertTrue(400 < sum(mantidas) < 600)
+        for i, mantida in enumerate(mantidas):
+            self.assertEqual(filtro.filter(self.registro(logging.DEBUG, f"req-{i}")), mantida)
+        # Registros acima do nível configurado não são amostrados
+        self.assertTrue(all(filtro.filter(self.registro(logging.INFO, f"req-{i}")) for i in range(100)))
+
+
+class SQLiteConcorrenciaTest(TestCase):
+    """Modo de concorrência do backend boticario.sqlite3 (SQLITE_WAL)"""
+
+    def setUp(self):
+        # Diretório temporário, que também recebe os arquivos -wal e -shm do banco
+        diretorio = tempfile.TemporaryDirectory()
+        self.addCleanup(diretorio.cleanup)
+        self.banco = os.path.join(diretorio.name, 'db.sqlite3')
+
+    def conectar(self):
+        settings_dict = dict(connection.settings_dict, NAME=self.banco)
+        conexao = DatabaseWrapper(settings_dict, alias='concorrencia')
+        self.addCleanup(conexao.close)
+        return conexao
+
+    def test_pragmas_aplicados_em_toda_conexao(self):
+        with self.settings(SQLITE_WAL=True, SQLITE_BUSY_TIMEOUT=1234):
+            with self.conectar().cursor() as cursor:
+                self.assertEqual(cursor.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+                self.assertEqual(cursor.execute('PRAGMA synchronous').fetchone()[0], 1)  # NORMAL
+                self.assertEqual(cursor.execute('PRAGMA busy_timeout').fetchone()[0], 1234)
+
+    def test_desabilitado_mantem_padrao_do_django(self):
+        with self.settings(SQLITE_WAL=False):
+            with self.conectar().cursor() as cursor:
+                self.assertEqual(cursor.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+
+    def test_repete_comando_bloqueado_fora_de_transacao(self):
+        bloqueio = sqlite3.connect(self.banco, isolation_level=None, check_same_thread=False)
+        bloqueio.execute('PRAGMA journal_mode=WAL')
+        bloqueio.execute('CREATE TABLE teste (id INTEGER)')
+        bloqueio.execute('BEGIN IMMEDIATE')
+        Timer(0.2, bloqueio.commit).start()
+        with self.settings(SQLITE_WAL=True, SQLITE_BUSY_TIMEOUT=10, SQLITE_LOCK_RETENTATIVAS=10,
+                           SQLITE_LOCK_BACKOFF=0.05):
+            with self.conectar().cursor() as cursor:
+                cursor.execute('INSERT INTO teste VALUES (1)')
+                self.assertEqual(cursor.execute('SELECT COUNT(*) FROM teste').fetchone()[0], 1)
+        bloqueio.close()
+
+    def test_begin_immediate_repetido_ate_esgotar_retentativas(self):
+        conexao = self.conectar()
+        with self.settings(SQLITE_WAL=True, SQLITE_BUSY_TIMEOUT=10, SQLITE_LOCK_RETENTATIVAS=10):
+            with conexao.cursor() as cursor:
+                cursor.execute('CREATE TABLE teste (id INTEGER)')
+            bloqueio = sqlite3.connect(self.banco, isolation_level=None)
+            bloqueio.execute('BEGIN IMMEDIATE')
+            try:
+                with self.assertRaises(OperationalError), patch('boticario.sqlite3.base.sleep') as sleep:
+                    conexao._start_transaction_under_autocommit()
+            finally:
+                bloqueio.rollback()
+                bloqueio.close()
+        self.assertEqual(sleep.call_count, 10)  # O BEGIN IMMEDIATE é repetido até esgotar as retentativas
+
+    def test_nao_repete_comando_dentro_de_transacao(self):
+        with self.settings(SQLITE_WAL=True):
+            cursor = self.conectar().cursor()
+            cursor.execute('BEGIN')
+            with patch('django.db.backends.sqlite3.base.SQLiteCursorWrapper.execute',
+                       side_effect=sqlite3.OperationalError('database is locked')), \
+                    patch('boticario.sqlite3.base.sleep') as sleep:
+                with self.assertRaises(OperationalError):
+                    cursor.execute('SELECT 1')
+        sleep.assert_not_called()
+
+    def test_escritas_de_varios_processos(self):
+        env = dict(os.environ, DATABASE_NAME=self.banco, SQLITE_WAL='True', DJANGO_SETTINGS_MODULE='boticario.settings')
+        subprocess.run([sys.executable, 'manage.py', 'migrate', '-v', '0'], cwd=settings.BASE_DIR, env=env,
+                       check=True, timeout=120)
+        script = """
+import sys
+import django
+django.setup()
+from decimal import Decimal
+from cashback.models import Vendedor, Compra
+indice = int(sys.argv[1])
+vendedor = Vendedor.objects.create(username=f"vendedor{indice}", cpf=f"{indice:011}")
+for i in range(40):
+    Compra.objects.create(codigo=f"{indice}{i:05}", vendedor=vendedor, valor=Decimal(100))
+    vendedor.registrar_login()
+"""
+        processos = [subprocess.Popen([sys.executable, '-W', 'ignore', '-c', script, str(indice)], cwd=settings.BASE_DIR,
+                                      env=env, stderr=subprocess.PIPE, text=True)
+                     for indice in range(4)]
+        for processo in processos:
+            _, erro = processo.communicate(timeout=120)
+            self.assertEqual(processo.returncode, 0, erro)
+
+        with sqlite3.connect(self.banco) as conexao:
+            self.assertEqual(conexao.execute('SELECT COUNT(*) FROM cashback_compra').fetchone()[0], 160)
+            self.assertEqual(conexao.execute('SELECT COUNT(*) FROM cashback_vendasdiarias').fetchone()[0], 4)
@@ -1,22 +1,37 @@
+import csv
+import json
 import logging
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from datetime import datetime, time, timedelta
+from itertools import islice
 
 from django.contrib.auth import authenticate
-from django.contrib.auth.models import update_last_login
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import make_aware
 from django.views.generic.dates import timezone_today
+import django_filters
 from rest_framework import mixins, status, permissions, fields
 from rest_framework import routers
 from rest_framework import serializers
 from rest_framework import viewsets
 from rest_framework.decorators import action
-from rest_framework.exceptions import ValidationError
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import ValidationError, NotFound
+from rest_framework.pagination import PageNumberPagination, BasePagination
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+from rest_framework.validators import UniqueValidator
 from rest_framework_simplejwt.exceptions import TokenError
 from rest_framework_simplejwt.serializers import TokenRefreshSerializer
-from rest_framework_simplejwt.tokens import RefreshToken
 
 from cashback import models
-from cashback.client import SaldoAPI
+from cashback.authentication import VendedorRefreshToken
+from cashback.client import get_saldo_api, consultar_saldos
+from cashback.routers import ler_da_replica, alias_de_leitura
 
 logger = logging.getLogger('core')
 
@@ -33,12 +48,108 @@ class ChoiceField(serializers.ChoiceField):
         return self._choices[obj]
 
 
+class PodeConsultarSaldos(permissions.BasePermission):
+    message = "Não é permitido consultar o saldo de outros vendedores"
+
+    def has_permission(self, request, view):
+        return request.user.has_perm('cashback.consultar_saldos')
+
+
 class ComprasPagination(PageNumberPagination):
     page_size = 10
     page_size_query_param = 'page_size'
     max_page_size = 50
 
 
+class ComprasCursorPagination(BasePagination):
+    """
+    Paginação por cursor (keyset) ordenada por (data, id) decrescente.
+    Não executa COUNT e não usa OFFSET, então o custo de uma página não depende da profundidade.
+    Ativada com ?paginacao=cursor, as páginas seguintes são navegadas pelo parâmetro cursor.
+    """
+    page_size = ComprasPagination.page_size
+    page_size_query_param = ComprasPagination.page_size_query_param
+    max_page_size = ComprasPagination.max_page_size
+    cursor_query_param = 'cursor'
+    modo_query_param = 'paginacao'
+    invalid_cursor_message = 'Cursor inválido'
+
+    @classmethod
+    def solicitada(cls, request):
+        return request.query_params.get(cls.modo_query_param) == 'cursor' or cls.cursor_query_param in request.query_params
+
+    # Mesma interpretação do page_size da paginação por número de página (valor inválido usa o padrão)
+    get_page_size = PageNumberPagination.get_page_size
+
+    @staticmethod
+    def encode_cursor(compra, reverso):
+        """:param compra: linha da listagem (dict com data e id)"""
+        posicao = f"{compra['data'].isoformat()}|{compra['id']}|{int(reverso)}"
+        return urlsafe_b64encode(posicao.encode()).decode()
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            data, pk, reverso = urlsafe_b64decode(encoded.encode()).decode().split('|')
+            data = parse_datetime(data)
+            if not data:
+                raise ValueError(encoded)
+            return data, int(pk), bool(int(reverso))
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        page_size = self.get_page_size(request)
+
+        cursor = self.decode_cursor(request)
+        reverso = False
+        # O filtro data <= cursor (ou >=) é redundante, mas permite que o índice (vendedor, data) limite a busca
+        if cursor is None:
+            queryset = queryset.order_by('-data', '-id')
+        else:
+            data, pk, reverso = cursor
+            if reverso:
+                queryset = queryset.filter(Q(data__gt=data) | Q(id__gt=pk), data__gte=data).order_by('data', 'id')
+            else:
+                queryset = queryset.filter(Q(data__lt=data) | Q(id__lt=pk), data__lte=data).order_by('-data', '-id')
+
+        # Busca um item a mais para saber se existe outra página na mesma direção
+        page = list(queryset[:page_size + 1])
+        tem_mais = len(page) > page_size
+        page = page[:page_size]
+        if reverso:
+            page.reverse()
+            self.has_next, self.has_previous = bool(page), tem_mais
+        else:
+            self.has_next, self.has_previous = tem_mais, cursor is not None and bool(page)
+        self.page = page
+        return page
+
+    def get_link(self, compra, reverso):
+        return replace_query_param(self.base_url, self.cursor_query_param, self.encode_cursor(compra, reverso))
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.get_link(self.page[-1], reverso=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        return self.get_link(self.page[0], reverso=True)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+
 class CPFRelatedField(serializers.SlugRelatedField):
     slug_field = 'cpf'
 
@@ -54,6 +165,16 @@ class CPFRelatedField(serializers.SlugRelatedField):
         return super(CPFRelatedField, self).run_validation(data=data)
 
 
+class CPFLoteField(CPFRelatedField):
+    """Resolve cada CPF apenas uma vez por lote, guardando o vendedor no contexto compartilhado do lote"""
+
+    def to_internal_value(self, data):
+        vendedores = self.context.setdefault('vendedores', {})
+        if data not in vendedores:
+            vendedores[data] = super(CPFLoteField, self).to_internal_value(data)
+        return vendedores[data]
+
+
 class VendedorSerializer(serializers.ModelSerializer):
     login = serializers.CharField(source='username')
     nome = serializers.CharField()
@@ -84,9 +205,18 @@ class LoginSerializer(serializers.Serializer):
     senha = serializers.CharField(required=True)
 
 
+class SaldosSerializer(serializers.Serializer):
+    cpfs = serializers.ListField(child=serializers.CharField(max_length=14), allow_empty=False)
+
+    def validate_cpfs(self, value):
+        if len(value) > settings.SALDO_LOTE_TAMANHO_MAXIMO:
+            raise ValidationError(f"É possível consultar no máximo {settings.SALDO_LOTE_TAMANHO_MAXIMO} CPFs")
+        return value
+
+
 class CompraSerializer(serializers.ModelSerializer):
     cpf = CPFRelatedField(queryset=models.Vendedor.objects.all(), source='vendedor')
-    cashback = serializers.DecimalField(max_digits=8, decimal_places=2, read_only=True)
+    cashback = serializers.DecimalField(max_digits=8, decimal_places=2, source='valor_cashback', read_only=True)
     status = ChoiceField(models.Compra.STATUS_CHOICES, read_only=True)
 
     def get_user(self):
@@ -112,11 +242,169 @@ class CompraSerializer(serializers.ModelSerializer):
         read_only_fields = ['percentual_cashback']
 
 
+class ComprasFilter(django_filters.FilterSet):
+    """
+    Filtros da listagem de compras por período (datas inclusivas) e status.
+    As datas viram um intervalo de datetime para que os índices (vendedor, data) e (vendedor, status, data) sejam usados.
+    O status é aceito pelo código (V, A, N) ou pela descrição retornada na listagem (ex: Aprovado)
+    """
+    codigos_status = {descricao: codigo for codigo, descricao in models.Compra.STATUS_CHOICES}
+
+    data_inicio = django_filters.DateFilter(method='filtrar_data_inicio')
+    data_fim = django_filters.DateFilter(method='filtrar_data_fim')
+    status = django_filters.ChoiceFilter(
+        choices=models.Compra.STATUS_CHOICES + tuple((descricao, descricao) for descricao in codigos_status),
+        method='filtrar_status')
+
+    class Meta:
+        model = models.Compra
+        fields = ['data_inicio', 'data_fim', 'status']
+
+    @staticmethod
+    def inicio_do_dia(dia):
+        # is_dst=False: nos dias de início do horário de verão a meia-noite não existe e o dia começa à 01:00
+        return make_aware(datetime.combine(dia, time.min), is_dst=False)
+
+    def filtrar_data_inicio(self, queryset, name, value):
+        return queryset.filter(data__gte=self.inicio_do_dia(value))
+
+    def filtrar_data_fim(self, queryset, name, value):
+        return queryset.filter(data__lt=self.inicio_do_dia(value + timedelta(days=1)))
+
+    def filtrar_status(self, queryset, name, value):
+        return queryset.filter(status=self.codigos_status.get(value, value))
+
+    @classmethod
+    def filtrar(cls, request, queryset):
+        filtro = cls(request.query_params, queryset=queryset)
+        if not filtro.is_valid():
+            raise ValidationError(filtro.errors)
+        return filtro.qs
+
+
+class CompraListagemSerializer:
+    """
+    Serialização somente leitura da listagem de compras a partir das linhas de .values().
+    Gera o mesmo JSON do CompraSerializer sem instanciar os models nem os fields a cada linha.
+    """
+    campos = ('id', 'codigo', 'valor', 'data', 'percentual_cashback', 'valor_cashback', 'status')
+    status_choices = dict(models.Compra.STATUS_CHOICES)
+
+    def __init__(self, compras, cpf):
+        self.compras = compras
+        self.cpf = cpf
+
+    @classmethod
+    def queryset(cls, vendedor):
+        # Filtra pelo id para aceitar também o vendedor construído a partir do token
+        return models.Compra.objects.filter(vendedor_id=vendedor.pk).order_by('-data').values(*cls.campos)
+
+    @staticmethod
+    def formatar_data(data, fuso):
+        """Mesmo formato ISO 8601 do DateTimeField do DRF, no fuso corrente"""
+        if not data:
+            return None
+        data = data.astimezone(fuso).isoformat()
+        if data.endswith('+00:00'):
+            data = data[:-6] + 'Z'
+        return data
+
+    def linhas(self):
+        """Gera as linhas conforme as compras são lidas, permitindo serializar iteradores sem materializá-los"""
+        # O fuso é resolvido uma vez por página. Os decimais já vêm do banco com 2 casas, como o DecimalField exibe
+        fuso = serializers.DateTimeField().default_timezone()
+        formatar_data = self.formatar_data
+        for compra in self.compras:
+            yield {
+                'codigo': compra['codigo'],
+                'valor': f"{compra['valor']:f}",
+                'data': formatar_data(compra['data'], fuso),
+                'cpf': self.cpf,
+                'percentual_cashback': compra['percentual_cashback'],
+                'cashback': f"{compra['valor_cashback']:f}",
+                'status': self.status_choices[compra['status']],
+            }
+
+    @property
+    def data(self):
+        return list(self.linhas())
+
+
+class EcoCSV:
+    """Arquivo fictício para o csv.writer, que apenas devolve a linha escrita"""
+
+    def write(self, linha):
+        return linha
+
+
+class ExportacaoCompras:
+    """
+    Exportação do histórico de compras do vendedor em NDJSON ou CSV.
+    As compras são lidas em blocos de EXPORTACAO_TAMANHO_BLOCO com QuerySet.iterator() e enviadas conforme são lidas,
+    então a memória utilizada não depende do tamanho do histórico
+    """
+    formatos = {
+        'ndjson': 'application/x-ndjson',
+        'csv': 'text/csv; charset=utf-8',
+    }
+    colunas = ['codigo', 'valor', 'data', 'cpf', 'percentual_cashback', 'cashback', 'status']
+
+    def __init__(self, compras, cpf, formato):
+        self.compras = compras
+        self.cpf = cpf
+        self.formato = formato
+
+    def blocos(self):
+        tamanho = settings.EXPORTACAO_TAMANHO_BLOCO
+        linhas = CompraListagemSerializer(self.compras.iterator(chunk_size=tamanho), self.cpf).linhas()
+        while True:
+            bloco = list(islice(linhas, tamanho))
+            if not bloco:
+                return
+            yield bloco
+
+    def ndjson(self):
+        encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+        for bloco in self.blocos():
+            yield ''.join(f'{encoder.encode(linha)}\n' for linha in bloco).encode()
+
+    def csv(self):
+        writer = csv.writer(EcoCSV())
+        yield writer.writerow(self.colunas).encode()
+        for bloco in self.blocos():
+            yield ''.join(writer.writerow([linha[coluna] for coluna in self.colunas]) for linha in bloco).encode()
+
+    def resposta(self):
+        response = StreamingHttpResponse(getattr(self, self.formato)(), content_type=self.formatos[self.formato])
+        response['Content-Disposition'] = f'attachment; filename="compras-{self.cpf}.{self.formato}"'
+        return response
+
+
+class CompraLoteItemSerializer(CompraSerializer):
+    """
+    Mesmas regras do CompraSerializer para cada item do lote.
+    A unicidade do código é verificada pela view com uma única consulta para o lote inteiro.
+    """
+    cpf = CPFLoteField(queryset=models.Vendedor.objects.all(), source='vendedor')
+
+    class Meta(CompraSerializer.Meta):
+        extra_kwargs = {'codigo': {'validators': []}}
+
+
 class VendedorViewset(mixins.CreateModelMixin, viewsets.GenericViewSet):
     queryset = models.Vendedor.objects.all()
     serializer_class = VendedorSerializer
     pagination_class = ComprasPagination
 
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            if ComprasCursorPagination.solicitada(self.request):
+                self._paginator = ComprasCursorPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
     @action(detail=False, methods=['post'])
     def login(self, request):
         serializer = LoginSerializer(data=request.data)
@@ -127,8 +415,8 @@ class VendedorViewset(mixins.CreateModelMixin, viewsets.GenericViewSet):
         user = authenticate(username=username, password=password)
         if not user:
             return Response({"erro": "Login ou senha incorretos"}, status=status.HTTP_400_BAD_REQUEST)
-        update_last_login(None, user)
-        tokens = RefreshToken.for_user(user)  # Gera os tokens JWT
+        user.registrar_login()
+        tokens = VendedorRefreshToken.for_user(user)  # Gera os tokens JWT com o CPF nas claims
         return Response(
             {
                 'refresh': str(tokens),
@@ -156,12 +444,31 @@ class VendedorViewset(mixins.CreateModelMixin, viewsets.GenericViewSet):
             return Response({"erro": "Não é possível acessar a listagem de vendas de outro vendedor"},
                             status.HTTP_400_BAD_REQUEST)
 
-        # Vendedor precisa existir pois a rota exige autenticação
-        vendedor = models.Vendedor.objects.filter(cpf=pk).first()
-        page = self.paginate_queryset(vendedor.compras.order_by('-data'))
-        serializer = CompraSerializer(page, many=True)
+        # O vendedor é o próprio usuário autenticado, sem necessidade de consultá-lo novamente
+        compras = ComprasFilter.filtrar(request, CompraListagemSerializer.queryset(request.user))
+        with ler_da_replica(request.user.pk):
+            page = self.paginate_queryset(compras)
+        serializer = CompraListagemSerializer(page, request.user.cpf)
         return self.get_paginated_response(serializer.data)
 
+    @action(detail=True, methods=['get'], url_path='compras/exportar', permission_classes=[permissions.IsAuthenticated])
+    def exportar_compras(self, request, pk):
+        if request.user.cpf != pk:
+            logger.info("Usuário tentou exportar as vendas de outro vendedor",
+                        extra={"cpf_usuario": request.user.cpf, "cpf_listagem": pk})
+            return Response({"erro": "Não é possível exportar as vendas de outro vendedor"},
+                            status.HTTP_400_BAD_REQUEST)
+
+        formato = request.query_params.get('formato', 'ndjson')
+        if formato not in ExportacaoCompras.formatos:
+            return Response({"formato": [f"Formato {formato} inválido, utilize ndjson ou csv"]},
+                            status.HTTP_400_BAD_REQUEST)
+
+        compras = ComprasFilter.filtrar(request, CompraListagemSerializer.queryset(request.user))
+        # A réplica é escolhida agora, pois as linhas só são lidas depois do retorno da view
+        compras = compras.order_by('-data', '-id').using(alias_de_leitura(request.user.pk))
+        return ExportacaoCompras(compras, request.user.cpf, formato).resposta()
+
     @action(detail=True, methods=['get'], permission_classes=[permissions.IsAuthenticated])
     def saldo(self, request, pk):
         if request.user.cpf != pk:
@@ -169,19 +476,93 @@ class VendedorViewset(mixins.CreateModelMixin, viewsets.GenericViewSet):
                         extra={"cpf_usuario": request.user.cpf, "cpf_listagem": pk})
             return Response({"erro": "Não é possível acessar o saldo de outro vendedor"},
                             status.HTTP_400_BAD_REQUEST)
-        saldo_api = SaldoAPI()
-        saldo = saldo_api.get_saldo(pk)
+        saldo = get_saldo_api().get_saldo(pk)
         if not saldo:
             logger.error("Não foi possível obter o saldo", extra={"cpf": pk})
             return Response({}, status.HTTP_500_INTERNAL_SERVER_ERROR)
         return Response({"saldo": saldo}, status.HTTP_200_OK)
 
+    @action(detail=False, methods=['post'], permission_classes=[permissions.IsAuthenticated, PodeConsultarSaldos])
+    def saldos(self, request):
+        serializer = SaldosSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        cpfs = []
+        erros = {}
+        for cpf in serializer.validated_data['cpfs']:
+            cpf_sanitizado = models.Vendedor.sanitizar_cpf(cpf)
+            if not cpf_sanitizado:
+                erros[cpf] = f"CPF {cpf} inválido"
+            elif cpf_sanitizado not in cpfs:
+                cpfs.append(cpf_sanitizado)
+
+        saldos, erros_consulta = consultar_saldos(cpfs, settings.SALDO_LOTE_PRAZO)
+        erros.update(erros_consulta)
+        if erros:
+            logger.error("Não foi possível obter alguns saldos do lote", extra={"erros": len(erros)})
+        return Response({"saldos": saldos, "erros": erros}, status.HTTP_200_OK)
+
 
 class CompraViewset(mixins.CreateModelMixin, viewsets.GenericViewSet):
     queryset = models.Compra.objects.all()
     serializer_class = CompraSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    @action(detail=False, methods=['post'])
+    def lote(self, request):
+        itens = request.data
+        if not isinstance(itens, list) or not itens:
+            return Response({"erro": "É necessário enviar uma lista de compras"}, status.HTTP_400_BAD_REQUEST)
+        if len(itens) > settings.COMPRA_LOTE_TAMANHO_MAXIMO:
+            return Response({"erro": f"O lote pode ter no máximo {settings.COMPRA_LOTE_TAMANHO_MAXIMO} compras"},
+                            status.HTTP_400_BAD_REQUEST)
+
+        codigos = [item.get("codigo") for item in itens if isinstance(item, dict)]
+        codigos_existentes = set(models.Compra.objects.filter(codigo__in=codigos).values_list("codigo", flat=True))
+
+        context = self.get_serializer_context()
+        compras = []
+        indices = {}
+        erros = []
+        for indice, item in enumerate(itens):
+            serializer = CompraLoteItemSerializer(data=item, context=context)
+            if not serializer.is_valid():
+                erros.append({"indice": indice, "erros": serializer.errors})
+                continue
+            codigo = serializer.validated_data["codigo"]
+            if codigo in codigos_existentes:
+                erros.append({"indice": indice, "erros": {"codigo": [UniqueValidator.message]}})
+                continue
+            codigos_existentes.add(codigo)
+            indices[codigo] = indice
+            compras.append(models.Compra(**serializer.validated_data))
+
+        while compras:
+            try:
+                models.Compra.criar_em_lote(compras)
+                break
+            except IntegrityError:
+                # Outra requisição gravou algum dos códigos depois da verificação acima. A transação do lote é
+                # desfeita, os códigos em conflito viram erros do item e as demais compras são gravadas novamente
+                conflitos = set(models.Compra.objects.filter(codigo__in=[compra.codigo for compra in compras])
+                                .values_list("codigo", flat=True))
+                if not conflitos:
+                    raise
+                logger.warning("Conflito de códigos ao inserir lote de compras",
+                               extra={"cpf": request.user.cpf, "codigos": sorted(conflitos)})
+                erros.extend({"indice": indices[codigo], "erros": {"codigo": [UniqueValidator.message]}}
+                             for codigo in conflitos)
+                erros.sort(key=lambda erro: erro["indice"])
+                compras = [compra for compra in compras if compra.codigo not in conflitos]
+
+        if not compras:
+            return Response({"compras": [], "erros": erros}, status.HTTP_400_BAD_REQUEST)
+        logger.info("Lote de compras inserido",
+                    extra={"cpf": request.user.cpf, "inseridas": len(compras), "erros": len(erros)})
+        serializer = CompraSerializer(compras, many=True)
+        return Response({"compras": serializer.data, "erros": erros}, status.HTTP_201_CREATED)
+
 
 v1_router = routers.DefaultRouter(trailing_slash=False)
 v1_router.register('vendedor', VendedorViewset)
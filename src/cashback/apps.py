@@ -1,5 +1,12 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class CashbackConfig(AppConfig):
     name = 'cashback'
+
+    def ready(self):
+        # Valida a configuração da réplica na inicialização do worker, e não na primeira requisição
+        if settings.DATABASE_REPLICA_HABILITADA:
+            from cashback.routers import get_fixacoes
+            get_fixacoes()
@@ -0,0 +1,107 @@
+from threading import Lock
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.functional import cached_property
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from cashback.cache import MemoriaLRU
+from cashback.instrumentacao import medir
+
+CLAIM_CPF = 'cpf'
+
+
+class VendedorRefreshToken(RefreshToken):
+    """RefreshToken com o CPF do vendedor nas claims, copiadas também para o access token"""
+
+    @classmethod
+    def for_user(cls, user):
+        token = super(VendedorRefreshToken, cls).for_user(user)
+        token[CLAIM_CPF] = user.cpf
+        return token
+
+
+class VendedorToken(TokenUser):
+    """
+    Vendedor construído a partir das claims do token, sem consulta ao banco.
+    O registro completo só é carregado quando necessário (ex: verificação de permissões)
+    """
+
+    @cached_property
+    def cpf(self):
+        return self.token[CLAIM_CPF]
+
+    @cached_property
+    def vendedor(self):
+        return VendedorJWTAuthentication().get_vendedor(self.token)
+
+    def get_group_permissions(self, obj=None):
+        return self.vendedor.get_group_permissions(obj)
+
+    def get_all_permissions(self, obj=None):
+        return self.vendedor.get_all_permissions(obj)
+
+    def has_perm(self, perm, obj=None):
+        return self.vendedor.has_perm(perm, obj)
+
+    def has_perms(self, perm_list, obj=None):
+        return self.vendedor.has_perms(perm_list, obj)
+
+    def has_module_perms(self, module):
+        return self.vendedor.has_module_perms(module)
+
+
+class VendedorJWTAuthentication(JWTAuthentication):
+    """
+    Autenticação JWT sem SELECT do vendedor a cada requisição quando o token traz o CPF nas claims.
+    Tokens sem a claim (emitidos antes dela) e o carregamento sob demanda do VendedorToken consultam o banco,
+    com cache por worker de AUTENTICACAO_CACHE_TTL segundos (0 desabilita)
+    """
+
+    def authenticate(self, request):
+        with medir('auth'):
+            return super(VendedorJWTAuthentication, self).authenticate(request)
+
+    def get_user(self, validated_token):
+        if CLAIM_CPF in validated_token:
+            return VendedorToken(validated_token)
+        return self.get_vendedor(validated_token)
+
+    def get_vendedor(self, validated_token):
+        ttl = settings.AUTENTICACAO_CACHE_TTL
+        if not ttl:
+            return super(VendedorJWTAuthentication, self).get_user(validated_token)
+
+        cache = get_cache_vendedores()
+        chave = validated_token.get(api_settings.USER_ID_CLAIM)
+        vendedor = cache.get(chave)
+        if vendedor is None:
+            vendedor = super(VendedorJWTAuthentication, self).get_user(validated_token)
+            cache.set(chave, vendedor, ttl)
+        return vendedor
+
+
+_cache_vendedores = None
+_cache_vendedores_lock = Lock()
+
+
+def get_cache_vendedores():
+    """Cache de vendedores compartilhado pelas threads do worker"""
+    global _cache_vendedores
+    if _cache_vendedores is None:
+        with _cache_vendedores_lock:
+            if _cache_vendedores is None:
+                _cache_vendedores = MemoriaLRU(settings.AUTENTICACAO_CACHE_MAX_ITENS)
+    return _cache_vendedores
+
+
+@receiver(setting_changed)
+def reset_cache_vendedores(setting, **kwargs):
+    """Descarta os vendedores em cache quando a configuração é alterada (ex: nos testes)"""
+    global _cache_vendedores
+    if setting.startswith('AUTENTICACAO_'):
+        _cache_vendedores = None
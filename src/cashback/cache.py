@@ -0,0 +1,227 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from threading import Lock, Thread
+from time import time, time_ns
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger('core')
+
+
+class MemoriaLRU:
+    """Backend em memória do processo com expiração por item e descarte do item usado há mais tempo (LRU)"""
+    bloqueante = False
+
+    def __init__(self, max_itens):
+        self.max_itens = max_itens
+        self.itens = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, chave):
+        with self.lock:
+            item = self.itens.get(chave)
+            if item is None:
+                return None
+            valor, expira_em = item
+            if expira_em <= time():
+                del self.itens[chave]
+                return None
+            self.itens.move_to_end(chave)
+            return valor
+
+    def set(self, chave, valor, timeout):
+        with self.lock:
+            self.itens[chave] = (valor, time() + timeout)
+            self.itens.move_to_end(chave)
+            while len(self.itens) > self.max_itens:
+                self.itens.popitem(last=False)
+
+    def delete(self, chave):
+        with self.lock:
+            self.itens.pop(chave, None)
+
+
+class CacheDjango:
+    """Backend que utiliza um cache configurado em settings.CACHES, permitindo compartilhar o cache entre workers"""
+    # Faz I/O (arquivos, rede) e não pode ser chamado diretamente no event loop
+    bloqueante = True
+
+    def __init__(self, alias):
+        self.cache = caches[alias]
+
+    def get(self, chave):
+        return self.cache.get(chave)
+
+    def set(self, chave, valor, timeout):
+        self.cache.set(chave, valor, timeout)
+
+    def delete(self, chave):
+        self.cache.delete(chave)
+
+
+class SaldoCache:
+    """
+    Cache do saldo por CPF com TTL.
+    Depois do TTL o valor ainda pode ser servido por mais `stale` segundos enquanto é atualizado em background.
+    Com o backend em memória a invalidação vale apenas para o processo que a fez: os demais workers continuam
+    servindo o saldo anterior até o TTL expirar. Para invalidar em todos é necessário um backend compartilhado.
+    Cada invalidação muda a geração do CPF, e uma consulta iniciada em outra geração (ex: atualização em
+    background que terminou depois da compra) não é guardada, pois pode trazer o saldo anterior à compra.
+    """
+    prefixo = 'saldo:'
+    prefixo_geracao = 'saldo:geracao:'
+    # Tempo mínimo que a geração é mantida, maior que a duração de qualquer consulta ao SaldoAPI
+    duracao_geracao = 300
+
+    def __init__(self, backend, ttl, stale=0):
+        self.backend = backend
+        self.ttl = ttl
+        self.stale = stale
+        self.lock = Lock()
+        self.atualizacoes = {}
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+
+    @classmethod
+    def from_settings(cls):
+        if settings.SALDO_CACHE_BACKEND == 'memoria':
+            backend = MemoriaLRU(settings.SALDO_CACHE_MAX_ITENS)
+        else:
+            backend = CacheDjango(settings.SALDO_CACHE_BACKEND)
+        return cls(backend, settings.SALDO_CACHE_TTL, settings.SALDO_CACHE_STALE)
+
+    def chave(self, cpf):
+        return f'{self.prefixo}{cpf}'
+
+    def chave_geracao(self, cpf):
+        return f'{self.prefixo_geracao}{cpf}'
+
+    def geracao(self, cpf):
+        return self.backend.get(self.chave_geracao(cpf)) or 0
+
+    def consultar_cache(self, cpf):
+        """
+        Busca o saldo no cache e contabiliza hits/misses
+        :return: tupla (saldo, precisa_atualizar) ou None se não estiver no cache
+        """
+        item = self.backend.get(self.chave(cpf))
+        if item is None:
+            self.contabilizar('misses')
+            return None
+        valor, criado_em = item
+        if time() - criado_em < self.ttl:
+            self.contabilizar('hits')
+            return valor, False
+        self.contabilizar('stale_hits')
+        return valor, True
+
+    def contabilizar(self, contador):
+        # Os contadores são atualizados por várias threads (workers com threads e atualizações em background)
+        with self.lock:
+            setattr(self, contador, getattr(self, contador) + 1)
+
+    def guardar(self, cpf, valor, geracao):
+        """Guarda o saldo consultado na geração informada, se o CPF não foi invalidado desde então"""
+        # Falhas não são guardadas no cache
+        if valor is None or self.geracao(cpf) != geracao:
+            return
+        self.backend.set(self.chave(cpf), (valor, time()), self.ttl + self.stale)
+        # A invalidação muda a geração antes de remover o saldo, então se ela aconteceu entre a verificação
+        # acima e a gravação a geração já mudou e o saldo é removido aqui
+        if self.geracao(cpf) != geracao:
+            self.backend.delete(self.chave(cpf))
+
+    def iniciar_atualizacao(self, cpf, iniciar):
+        """Inicia a atualização em background do CPF, se já não houver uma em andamento"""
+        with self.lock:
+            if cpf in self.atualizacoes:
+                return
+            self.atualizacoes[cpf] = iniciar()
+
+    def finalizar_atualizacao(self, cpf):
+        with self.lock:
+            self.atualizacoes.pop(cpf, None)
+
+    def obter(self, cpf, consultar):
+        """
+        Retorna o saldo do cache ou da função de consulta
+        :param cpf: CPF do vendedor
+        :param consultar: função que consulta o saldo na origem, recebe o CPF
+        :return: Decimal ou None
+        """
+        if not self.ttl:
+            return consultar(cpf)
+        item = self.consultar_cache(cpf)
+        if item is None:
+            return self.atualizar(cpf, consultar)
+        valor, precisa_atualizar = item
+        if precisa_atualizar:
+            self.iniciar_atualizacao(cpf, lambda: self._iniciar_thread(cpf, consultar))
+        return valor
+
+    async def no_backend(self, funcao, *args):
+        """
+        Executa uma operação do cache a partir do event loop. Com um backend bloqueante (cache do Django) a operação
+        roda em uma thread do sync_to_async, e o backend em memória é chamado diretamente
+        """
+        if self.backend.bloqueante:
+            return await sync_to_async(funcao, thread_sensitive=False)(*args)
+        return funcao(*args)
+
+    async def obter_async(self, cpf, consultar):
+        """Versão assíncrona do obter, a função de consulta deve ser uma coroutine"""
+        if not self.ttl:
+            return await consultar(cpf)
+        item = await self.no_backend(self.consultar_cache, cpf)
+        if item is None:
+            geracao = await self.no_backend(self.geracao, cpf)
+            valor = await consultar(cpf)
+            await self.no_backend(self.guardar, cpf, valor, geracao)
+            return valor
+        valor, precisa_atualizar = item
+        if precisa_atualizar:
+            self.iniciar_atualizacao(cpf, lambda: asyncio.ensure_future(self._atualizar_async(cpf, consultar)))
+        return valor
+
+    def atualizar(self, cpf, consultar):
+        geracao = self.geracao(cpf)
+        valor = consultar(cpf)
+        self.guardar(cpf, valor, geracao)
+        return valor
+
+    def _iniciar_thread(self, cpf, consultar):
+        thread = Thread(target=self._atualizar_e_liberar, args=(cpf, consultar), daemon=True)
+        thread.start()
+        return thread
+
+    def _atualizar_e_liberar(self, cpf, consultar):
+        try:
+            self.atualizar(cpf, consultar)
+        except Exception as ex:
+            logger.exception(ex)
+        finally:
+            self.finalizar_atualizacao(cpf)
+
+    async def _atualizar_async(self, cpf, consultar):
+        try:
+            geracao = await self.no_backend(self.geracao, cpf)
+            valor = await consultar(cpf)
+            await self.no_backend(self.guardar, cpf, valor, geracao)
+        except Exception as ex:
+            logger.exception(ex)
+        finally:
+            self.finalizar_atualizacao(cpf)
+
+    def invalidar(self, cpf):
+        # Descarta as consultas em andamento (ver guardar). A geração é um valor único, e não um contador, para que
+        # continue diferente mesmo se a anterior foi descartada do cache ou gravada por outro worker
+        self.backend.set(self.chave_geracao(cpf), time_ns(), max(self.ttl + self.stale, self.duracao_geracao))
+        self.backend.delete(self.chave(cpf))
+
+    def estatisticas(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "stale": self.stale_hits}
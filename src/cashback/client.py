@@ -1,12 +1,160 @@
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextvars import ContextVar, copy_context
 from decimal import Decimal
+from threading import Lock, Event
+from time import monotonic, perf_counter
 from urllib.parse import urljoin
+from weakref import WeakKeyDictionary
+
+import httpx
 
 from django.conf import settings
-from requests import session
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from requests import session, RequestException
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from cashback.cache import SaldoCache, MemoriaLRU
+from cashback.instrumentacao import medir
+from cashback.metricas import registrar_consulta_saldo
 
 logger = logging.getLogger('core')
 
+STATUS_RETENTATIVA = (502, 503, 504)
+
+# Instante (monotonic) limite para as chamadas ao SaldoAPI da consulta em lote, que limita o timeout de cada chamada
+_prazo = ContextVar('prazo_saldo', default=None)
+
+
+class SingleFlight:
+    """
+    Agrupa chamadas concorrentes com a mesma chave: apenas a primeira executa a função,
+    as demais aguardam e recebem o mesmo resultado (ou a mesma exceção).
+    Com o worker eventlet do gunicorn o módulo threading é substituído pela versão green (monkey patch),
+    então o agrupamento também vale entre greenlets.
+    """
+
+    class Chamada:
+        def __init__(self):
+            self.evento = Event()
+            self.resultado = None
+            self.erro = None
+
+    def __init__(self):
+        self.lock = Lock()
+        self.chamadas = {}
+
+    def executar(self, chave, funcao, *args, **kwargs):
+        with self.lock:
+            chamada = self.chamadas.get(chave)
+            lider = chamada is None
+            if lider:
+                chamada = self.chamadas[chave] = self.Chamada()
+
+        if not lider:
+            chamada.evento.wait()
+            if chamada.erro:
+                raise chamada.erro
+            return chamada.resultado
+
+        try:
+            chamada.resultado = funcao(*args, **kwargs)
+        except Exception as ex:
+            chamada.erro = ex
+            raise
+        finally:
+            with self.lock:
+                del self.chamadas[chave]
+            chamada.evento.set()
+        return chamada.resultado
+
+
+class CircuitoAberto(Exception):
+    pass
+
+
+class SaldoAPIIndisponivel(Exception):
+    """Falha de comunicação, timeout ou erro 5xx do SaldoAPI. Apenas essas falhas são contabilizadas no circuito"""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker por worker para as chamadas ao SaldoAPI.
+    Fechado: as chamadas passam normalmente. Após `limite_falhas` falhas consecutivas o circuito abre.
+    Aberto: as chamadas falham imediatamente (CircuitoAberto) durante `tempo_aberto` segundos.
+    Semiaberto: depois desse tempo até `tentativas_semiaberto` chamadas de teste passam; sucesso fecha o circuito
+    e falha abre novamente.
+    Os clientes do SaldoAPI registram como falha apenas SaldoAPIIndisponivel (e exceções inesperadas): respostas 4xx
+    ou JSON inválido de um CPF mostram que o serviço está respondendo e não abrem o circuito para os demais.
+    """
+    FECHADO = 'fechado'
+    ABERTO = 'aberto'
+    SEMIABERTO = 'semiaberto'
+
+    def __init__(self, limite_falhas, tempo_aberto, tentativas_semiaberto=1, relogio=monotonic):
+        self.limite_falhas = limite_falhas
+        self.tempo_aberto = tempo_aberto
+        self.tentativas_semiaberto = tentativas_semiaberto
+        self.relogio = relogio
+        self.lock = Lock()
+        self.estado = self.FECHADO
+        self.falhas_consecutivas = 0
+        self.aberto_em = None
+        self.em_teste = 0
+        self.rejeitadas = 0
+
+    @classmethod
+    def from_settings(cls):
+        return cls(settings.SALDO_API_CIRCUITO_FALHAS, settings.SALDO_API_CIRCUITO_TEMPO_ABERTO,
+                   settings.SALDO_API_CIRCUITO_TENTATIVAS_SEMIABERTO)
+
+    def permitir(self):
+        with self.lock:
+            if self.estado == self.ABERTO and self.relogio() - self.aberto_em >= self.tempo_aberto:
+                self.estado = self.SEMIABERTO
+                self.em_teste = 0
+            if self.estado == self.FECHADO:
+                return True
+            if self.estado == self.SEMIABERTO and self.em_teste < self.tentativas_semiaberto:
+                self.em_teste += 1
+                return True
+            self.rejeitadas += 1
+            return False
+
+    def registrar_sucesso(self):
+        with self.lock:
+            if self.estado != self.FECHADO:
+                logger.info("Circuito do SaldoAPI fechado")
+            self.estado = self.FECHADO
+            self.falhas_consecutivas = 0
+            self.em_teste = 0
+
+    def registrar_falha(self):
+        with self.lock:
+            self.falhas_consecutivas += 1
+            if self.estado == self.SEMIABERTO or self.falhas_consecutivas >= self.limite_falhas:
+                if self.estado != self.ABERTO:
+                    logger.error("Circuito do SaldoAPI aberto", extra={"falhas": self.falhas_consecutivas})
+                self.estado = self.ABERTO
+                self.aberto_em = self.relogio()
+                self.em_teste = 0
+
+    def verificar(self):
+        if not self.permitir():
+            raise CircuitoAberto()
+
+    def inspecionar(self):
+        with self.lock:
+            return {
+                "estado": self.estado,
+                "falhas_consecutivas": self.falhas_consecutivas,
+                "aberto_ha": self.relogio() - self.aberto_em if self.estado != self.FECHADO else None,
+                "rejeitadas": self.rejeitadas,
+            }
+
 
 class SaldoAPI:
 
@@ -16,23 +164,114 @@ class SaldoAPI:
         self.session.headers = {
             "token": settings.SALDO_API_TOKEN,
         }
+        self.timeout = (settings.SALDO_API_TIMEOUT_CONEXAO, settings.SALDO_API_TIMEOUT_LEITURA)
+        # Retentativas apenas para GET (idempotente), com backoff exponencial.
+        # Timeout de leitura não é repetido para que o tempo máximo de espera continue limitado
+        retry = Retry(
+            total=settings.SALDO_API_RETENTATIVAS,
+            read=0,
+            backoff_factor=settings.SALDO_API_BACKOFF,
+            status_forcelist=STATUS_RETENTATIVA,
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.SALDO_API_POOL_SIZE,
+                              max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.cache = SaldoCache.from_settings()
+        self.single_flight = SingleFlight()
+        self.circuito = CircuitBreaker.from_settings()
+        # Último saldo conhecido por CPF, retornado enquanto o circuito estiver aberto
+        self.ultimos_saldos = MemoriaLRU(settings.SALDO_CACHE_MAX_ITENS)
 
     def get_saldo(self, cpf):
+        return self.cache.obter(cpf, self.consultar_saldo_agrupado)
+
+    def consultar_saldo_agrupado(self, cpf):
+        """Consultas simultâneas do mesmo CPF compartilham uma única chamada ao SaldoAPI"""
+        return self.single_flight.executar(cpf, self.consultar_saldo_protegido, cpf)
+
+    def consultar_saldo_protegido(self, cpf):
+        try:
+            self.circuito.verificar()
+        except CircuitoAberto:
+            return self.ultimo_saldo(cpf)
+        try:
+            saldo = self.consultar_saldo(cpf)
+        except SaldoAPIIndisponivel:
+            self.circuito.registrar_falha()
+            return None
+        except Exception:
+            self.circuito.registrar_falha()
+            raise
+        self.circuito.registrar_sucesso()
+        self.guardar_ultimo_saldo(cpf, saldo)
+        return saldo
+
+    def ultimo_saldo(self, cpf):
+        if not settings.SALDO_API_CIRCUITO_ULTIMO_SALDO:
+            return None
+        return self.ultimos_saldos.get(cpf)
+
+    def guardar_ultimo_saldo(self, cpf, saldo):
+        if saldo is not None and settings.SALDO_API_CIRCUITO_ULTIMO_SALDO:
+            self.ultimos_saldos.set(cpf, saldo, settings.SALDO_API_CIRCUITO_ULTIMO_SALDO_TTL)
+
+    def invalidar_saldo(self, cpf):
+        self.cache.invalidar(cpf)
+
+    def consultar_saldo(self, cpf):
+        inicio = perf_counter()
+        resultado = 'excecao'
+        try:
+            saldo = self.requisitar_saldo(cpf)
+            resultado = 'sucesso' if saldo is not None else 'erro'
+            return saldo
+        except SaldoAPIIndisponivel:
+            resultado = 'indisponivel'
+            raise
+        finally:
+            registrar_consulta_saldo(resultado, perf_counter() - inicio)
+
+    def timeout_no_prazo(self):
+        """Timeouts de conexão e leitura limitados ao tempo restante do prazo da consulta em lote, se houver"""
+        limite = _prazo.get()
+        if limite is None:
+            return self.timeout
+        restante = max(limite - monotonic(), 0.001)
+        return tuple(min(timeout, restante) for timeout in self.timeout)
+
+    def requisitar_saldo(self, cpf):
         url = urljoin(self.base_url, f'/v1/cashback?cpf={cpf}')
-        response = self.session.get(url)
-        logger.debug("Consulta ao SaldoAPI", extra={
-            "method": response.request.method,
-            "url": response.request.url,
-            "status": response.status_code,
-            "body": response.content if response.status_code >= 400 else "-",
-            "duration": response.elapsed.total_seconds()
-        })
+        try:
+            with medir('saldo_api'):
+                response = self.session.get(url, timeout=self.timeout_no_prazo())
+        except RequestException as ex:
+            logger.error("Falha na comunicação com o SaldoAPI", extra={
+                "erro": str(ex)
+            })
+            raise SaldoAPIIndisponivel(str(ex)) from ex
+        # O extra (com o corpo da resposta) só é montado se o nível DEBUG estiver habilitado
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Consulta ao SaldoAPI", extra={
+                "method": response.request.method,
+                "url": response.request.url,
+                "status": response.status_code,
+                "body": response.content if response.status_code >= 400 else "-",
+                "duration": response.elapsed.total_seconds()
+            })
         if not response.ok:
             logger.error("Resposta inválida do SaldoAPI", extra={
                 "status": response.status_code
             })
+            if response.status_code >= 500:
+                raise SaldoAPIIndisponivel(f"status {response.status_code}")
             return None
-        data = response.json()
+        return self.extrair_saldo(response.json())
+
+    @staticmethod
+    def extrair_saldo(data):
         data_status_code = data.get("statusCode")
         if data_status_code != 200:
             logger.error("SaldoAPI retornou um JSON inválido", extra={
@@ -41,3 +280,227 @@ class SaldoAPI:
             return None
         credit = data["body"]["credit"]
         return Decimal(credit / 100)
+
+
+class SingleFlightAsync:
+    """Versão do SingleFlight para coroutines executadas no mesmo event loop"""
+
+    def __init__(self):
+        self.chamadas = {}
+
+    async def executar(self, chave, funcao, *args, **kwargs):
+        futuro = self.chamadas.get(chave)
+        if futuro is None:
+            futuro = asyncio.ensure_future(funcao(*args, **kwargs))
+            self.chamadas[chave] = futuro
+            futuro.add_done_callback(lambda _: self.chamadas.pop(chave, None))
+        # O shield evita que o cancelamento de um dos chamadores cancele a consulta dos demais
+        return await asyncio.shield(futuro)
+
+
+class SaldoAPIAsync:
+    """
+    Cliente assíncrono do SaldoAPI (httpx), utilizado pelas views do modo ASGI.
+    Usa as mesmas configurações de pool, timeouts e retentativas do SaldoAPI e compartilha o seu cache e circuit breaker.
+    """
+
+    def __init__(self, saldo_api):
+        self.saldo_api = saldo_api
+        self.base_url = settings.SALDO_API
+        self.client = httpx.AsyncClient(
+            headers={"token": settings.SALDO_API_TOKEN},
+            timeout=httpx.Timeout(settings.SALDO_API_TIMEOUT_LEITURA, connect=settings.SALDO_API_TIMEOUT_CONEXAO),
+            limits=httpx.Limits(max_connections=settings.SALDO_API_POOL_SIZE,
+                                max_keepalive_connections=settings.SALDO_API_POOL_SIZE),
+        )
+        self.cache = saldo_api.cache
+        self.circuito = saldo_api.circuito
+        self.single_flight = SingleFlightAsync()
+
+    async def get_saldo(self, cpf):
+        return await self.cache.obter_async(cpf, self.consultar_saldo_agrupado)
+
+    async def consultar_saldo_agrupado(self, cpf):
+        return await self.single_flight.executar(cpf, self.consultar_saldo_protegido, cpf)
+
+    async def consultar_saldo_protegido(self, cpf):
+        try:
+            self.circuito.verificar()
+        except CircuitoAberto:
+            return self.saldo_api.ultimo_saldo(cpf)
+        try:
+            saldo = await self.consultar_saldo(cpf)
+        except SaldoAPIIndisponivel:
+            self.circuito.registrar_falha()
+            return None
+        except Exception:
+            self.circuito.registrar_falha()
+            raise
+        self.circuito.registrar_sucesso()
+        self.saldo_api.guardar_ultimo_saldo(cpf, saldo)
+        return saldo
+
+    async def consultar_saldo(self, cpf):
+        inicio = perf_counter()
+        resultado = 'excecao'
+        try:
+            saldo = await self.requisitar_saldo(cpf)
+            resultado = 'sucesso' if saldo is not None else 'erro'
+            return saldo
+        except SaldoAPIIndisponivel:
+            resultado = 'indisponivel'
+            raise
+        finally:
+            registrar_consulta_saldo(resultado, perf_counter() - inicio)
+
+    async def requisitar_saldo(self, cpf):
+        url = urljoin(self.base_url, f'/v1/cashback?cpf={cpf}')
+        retentativas = settings.SALDO_API_RETENTATIVAS
+        for tentativa in range(retentativas + 1):
+            ultima_tentativa = tentativa == retentativas
+            try:
+                with medir('saldo_api'):
+                    response = await self.client.get(url)
+            except httpx.ConnectError as ex:
+                if not ultima_tentativa:
+                    await asyncio.sleep(settings.SALDO_API_BACKOFF * (2 ** tentativa))
+                    continue
+                logger.error("Falha na comunicação com o SaldoAPI", extra={"erro": str(ex)})
+                raise SaldoAPIIndisponivel(str(ex)) from ex
+            except httpx.HTTPError as ex:
+                # Timeout de leitura não é repetido, como no cliente síncrono
+                logger.error("Falha na comunicação com o SaldoAPI", extra={"erro": str(ex)})
+                raise SaldoAPIIndisponivel(str(ex)) from ex
+            if response.status_code in STATUS_RETENTATIVA and not ultima_tentativa:
+                await asyncio.sleep(settings.SALDO_API_BACKOFF * (2 ** tentativa))
+                continue
+            break
+        # O extra (com o corpo da resposta) só é montado se o nível DEBUG estiver habilitado
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Consulta ao SaldoAPI", extra={
+                "method": response.request.method,
+                "url": str(response.request.url),
+                "status": response.status_code,
+                "body": response.content if response.status_code >= 400 else "-",
+                "duration": response.elapsed.total_seconds()
+            })
+        if response.status_code >= 400:
+            logger.error("Resposta inválida do SaldoAPI", extra={
+                "status": response.status_code
+            })
+            if response.status_code >= 500:
+                raise SaldoAPIIndisponivel(f"status {response.status_code}")
+            return None
+        return SaldoAPI.extrair_saldo(response.json())
+
+
+_saldo_api = None
+_saldo_api_lock = Lock()
+_saldos_executor = None
+_saldo_api_async = WeakKeyDictionary()
+
+
+def get_saldo_api():
+    """
+    Retorna o cliente do SaldoAPI compartilhado pelo processo, reaproveitando as conexões entre requisições
+    :return: SaldoAPI
+    """
+    global _saldo_api
+    if _saldo_api is None:
+        with _saldo_api_lock:
+            if _saldo_api is None:
+                _saldo_api = SaldoAPI()
+    return _saldo_api
+
+
+def get_saldo_api_async():
+    """
+    Retorna o cliente assíncrono do SaldoAPI do event loop atual (as conexões do httpx pertencem ao loop)
+    :return: SaldoAPIAsync
+    """
+    loop = asyncio.get_event_loop()
+    cliente = _saldo_api_async.get(loop)
+    if cliente is None:
+        cliente = _saldo_api_async[loop] = SaldoAPIAsync(get_saldo_api())
+    return cliente
+
+
+def get_saldos_executor():
+    global _saldos_executor
+    if _saldos_executor is None:
+        with _saldo_api_lock:
+            if _saldos_executor is None:
+                _saldos_executor = ThreadPoolExecutor(max_workers=settings.SALDO_LOTE_CONCORRENCIA,
+                                                      thread_name_prefix='saldos')
+    return _saldos_executor
+
+
+def consultar_saldo_no_prazo(saldo_api, cpf, limite):
+    """Consulta executada no pool do lote, com o timeout HTTP limitado ao prazo para não reter a thread depois dele"""
+    if monotonic() >= limite:
+        raise TimeoutError()
+    token = _prazo.set(limite)
+    try:
+        saldo = saldo_api.get_saldo(cpf)
+    finally:
+        _prazo.reset(token)
+    if saldo is None and monotonic() >= limite:
+        raise TimeoutError()
+    return saldo
+
+
+def consultar_saldos(cpfs, prazo):
+    """
+    Consulta o saldo de vários CPFs em paralelo (limitado por SALDO_LOTE_CONCORRENCIA), respeitando um prazo
+    para o lote inteiro. O tempo total fica próximo da consulta mais lenta, e não da soma de todas.
+    Cada chamada ao SaldoAPI usa o tempo restante do prazo como timeout, então as consultas abandonadas no fim do
+    prazo liberam as threads do pool em seguida, sem atrasar os próximos lotes do worker.
+    :param cpfs: lista de CPFs
+    :param prazo: tempo máximo em segundos
+    :return: tupla (saldos, erros), dicts por CPF
+    """
+    saldo_api = get_saldo_api()
+    executor = get_saldos_executor()
+    limite = monotonic() + prazo
+    # Cada consulta roda em uma cópia do contexto da requisição, para que a fase saldo_api seja medida
+    futures = {executor.submit(copy_context().run, consultar_saldo_no_prazo, saldo_api, cpf, limite): cpf
+               for cpf in cpfs}
+    concluidas, pendentes = wait(futures, timeout=prazo)
+
+    saldos = {}
+    erros = {}
+    for future in pendentes:
+        future.cancel()  # Se ainda não começou não chega a chamar o SaldoAPI
+        erros[futures[future]] = "Tempo esgotado ao consultar o saldo"
+    for future in concluidas:
+        cpf = futures[future]
+        try:
+            saldo = future.result()
+        except TimeoutError:
+            erros[cpf] = "Tempo esgotado ao consultar o saldo"
+            continue
+        except Exception as ex:
+            logger.exception(ex)
+            saldo = None
+        if saldo is None:
+            erros[cpf] = "Não foi possível obter o saldo"
+        else:
+            saldos[cpf] = saldo
+    return saldos, erros
+
+
+def invalidar_saldo(cpf):
+    """Remove o saldo do CPF do cache, para que a próxima consulta vá ao SaldoAPI"""
+    get_saldo_api().invalidar_saldo(cpf)
+
+
+@receiver(setting_changed)
+def reset_saldo_api(setting, **kwargs):
+    """Descarta o cliente compartilhado quando alguma configuração do SaldoAPI é alterada (ex: nos testes)"""
+    global _saldo_api, _saldos_executor
+    if setting.startswith('SALDO_'):
+        with _saldo_api_lock:
+            _saldo_api = None
+            _saldo_api_async.clear()
+            if setting == 'SALDO_LOTE_CONCORRENCIA':
+                _saldos_executor = None
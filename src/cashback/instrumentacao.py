@@ -0,0 +1,178 @@
+"""
+Tempo das requisições por fase (autenticação, recálculo do cashback, SaldoAPI e serialização) e das consultas SQL.
+
+O TempoRequisicaoMiddleware abre uma Medicao por requisição em uma context var, as fases são somadas com
+medir(fase) e as consultas por um execute_wrapper fixo nas conexões. Ao final a medição é enviada no header
+Server-Timing e em uma linha de log estruturado com o request_id.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from log_request_id import local
+
+from cashback.metricas import registrar_requisicao
+
+logger = logging.getLogger('core')
+
+_medicao = ContextVar('medicao', default=None)
+
+
+class Medicao:
+    """
+    Tempos acumulados (em segundos) das fases e das consultas SQL de uma requisição.
+    As fases executadas em paralelo (ex: consultas ao SaldoAPI em lote, em threads com o contexto da requisição)
+    são somadas, então podem ultrapassar a duração total
+    """
+
+    def __init__(self):
+        self.inicio = perf_counter()
+        self.fases = defaultdict(float)
+        self.consultas = 0
+        self.inicio_serializacao = None
+        self.lock = Lock()
+
+    def somar(self, fase, duracao, consultas=0):
+        with self.lock:
+            self.fases[fase] += duracao
+            self.consultas += consultas
+
+    def duracao(self):
+        return perf_counter() - self.inicio
+
+    def server_timing(self, duracao):
+        """Valor do header Server-Timing, com as durações em milissegundos"""
+        metricas = [f'{fase};dur={tempo * 1000:.2f}' for fase, tempo in self.fases.items() if fase != 'db']
+        metricas.append(f'db;dur={self.fases["db"] * 1000:.2f};desc="{self.consultas} consultas"')
+        metricas.append(f'total;dur={duracao * 1000:.2f}')
+        return ', '.join(metricas)
+
+
+def medicao_atual():
+    return _medicao.get()
+
+
+@contextmanager
+def medir(fase):
+    """Soma a duração do bloco à fase da requisição corrente (fora de uma requisição não mede nada)"""
+    medicao = _medicao.get()
+    if medicao is None:
+        yield
+        return
+    inicio = perf_counter()
+    try:
+        yield
+    finally:
+        medicao.somar(fase, perf_counter() - inicio)
+
+
+def contabilizar_sql(execute, sql, params, many, context):
+    medicao = _medicao.get()
+    if medicao is None:
+        return execute(sql, params, many, context)
+    inicio = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        medicao.somar('db', perf_counter() - inicio, consultas=1)
+
+
+def instrumentar_conexao(connection):
+    if contabilizar_sql not in connection.execute_wrappers:
+        connection.execute_wrappers.append(contabilizar_sql)
+
+
+@receiver(connection_created)
+def instrumentar_nova_conexao(sender, connection, **kwargs):
+    # Conexões abertas em outras threads (ex: sync_to_async nas views assíncronas)
+    instrumentar_conexao(connection)
+
+
+class TempoRequisicaoMiddleware:
+    """
+    Mede a requisição e envia o resultado no header Server-Timing (TEMPO_REQUISICAO_SERVER_TIMING) e em uma linha
+    de log com o request_id (TEMPO_REQUISICAO), além de registrar as métricas da rota (METRICAS).
+    Deve ficar logo após o RequestIDMiddleware. Desabilitado se ambos forem False
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.TEMPO_REQUISICAO and not settings.METRICAS:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.assincrono = asyncio.iscoroutinefunction(get_response)
+        if self.assincrono:
+            # Sinaliza ao Django que o middleware é uma coroutine, como no MiddlewareMixin
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.assincrono:
+            return self.__acall__(request)
+        medicao = self.iniciar()
+        token = _medicao.set(medicao)
+        try:
+            response = self.get_response(request)
+        finally:
+            _medicao.reset(token)
+        return self.finalizar(request, response, medicao)
+
+    async def __acall__(self, request):
+        medicao = self.iniciar()
+        token = _medicao.set(medicao)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _medicao.reset(token)
+        return self.finalizar(request, response, medicao)
+
+    def iniciar(self):
+        for connection in connections.all():
+            instrumentar_conexao(connection)
+        return Medicao()
+
+    def process_template_response(self, request, response):
+        # Chamado entre o retorno da view e a renderização da Response do DRF
+        medicao = _medicao.get()
+        if medicao is not None:
+            medicao.inicio_serializacao = perf_counter()
+        return response
+
+    def finalizar(self, request, response, medicao):
+        if medicao.inicio_serializacao is not None:
+            medicao.somar('serializacao', perf_counter() - medicao.inicio_serializacao)
+        duracao = medicao.duracao()
+        if settings.METRICAS:
+            registrar_requisicao(request, response, duracao, medicao.consultas, medicao.fases.get('db', 0.0))
+        if not settings.TEMPO_REQUISICAO:
+            return response
+        if settings.TEMPO_REQUISICAO_SERVER_TIMING:
+            response['Server-Timing'] = medicao.server_timing(duracao)
+
+        # O request_id da thread pode ser de outra requisição nas views assíncronas (event loop)
+        anterior = getattr(local, 'request_id', None)
+        local.request_id = getattr(request, 'id', anterior)
+        try:
+            logger.info("Requisição finalizada", extra={
+                "method": request.method,
+                "path": request.path,
+                "status": response.status_code,
+                "duration": round(duracao * 1000, 2),
+                "queries": medicao.consultas,
+                "fases": {fase: round(tempo * 1000, 2) for fase, tempo in medicao.fases.items()},
+            })
+        finally:
+            if anterior is None:
+                del local.request_id
+            else:
+                local.request_id = anterior
+        return response
@@ -0,0 +1,204 @@
+import csv
+import json
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, time
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from time import perf_counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.dateparse import parse_datetime, parse_date
+from django.utils.timezone import is_naive, make_aware, localdate
+
+from cashback.client import invalidar_saldo
+from cashback.models import Compra, Vendedor, VendasDiarias
+from cashback.routers import registrar_escrita
+from cashback.utils import validar_cpfs
+
+logger = logging.getLogger('core')
+
+
+class LinhaInvalida(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Importa o histórico de compras de um arquivo CSV ou NDJSON (mesmas colunas da exportação) em lotes, '
+            'com bulk_create e recálculo do percentual de cashback uma única vez por vendedor no final')
+
+    formatos = ('csv', 'ndjson')
+    status_validos = {codigo: codigo for codigo, _ in Compra.STATUS_CHOICES}
+    status_validos.update({nome: codigo for codigo, nome in Compra.STATUS_CHOICES})
+
+    def add_arguments(self, parser):
+        parser.add_argument('arquivo', help='Caminho do arquivo a ser importado')
+        parser.add_argument('--formato', choices=self.formatos,
+                            help='Formato do arquivo. Por padrão é obtido da extensão')
+        parser.add_argument('--lote', type=int, default=5000, help='Quantidade de linhas por lote')
+
+    def handle(self, *args, **options):
+        formato = options['formato'] or os.path.splitext(options['arquivo'])[1].lstrip('.').lower()
+        if formato not in self.formatos:
+            raise CommandError(f"Formato não suportado: '{formato}'. Utilize --formato {' ou '.join(self.formatos)}")
+        if options['lote'] < 1:
+            raise CommandError("O tamanho do lote deve ser maior que zero")
+
+        self.verbosity = options['verbosity']
+        # Índice em memória dos códigos já gravados, acrescido dos importados, para descartar duplicados sem consultas
+        self.codigos = set(Compra.objects.values_list('codigo', flat=True).iterator())
+        # CPF -> id do vendedor (ou None se não existir), consultando apenas os CPFs ainda não vistos
+        self.vendedores = {}
+        self.contadores = dict.fromkeys(['lidas', 'inseridas', 'duplicadas', 'invalidas'], 0)
+        afetados = {}
+
+        inicio = perf_counter()
+        try:
+            with open(options['arquivo'], encoding='utf-8', newline='') as arquivo:
+                linhas = getattr(self, f'ler_{formato}')(arquivo)
+                numero = 0
+                while True:
+                    lote = list(islice(linhas, options['lote']))
+                    if not lote:
+                        break
+                    numero += 1
+                    compras = self.importar_lote(lote)
+                    afetados.update({compra.vendedor_id: cpf for compra, cpf in compras})
+                    self.stdout.write(self.progresso(f"Lote {numero}", inicio))
+        finally:
+            # Os lotes já gravados ficam consistentes mesmo se a importação for interrompida por um erro
+            self.recalcular(afetados)
+
+        duracao = perf_counter() - inicio
+        logger.info("Importação de compras finalizada", extra={
+            **self.contadores,
+            "vendedores": len(afetados),
+            "duracao": duracao,
+        })
+        self.stdout.write(self.style.SUCCESS(self.progresso("Importação finalizada", inicio)))
+
+    @staticmethod
+    def recalcular(afetados):
+        """Faixas de cashback recalculadas uma única vez por vendedor, com todo o histórico já gravado"""
+        for vendedor_id, cpf in afetados.items():
+            with transaction.atomic():
+                Compra.atualizar_percentual_cashback(vendedor_id)
+            invalidar_saldo(cpf)
+            registrar_escrita(vendedor_id)
+
+    def progresso(self, titulo, inicio):
+        duracao = perf_counter() - inicio
+        taxa = self.contadores['lidas'] / duracao if duracao else 0
+        return (f"{titulo}: {self.contadores['lidas']} linhas lidas, {self.contadores['inseridas']} inseridas, "
+                f"{self.contadores['duplicadas']} duplicadas, {self.contadores['invalidas']} inválidas "
+                f"({taxa:.0f} linhas/s)")
+
+    def ler_csv(self, arquivo):
+        leitor = csv.DictReader(arquivo)
+        for registro in leitor:
+            yield leitor.line_num, registro
+
+    def ler_ndjson(self, arquivo):
+        for numero, texto in enumerate(arquivo, start=1):
+            if not texto.strip():
+                continue
+            try:
+                registro = json.loads(texto)
+            except ValueError:
+                registro = None
+            yield numero, registro if isinstance(registro, dict) else None
+
+    def importar_lote(self, lote):
+        """
+        Valida e insere um lote de linhas com uma consulta de vendedores, um bulk_create das compras e o livro de
+        vendas diárias atualizado em lote
+        :param lote: lista de (número da linha, registro)
+        :return: lista de (Compra, cpf) inseridas
+        """
+        self.contadores['lidas'] += len(lote)
+        validos = [(numero, registro) for numero, registro in lote if registro is not None]
+        for numero, registro in lote:
+            if registro is None:
+                self.invalida(numero, "registro mal formado")
+
+        cpfs = validar_cpfs([registro.get('cpf') or '' for _, registro in validos])
+        novos = {cpf for cpf in cpfs if cpf is not None and cpf not in self.vendedores}
+        if novos:
+            self.vendedores.update(dict.fromkeys(novos))
+            self.vendedores.update(Vendedor.objects.filter(cpf__in=novos).values_list('cpf', 'id'))
+
+        compras = []
+        totais = defaultdict(Decimal)
+        for (numero, registro), cpf in zip(validos, cpfs):
+            try:
+                compra = self.criar_compra(registro, cpf)
+            except LinhaInvalida as ex:
+                self.invalida(numero, str(ex))
+                continue
+            if compra.codigo in self.codigos:
+                self.contadores['duplicadas'] += 1
+                continue
+            self.codigos.add(compra.codigo)
+            compras.append((compra, cpf))
+            totais[(compra.vendedor_id, localdate(compra.data))] += compra.valor
+
+        with transaction.atomic():
+            Compra.objects.bulk_create([compra for compra, _ in compras])
+            VendasDiarias.registrar_em_lote(totais)
+        self.contadores['inseridas'] += len(compras)
+        return compras
+
+    def criar_compra(self, registro, cpf):
+        """Compra ainda não salva com o percentual do próprio valor (o da faixa do vendedor é aplicado no final)"""
+        if cpf is None:
+            raise LinhaInvalida("CPF inválido")
+        vendedor_id = self.vendedores.get(cpf)
+        if vendedor_id is None:
+            raise LinhaInvalida(f"vendedor não encontrado para o CPF {cpf}")
+
+        codigo = str(registro.get('codigo') or '').strip()
+        if not codigo or len(codigo) > Compra._meta.get_field('codigo').max_length:
+            raise LinhaInvalida("código inválido")
+
+        try:
+            valor = Decimal(str(registro.get('valor')).strip())
+        except InvalidOperation:
+            raise LinhaInvalida("valor inválido")
+        if not valor.is_finite() or valor <= 0 or valor != valor.quantize(Decimal('0.01')) or valor >= 10 ** 6:
+            raise LinhaInvalida("valor inválido")
+
+        data = self.converter_data(str(registro.get('data') or '').strip())
+        if data is None:
+            raise LinhaInvalida("data inválida")
+
+        status = registro.get('status') or Compra.status_inicial_do_cpf(cpf)
+        if status not in self.status_validos:
+            raise LinhaInvalida("status inválido")
+
+        compra = Compra(codigo=codigo, valor=valor, data=data, vendedor_id=vendedor_id,
+                        status=self.status_validos[status])
+        compra.percentual_cashback = Compra.get_percentual_cashback(valor)
+        compra.valor_cashback = compra.calcular_valor_cashback()
+        return compra
+
+    @staticmethod
+    def converter_data(texto):
+        """Aceita datetime ISO 8601 (sem fuso é considerado o fuso corrente) ou apenas a data (início do dia)"""
+        try:
+            data = parse_datetime(texto)
+            if data is None:
+                dia = parse_date(texto)
+                data = datetime.combine(dia, time.min) if dia else None
+        except ValueError:
+            return None
+        if data is not None and is_naive(data):
+            # is_dst=False resolve os horários inexistentes ou ambíguos do horário de verão (ex: meia-noite de 04/11/2018)
+            data = make_aware(data, is_dst=False)
+        return data
+
+    def invalida(self, numero, motivo):
+        self.contadores['invalidas'] += 1
+        if self.verbosity > 1:
+            self.stderr.write(f"Linha {numero} ignorada: {motivo}")
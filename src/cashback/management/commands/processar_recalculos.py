@@ -0,0 +1,33 @@
+import logging
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from cashback.models import RecalculoPendente
+
+logger = logging.getLogger('core')
+
+
+class Command(BaseCommand):
+    help = 'Processa os recálculos de percentual de cashback pendentes (CASHBACK_RECALCULO_ASSINCRONO)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lote', type=int, default=500, help='Quantidade máxima de eventos por lote')
+        parser.add_argument('--intervalo', type=float, default=1,
+                            help='Segundos de espera quando não há eventos pendentes')
+        parser.add_argument('--uma-vez', action='store_true', help='Processa os pendentes e finaliza')
+
+    def handle(self, *args, **options):
+        while True:
+            atraso = RecalculoPendente.atraso()
+            eventos, vendedores = RecalculoPendente.processar(options['lote'])
+            if eventos:
+                logger.info("Recálculos de cashback processados", extra={
+                    "eventos": eventos,
+                    "vendedores": vendedores,
+                    "atraso": atraso.total_seconds(),
+                })
+                continue
+            if options['uma_vez']:
+                return
+            sleep(options['intervalo'])
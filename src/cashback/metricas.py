@@ -0,0 +1,325 @@
+"""
+Métricas da aplicação (contadores e histogramas) no formato texto do Prometheus.
+
+Com METRICAS_DIRETORIO cada worker grava os valores em um arquivo próprio mapeado em memória (mmap) nesse diretório,
+e a exportação soma os arquivos de todos os workers. Sem o diretório os valores ficam apenas na memória do processo.
+"""
+import glob
+import json
+import mmap
+import os
+import struct
+from contextlib import contextmanager
+from functools import lru_cache
+from threading import Lock
+from time import perf_counter
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+BUCKETS_DURACAO = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Definições registradas, na ordem de exportação
+METRICAS = []
+
+
+@lru_cache(maxsize=4096)
+def chave(nome, labels):
+    """Chave de uma amostra, a partir da tupla ordenada de (label, valor)"""
+    return json.dumps([nome, dict(labels)], separators=(',', ':'))
+
+
+class Metrica:
+    tipo = None
+
+    def __init__(self, nome, ajuda, labels=()):
+        self.nome = nome
+        self.ajuda = ajuda
+        self.labels = tuple(labels)
+        METRICAS.append(self)
+
+    def validar_labels(self, labels):
+        if len(labels) != len(self.labels) or any(nome not in labels for nome in self.labels):
+            raise ValueError(f"A métrica {self.nome} exige os labels {', '.join(self.labels)}")
+        return tuple(sorted((nome, str(valor)) for nome, valor in labels.items()))
+
+
+class Contador(Metrica):
+    tipo = 'counter'
+
+    def incrementar(self, valor=1, **labels):
+        if settings.METRICAS:
+            get_armazenamento().incrementar(chave(self.nome, self.validar_labels(labels)), valor)
+
+
+class Histograma(Metrica):
+    tipo = 'histogram'
+
+    def __init__(self, nome, ajuda, labels=(), buckets=BUCKETS_DURACAO):
+        super(Histograma, self).__init__(nome, ajuda, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observar(self, valor, **labels):
+        if not settings.METRICAS:
+            return
+        labels = self.validar_labels(labels)
+        armazenamento = get_armazenamento()
+        # Cada bucket guarda apenas as próprias observações, os valores acumulados são calculados na exportação
+        for limite in self.buckets:
+            if valor <= limite:
+                armazenamento.incrementar(chave(f'{self.nome}_bucket', labels + (('le', formatar(limite)),)), 1)
+                break
+        armazenamento.incrementar(chave(f'{self.nome}_sum', labels), valor)
+        armazenamento.incrementar(chave(f'{self.nome}_count', labels), 1)
+
+    @contextmanager
+    def cronometrar(self, **labels):
+        inicio = perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(perf_counter() - inicio, **labels)
+
+
+class ArmazenamentoMemoria:
+    """Valores do processo corrente"""
+
+    def __init__(self):
+        self.valores = {}
+        self.lock = Lock()
+
+    def incrementar(self, chave, valor):
+        with self.lock:
+            self.valores[chave] = self.valores.get(chave, 0.0) + valor
+
+    def coletar(self):
+        with self.lock:
+            return dict(self.valores)
+
+
+class ArquivoMmap:
+    """
+    Dicionário de chave -> float em um arquivo mapeado em memória, escrito apenas pelo processo dono.
+    Layout: inteiro com os bytes utilizados, seguido das entradas (tamanho da chave, chave alinhada em 8 bytes, valor)
+    """
+    tamanho_inicial = 1 << 20
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self.arquivo = open(caminho, 'a+b')
+        tamanho = os.fstat(self.arquivo.fileno()).st_size
+        if tamanho == 0:
+            self.arquivo.truncate(self.tamanho_inicial)
+            tamanho = self.tamanho_inicial
+        self.mapear(tamanho)
+        self.usado = struct.unpack_from('i', self.mapa, 0)[0]
+        if not self.usado:
+            self.usado = 8
+            struct.pack_into('i', self.mapa, 0, self.usado)
+        self.posicoes = {chave: posicao for chave, _, posicao in self.entradas(self.mapa, self.usado)}
+
+    def mapear(self, tamanho):
+        self.tamanho = tamanho
+        self.mapa = mmap.mmap(self.arquivo.fileno(), tamanho)
+
+    @staticmethod
+    def entradas(dados, usado):
+        posicao = 8
+        while posicao < usado:
+            tamanho_chave = struct.unpack_from('i', dados, posicao)[0]
+            inicio_chave = posicao + 4
+            posicao_valor = inicio_chave + tamanho_chave + (8 - (4 + tamanho_chave) % 8) % 8
+            chave = bytes(dados[inicio_chave:inicio_chave + tamanho_chave]).decode()
+            yield chave, struct.unpack_from('d', dados, posicao_valor)[0], posicao_valor
+            posicao = posicao_valor + 8
+
+    @classmethod
+    def ler(cls, caminho):
+        with open(caminho, 'rb') as arquivo:
+            dados = arquivo.read()
+        if len(dados) < 8:
+            return []
+        return [(chave, valor) for chave, valor, _ in cls.entradas(dados, struct.unpack_from('i', dados, 0)[0])]
+
+    def criar(self, chave):
+        codificada = chave.encode()
+        alinhamento = (8 - (4 + len(codificada)) % 8) % 8
+        tamanho_entrada = 4 + len(codificada) + alinhamento + 8
+        if self.usado + tamanho_entrada > self.tamanho:
+            tamanho = self.tamanho
+            while self.usado + tamanho_entrada > tamanho:
+                tamanho *= 2
+            self.mapa.close()
+            self.arquivo.truncate(tamanho)
+            self.mapear(tamanho)
+        struct.pack_into(f'i{len(codificada)}s', self.mapa, self.usado, len(codificada), codificada)
+        posicao = self.usado + 4 + len(codificada) + alinhamento
+        struct.pack_into('d', self.mapa, posicao, 0.0)
+        # Os bytes utilizados são atualizados por último, então a leitura nunca vê uma entrada incompleta
+        self.usado += tamanho_entrada
+        struct.pack_into('i', self.mapa, 0, self.usado)
+        self.posicoes[chave] = posicao
+        return posicao
+
+    def incrementar(self, chave, valor):
+        posicao = self.posicoes.get(chave)
+        if posicao is None:
+            posicao = self.criar(chave)
+        struct.pack_into('d', self.mapa, posicao, struct.unpack_from('d', self.mapa, posicao)[0] + valor)
+
+    def fechar(self):
+        self.mapa.close()
+        self.arquivo.close()
+
+
+class ArmazenamentoArquivo:
+    """Um arquivo por processo no diretório compartilhado pelos workers, somados na coleta"""
+
+    def __init__(self, diretorio):
+        self.diretorio = diretorio
+        self.lock = Lock()
+        self.pid = None
+        self.arquivo = None
+
+    def arquivo_do_processo(self):
+        # O arquivo é aberto novamente no processo filho após o fork dos workers
+        pid = os.getpid()
+        if self.pid != pid:
+            os.makedirs(self.diretorio, exist_ok=True)
+            self.arquivo = ArquivoMmap(os.path.join(self.diretorio, f'metricas_{pid}.db'))
+            self.pid = pid
+        return self.arquivo
+
+    def incrementar(self, chave, valor):
+        with self.lock:
+            self.arquivo_do_processo().incrementar(chave, valor)
+
+    def coletar(self):
+        valores = {}
+        for caminho in glob.glob(os.path.join(self.diretorio, 'metricas_*.db')):
+            for chave, valor in ArquivoMmap.ler(caminho):
+                valores[chave] = valores.get(chave, 0.0) + valor
+        return valores
+
+
+_armazenamento = None
+_armazenamento_lock = Lock()
+
+
+def get_armazenamento():
+    global _armazenamento
+    if _armazenamento is None:
+        with _armazenamento_lock:
+            if _armazenamento is None:
+                if settings.METRICAS_DIRETORIO:
+                    _armazenamento = ArmazenamentoArquivo(settings.METRICAS_DIRETORIO)
+                else:
+                    _armazenamento = ArmazenamentoMemoria()
+    return _armazenamento
+
+
+@receiver(setting_changed)
+def reset_armazenamento(setting, **kwargs):
+    """Descarta o armazenamento quando a configuração das métricas é alterada (ex: nos testes)"""
+    global _armazenamento
+    if setting.startswith('METRICAS'):
+        _armazenamento = None
+
+
+def formatar(valor):
+    if valor == float('inf'):
+        return '+Inf'
+    return repr(float(valor))
+
+
+def formatar_labels(labels):
+    if not labels:
+        return ''
+    pares = []
+    for nome, valor in labels.items():
+        valor = valor.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        pares.append(f'{nome}="{valor}"')
+    return '{' + ','.join(pares) + '}'
+
+
+def exportar():
+    """Métricas de todos os workers no formato texto do Prometheus"""
+    amostras = {}
+    for chave_amostra, valor in get_armazenamento().coletar().items():
+        nome, labels = json.loads(chave_amostra)
+        amostras.setdefault(nome, []).append((labels, valor))
+
+    linhas = []
+    for metrica in METRICAS:
+        linhas.append(f'# HELP {metrica.nome} {metrica.ajuda}')
+        linhas.append(f'# TYPE {metrica.nome} {metrica.tipo}')
+        if metrica.tipo == 'histogram':
+            linhas.extend(exportar_histograma(metrica, amostras))
+        else:
+            for labels, valor in sorted(amostras.get(metrica.nome, []), key=lambda amostra: sorted(amostra[0].items())):
+                linhas.append(f'{metrica.nome}{formatar_labels(labels)} {formatar(valor)}')
+    return '\n'.join(linhas) + '\n'
+
+
+def exportar_histograma(metrica, amostras):
+    buckets = {}
+    for labels, valor in amostras.get(f'{metrica.nome}_bucket', []):
+        limite = labels.pop('le')
+        buckets.setdefault(json.dumps(labels, sort_keys=True), {})[limite] = valor
+    somas = {json.dumps(labels, sort_keys=True): valor for labels, valor in amostras.get(f'{metrica.nome}_sum', [])}
+    contagens = {json.dumps(labels, sort_keys=True): valor
+                 for labels, valor in amostras.get(f'{metrica.nome}_count', [])}
+
+    for serie in sorted(contagens):
+        labels = json.loads(serie)
+        acumulado = 0.0
+        for limite in metrica.buckets:
+            acumulado += buckets.get(serie, {}).get(formatar(limite), 0.0)
+            yield f'{metrica.nome}_bucket{formatar_labels({**labels, "le": formatar(limite)})} {formatar(acumulado)}'
+        yield f'{metrica.nome}_bucket{formatar_labels({**labels, "le": "+Inf"})} {formatar(contagens[serie])}'
+        yield f'{metrica.nome}_sum{formatar_labels(labels)} {formatar(somas.get(serie, 0.0))}'
+        yield f'{metrica.nome}_count{formatar_labels(labels)} {formatar(contagens[serie])}'
+
+
+def metricas(request):
+    """
+    Endpoint interno /metrics, exige o header Authorization: Bearer <METRICAS_TOKEN>.
+    Sem METRICAS_TOKEN configurado o acesso é sempre negado
+    """
+    token = settings.METRICAS_TOKEN
+    if not token or not constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}'):
+        return HttpResponseForbidden()
+    return HttpResponse(exportar(), content_type=CONTENT_TYPE)
+
+
+requisicoes = Contador('http_requisicoes_total', 'Requisições HTTP por rota, método e status',
+                       ['rota', 'metodo', 'status'])
+duracao_requisicoes = Histograma('http_requisicao_duracao_segundos', 'Duração das requisições HTTP',
+                                 ['rota', 'metodo'])
+consultas_sql = Contador('db_consultas_total', 'Consultas SQL executadas pelas requisições HTTP', ['rota'])
+duracao_consultas_sql = Contador('db_consultas_duracao_segundos_total',
+                                 'Tempo das consultas SQL executadas pelas requisições HTTP', ['rota'])
+# resultado: sucesso, erro (status 4xx ou JSON inválido), indisponivel (falha de comunicação, timeout ou 5xx) ou excecao
+consultas_saldo_api = Contador('saldo_api_consultas_total', 'Consultas ao SaldoAPI por resultado', ['resultado'])
+duracao_saldo_api = Histograma('saldo_api_duracao_segundos', 'Duração das consultas ao SaldoAPI', ['resultado'])
+duracao_recalculo = Histograma('cashback_recalculo_duracao_segundos',
+                               'Duração do recálculo do percentual de cashback de um vendedor')
+
+
+def registrar_requisicao(request, response, duracao, consultas, duracao_consultas):
+    resolver_match = getattr(request, 'resolver_match', None)
+    rota = resolver_match.view_name if resolver_match else 'nao_encontrada'
+    requisicoes.incrementar(rota=rota, metodo=request.method, status=response.status_code)
+    duracao_requisicoes.observar(duracao, rota=rota, metodo=request.method)
+    if consultas:
+        consultas_sql.incrementar(consultas, rota=rota)
+        duracao_consultas_sql.incrementar(duracao_consultas, rota=rota)
+
+
+def registrar_consulta_saldo(resultado, duracao):
+    consultas_saldo_api.incrementar(resultado=resultado)
+    duracao_saldo_api.observar(duracao, resultado=resultado)
@@ -0,0 +1,44 @@
+# Generated by Django 3.1.3 on 2026-10-17 00:05
+
+from decimal import Decimal
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Sum
+from django.db.models.functions import TruncDate
+
+
+def popular_vendas_diarias(apps, schema_editor):
+    Compra = apps.get_model('cashback', 'Compra')
+    VendasDiarias = apps.get_model('cashback', 'VendasDiarias')
+    totais = (Compra.objects.filter(data__isnull=False)
+              .annotate(dia=TruncDate('data'))
+              .values('vendedor_id', 'dia')
+              .annotate(total=Sum('valor'))
+              .order_by())
+    VendasDiarias.objects.bulk_create(
+        VendasDiarias(vendedor_id=item['vendedor_id'], dia=item['dia'], total=item['total']) for item in totais
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cashback', '0002_compra'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VendasDiarias',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dia', models.DateField(verbose_name='Dia')),
+                ('total', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=14, verbose_name='Total')),
+                ('vendedor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='vendas_diarias', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('vendedor', 'dia')},
+            },
+        ),
+        migrations.RunPython(popular_vendas_diarias, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.1.3 on 2026-10-17 00:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cashback', '0003_vendas_diarias'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='compra',
+            index=models.Index(fields=['vendedor', 'data'], name='compra_vendedor_data_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.1.3 on 2026-10-17 00:17
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cashback', '0004_compra_vendedor_data_idx'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='vendedor',
+            options={'permissions': [('consultar_saldos', 'Pode consultar o saldo de cashback de outros vendedores')], 'verbose_name': 'user', 'verbose_name_plural': 'users'},
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.1.3 on 2026-10-17 00:20
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cashback', '0005_vendedor_consultar_saldos'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecalculoPendente',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('criado_em', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Criado em')),
+                ('vendedor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recalculos_pendentes', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.1.3 on 2026-10-17 12:00
+
+from decimal import Decimal, ROUND_HALF_EVEN
+from django.db import migrations, models
+
+
+TAMANHO_LOTE = 500
+
+
+def popular_valor_cashback(apps, schema_editor):
+    Compra = apps.get_model('cashback', 'Compra')
+    # Gravado a cada lote para que a memória não dependa do tamanho da tabela
+    lote = []
+    for compra in Compra.objects.only('id', 'valor', 'percentual_cashback').iterator(chunk_size=TAMANHO_LOTE):
+        # Mesma conta de Compra.cashback, arredondada em centavos como a API apresenta
+        cashback = 0
+        if compra.valor and compra.percentual_cashback:
+            cashback = compra.valor * Decimal(compra.percentual_cashback / 100)
+        compra.valor_cashback = Decimal(cashback).quantize(Decimal('0.01'), rounding=ROUND_HALF_EVEN)
+        lote.append(compra)
+        if len(lote) == TAMANHO_LOTE:
+            Compra.objects.bulk_update(lote, ['valor_cashback'])
+            lote = []
+    if lote:
+        Compra.objects.bulk_update(lote, ['valor_cashback'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cashback', '0006_recalculo_pendente'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='compra',
+            name='valor_cashback',
+            field=models.DecimalField(blank=True, decimal_places=2, default=Decimal('0'), max_digits=8, verbose_name='Valor Cashback'),
+        ),
+        migrations.RunPython(popular_valor_cashback, migrations.RunPython.noop),
+    ]
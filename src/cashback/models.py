@@ -1,20 +1,32 @@
-from datetime import timedelta
-from decimal import Decimal
-from string import digits
-
-from django.contrib.auth.models import AbstractUser
-from django.db import models
-from django.db.models import Sum
-from django.utils.timezone import now
+from collections import defaultdict
+from datetime import timedelta, datetime, time
+from functools import partial
+from decimal import Decimal, ROUND_HALF_EVEN
+
+from django.conf import settings
+from django.contrib.auth.models import AbstractUser, update_last_login
+from django.db import models, transaction, IntegrityError
+from django.db.models import Sum, F, Value, ExpressionWrapper, IntegerField, FloatField
+from django.db.models.functions import Cast, Mod, Round
+from django.utils.timezone import now, localdate, make_aware
 from django.views.generic.dates import timezone_today
 
-from cashback.utils import digito_mod11
+from cashback.client import invalidar_saldo
+from cashback.instrumentacao import medir
+from cashback.metricas import duracao_recalculo
+from cashback.routers import registrar_escrita
+from cashback.utils import sanitizar_cpf
 
 
 class Vendedor(AbstractUser):
     # AbstractUser já possui first_name, last_name, e-mail e password
     cpf = models.CharField('CPF', max_length=11, blank=False, null=False, unique=True)
 
+    class Meta(AbstractUser.Meta):
+        permissions = [
+            ('consultar_saldos', 'Pode consultar o saldo de cashback de outros vendedores'),
+        ]
+
     @staticmethod
     def separar_nome_sobrenome(nome):
         first = None
@@ -45,23 +57,19 @@ class Vendedor(AbstractUser):
         :param cpf: CPF a ser validado
         :return: string or None
         """
+        return sanitizar_cpf(cpf)
 
-        if not cpf:
-            return None  # CPF é inválido, pois é vazio
-        # Remove qualquer caractere não numérico e converte para int
-        algarismos = list(map(int, filter(lambda c: c in digits, cpf)))
-
-        if len(algarismos) != 11:
-            return None  # CPF é inválido, pois não tem 11 caracteres
-
-        cpf_calculado = algarismos[:9]
-        # Gera o digito e verifica com a posicao 9 e 10 do array algarismos
-        for i in range(9, 11):
-            digito = digito_mod11(cpf_calculado)
-            cpf_calculado.append(digito)
-            if digito != algarismos[i]:
-                return None  # CPF é inválido, pois um digito não confere
-        return ''.join(map(str, cpf_calculado))  # CPF é válido
+    def registrar_login(self):
+        """
+        Atualiza o last_login, deixando de gravar quando o último registro tem menos de
+        LOGIN_INTERVALO_ULTIMO_ACESSO segundos (o last_login fica defasado no máximo esse intervalo)
+        :return: True se o last_login foi gravado
+        """
+        intervalo = settings.LOGIN_INTERVALO_ULTIMO_ACESSO
+        if intervalo and self.last_login and now() - self.last_login < timedelta(seconds=intervalo):
+            return False
+        update_last_login(None, self)
+        return True
 
     def __str__(self):
         return self.nome
@@ -79,6 +87,16 @@ class Compra(models.Model):
     )
     status = models.CharField("Status", max_length=1, null=False, blank=False, choices=STATUS_CHOICES)
     percentual_cashback = models.FloatField("Percentual Cashback", null=False, blank=True)
+    # Valor do cashback já calculado (mantido junto com o percentual) para leitura e agregação direto no banco
+    valor_cashback = models.DecimalField("Valor Cashback", max_digits=8, decimal_places=2, null=False, blank=True,
+                                         default=Decimal(0))
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['vendedor', 'data'], name='compra_vendedor_data_idx'),
+            # Filtro por status da listagem, mantendo a ordenação por data
+            models.Index(fields=['vendedor', 'status', 'data'], name='compra_vendedor_status_idx'),
+        ]
 
     @property
     def cashback(self):
@@ -88,8 +106,16 @@ class Compra(models.Model):
             return self.valor * Decimal(self.percentual_cashback / 100)
         return 0.0
 
+    def calcular_valor_cashback(self):
+        """Cashback arredondado em centavos, como é apresentado pela API"""
+        return Decimal(self.cashback).quantize(Decimal('0.01'), rounding=ROUND_HALF_EVEN)
+
     def get_status_inicial(self):
-        if self.vendedor and self.vendedor.cpf == '15350946056':
+        return self.status_inicial_do_cpf(self.vendedor.cpf if self.vendedor else None)
+
+    @staticmethod
+    def status_inicial_do_cpf(cpf):
+        if cpf == '15350946056':
             return 'A'
         return 'V'
 
@@ -104,27 +130,270 @@ class Compra(models.Model):
                 return 20.0
         return 0.0
 
+    @staticmethod
+    def inicio_periodo():
+        return timezone_today() - timedelta(days=30)
+
+    @classmethod
+    def compras_do_periodo(cls, vendedor_id):
+        """
+        Compras do vendedor nos últimos 30 dias.
+        Filtra por intervalo de datetime (e não por data__date) para que o índice (vendedor, data) seja utilizado.
+        """
+        # is_dst=False: quando a janela começa no início do horário de verão a meia-noite não existe
+        inicio = make_aware(datetime.combine(cls.inicio_periodo(), time.min), is_dst=False)
+        return cls.objects.filter(vendedor_id=vendedor_id, data__gte=inicio)
+
+    @classmethod
+    def percentual_do_periodo(cls, vendedor_id):
+        return cls.get_percentual_cashback(VendasDiarias.total_periodo(vendedor_id, cls.inicio_periodo()))
+
+    @classmethod
+    def recalcular_percentual_cashback(cls, vendedor_id, novo_percentual=None):
+        """
+        Com CASHBACK_RECALCULO_ASSINCRONO o recálculo é agendado no outbox (na mesma transação) para o comando
+        processar_recalculos, caso contrário é feito imediatamente.
+        :param vendedor_id: id do vendedor
+        :param novo_percentual: percentual já calculado com o livro de vendas atualizado, evita somar o período novamente
+        :return: float com o percentual de cashback vigente, ou None se o recálculo foi agendado
+        """
+        if settings.CASHBACK_RECALCULO_ASSINCRONO:
+            RecalculoPendente.objects.create(vendedor_id=vendedor_id)
+            return None
+        with medir('recalculo'):
+            return cls.atualizar_percentual_cashback(vendedor_id, novo_percentual)
+
+    @classmethod
+    def atualizar_percentual_cashback(cls, vendedor_id, novo_percentual=None):
+        """
+        Recalcula o percentual de cashback das compras do vendedor nos últimos 30 dias a partir do livro de vendas
+        diárias e atualiza apenas as compras cujo percentual mudou.
+        :param vendedor_id: id do vendedor
+        :param novo_percentual: percentual já calculado com o livro de vendas atualizado, evita somar o período novamente
+        :return: float com o percentual de cashback vigente
+        """
+        with duracao_recalculo.cronometrar():
+            if novo_percentual is None:
+                novo_percentual = cls.percentual_do_periodo(vendedor_id)
+            vendas_do_mes = cls.compras_do_periodo(vendedor_id)
+            # Se o vendedor não mudou de faixa nenhuma compra é alterada. Caso contrário um único UPDATE, sem
+            # carregar as compras, independente da quantidade de compras do vendedor no período
+            alteradas = vendas_do_mes.exclude(percentual_cashback=novo_percentual)
+            if alteradas.exists():
+                alteradas.update(percentual_cashback=novo_percentual,
+                                 valor_cashback=cls.expressao_valor_cashback(novo_percentual))
+        return novo_percentual
+
+    @staticmethod
+    def expressao_valor_cashback(percentual):
+        """
+        Expressão SQL com o mesmo resultado do calcular_valor_cashback para um percentual inteiro (as faixas de cashback).
+        O cálculo é feito em inteiros (centavos x percentual), sem depender da aritmética decimal do banco. No Python
+        o percentual é um float (0.1 é um pouco maior e 0.15 um pouco menor que o valor exato), então no empate de
+        meio centavo o arredondamento segue o sentido desse erro
+        """
+        percentual = int(percentual)
+        empate_para_cima = Decimal(percentual / 100) > Decimal(percentual) / 100
+        # Cashback em centésimos de centavo, arredondado para o múltiplo de 100 somando 50 (ou 49 quando o empate
+        # é arredondado para baixo) e descartando o resto
+        centesimos = ExpressionWrapper(Cast(Round(F('valor') * 100), IntegerField()) * percentual + (50 if empate_para_cima else 49),
+                                       output_field=IntegerField())
+        return ExpressionWrapper((centesimos - Mod(centesimos, 100)) / Value(10000.0), output_field=FloatField())
+
+    @classmethod
+    def criar_em_lote(cls, compras):
+        """
+        Insere as compras com um único bulk_create e recalcula o percentual de cashback uma vez por vendedor
+        :param compras: lista de Compra ainda não salvas
+        :return: lista de Compra com o percentual atualizado
+        """
+        totais = defaultdict(Decimal)
+        for compra in compras:
+            if not compra.status:
+                compra.status = compra.get_status_inicial()
+            compra.percentual_cashback = cls.get_percentual_cashback(compra.valor)
+            compra.valor_cashback = compra.calcular_valor_cashback()
+            if compra.data and compra.valor:
+                totais[(compra.vendedor_id, localdate(compra.data))] += compra.valor
+
+        with transaction.atomic():
+            cls.objects.bulk_create(compras)
+            for (vendedor_id, dia), total in totais.items():
+                VendasDiarias.registrar(vendedor_id, dia, total)
+            percentuais = {}
+            for vendedor_id in {compra.vendedor_id for compra in compras}:
+                percentual = cls.recalcular_percentual_cashback(vendedor_id)
+                if percentual is None:
+                    percentual = cls.percentual_do_periodo(vendedor_id)
+                percentuais[vendedor_id] = percentual
+            for cpf in {compra.vendedor.cpf for compra in compras}:
+                transaction.on_commit(partial(invalidar_saldo, cpf))
+            for vendedor_id in {compra.vendedor_id for compra in compras}:
+                transaction.on_commit(partial(registrar_escrita, vendedor_id))
+
+        inicio = cls.inicio_periodo()
+        for compra in compras:
+            if compra.data and localdate(compra.data) >= inicio:
+                compra.percentual_cashback = percentuais[compra.vendedor_id]
+                compra.valor_cashback = compra.calcular_valor_cashback()
+        return compras
+
     def save(self, **kwargs):
         # Preenche os atributos sem preenchimento do usuário
         if not self.status:
             self.status = self.get_status_inicial()
 
-        # Precisa preencher pois o campo é NOT_NULL, mas será sobrescrito depois
-        self.percentual_cashback = self.get_percentual_cashback(self.valor)
+        with transaction.atomic():
+            # Mantém o livro de vendas diárias sincronizado com a compra
+            if self.pk:
+                anterior = Compra.objects.filter(pk=self.pk).values('valor', 'data', 'vendedor_id').first()
+                if anterior:
+                    VendasDiarias.registrar(anterior['vendedor_id'], anterior['data'], -anterior['valor'])
+            VendasDiarias.registrar(self.vendedor_id, self.data, self.valor)
+
+            # Faixa do vendedor com o livro já atualizado, somada uma única vez para a compra e para o recálculo
+            with medir('recalculo'):
+                novo_percentual = self.percentual_do_periodo(self.vendedor_id)
 
-        # Salva a compra no banco de dados
-        super(Compra, self).save(**kwargs)
+            # Compras fora da janela de 30 dias mantém o percentual do próprio valor
+            self.percentual_cashback = self.get_percentual_cashback(self.valor)
+            if self.data and localdate(self.data) >= self.inicio_periodo():
+                self.percentual_cashback = novo_percentual
+            self.valor_cashback = self.calcular_valor_cashback()
 
-        # Recalcula o total de vendas do último mês
-        inicio = timezone_today() - timedelta(days=30)
-        vendas_do_mes = self.vendedor.compras.filter(data__date__gte=inicio)
+            # Salva a compra no banco de dados
+            super(Compra, self).save(**kwargs)
 
-        sum = vendas_do_mes.aggregate(vendas_do_mes=Sum("valor"))
-        if sum:
-            novo_percentual = self.get_percentual_cashback(sum["vendas_do_mes"])
-            # Atualiza o mesmo queryset para o novo percentual
-            vendas_do_mes.update(percentual_cashback=novo_percentual)
-            self.percentual_cashback = novo_percentual
+            # Recalcula o percentual das demais vendas do último mês
+            self.recalcular_percentual_cashback(self.vendedor_id, novo_percentual)
+
+            # O saldo em cache do vendedor fica desatualizado com a nova compra
+            transaction.on_commit(partial(invalidar_saldo, self.vendedor.cpf))
+            # As próximas leituras do vendedor ficam no primário até a réplica receber a compra
+            transaction.on_commit(partial(registrar_escrita, self.vendedor_id))
+
+    def delete(self, **kwargs):
+        with transaction.atomic():
+            anterior = Compra.objects.filter(pk=self.pk).values('valor', 'data', 'vendedor_id').first()
+            retorno = super(Compra, self).delete(**kwargs)
+            if anterior:
+                VendasDiarias.registrar(anterior['vendedor_id'], anterior['data'], -anterior['valor'])
+                self.recalcular_percentual_cashback(anterior['vendedor_id'])
+                transaction.on_commit(partial(registrar_escrita, anterior['vendedor_id']))
+        return retorno
 
     def __str__(self):
         return f"Compra {self.codigo}"
+
+
+class VendasDiarias(models.Model):
+    """
+    Livro de vendas por vendedor e dia, mantido em sincronia com as escritas de Compra.
+    O total da janela de 30 dias é obtido somando no máximo 31 linhas.
+    """
+    vendedor = models.ForeignKey(Vendedor, null=False, blank=False, on_delete=models.CASCADE,
+                                 related_name='vendas_diarias')
+    dia = models.DateField("Dia", null=False, blank=False)
+    total = models.DecimalField("Total", max_digits=14, decimal_places=2, null=False, blank=False,
+                                default=Decimal(0))
+
+    class Meta:
+        unique_together = [['vendedor', 'dia']]
+
+    @classmethod
+    def registrar(cls, vendedor_id, data, valor):
+        """
+        Soma o valor ao total do dia da compra (valores negativos removem uma venda do total)
+        :param vendedor_id: id do vendedor
+        :param data: datetime da compra (ou date do dia)
+        :param valor: valor a ser somado
+        """
+        if not data or not valor:
+            return
+        dia = localdate(data) if isinstance(data, datetime) else data
+        atualizados = cls.objects.filter(vendedor_id=vendedor_id, dia=dia).update(total=F('total') + valor)
+        if atualizados:
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(vendedor_id=vendedor_id, dia=dia, total=valor)
+        except IntegrityError:
+            # Outra requisição criou o dia primeiro
+            cls.objects.filter(vendedor_id=vendedor_id, dia=dia).update(total=F('total') + valor)
+
+    @classmethod
+    def registrar_em_lote(cls, totais):
+        """
+        Soma os totais de vários vendedores e dias com uma consulta, um bulk_update e um bulk_create.
+        Deve ser chamado dentro de uma transação, que mantém os dias existentes bloqueados até a gravação
+        :param totais: dict de (vendedor_id, date do dia) -> valor a ser somado
+        """
+        if not totais:
+            return
+        existentes = cls.objects.select_for_update().filter(vendedor_id__in={vendedor_id for vendedor_id, _ in totais},
+                                                            dia__in={dia for _, dia in totais})
+        alterados = []
+        for registro in existentes:
+            valor = totais.get((registro.vendedor_id, registro.dia))
+            if valor is not None:
+                registro.total += valor
+                alterados.append(registro)
+        existentes = {(registro.vendedor_id, registro.dia) for registro in alterados}
+        cls.objects.bulk_update(alterados, ['total'], batch_size=500)
+        cls.objects.bulk_create(cls(vendedor_id=vendedor_id, dia=dia, total=valor)
+                                for (vendedor_id, dia), valor in totais.items() if (vendedor_id, dia) not in existentes)
+
+    @classmethod
+    def total_periodo(cls, vendedor_id, inicio):
+        """
+        Retorna o total vendido pelo vendedor a partir do dia informado
+        :param vendedor_id: id do vendedor
+        :param inicio: date do primeiro dia do período
+        :return: Decimal ou None se não houver vendas
+        """
+        soma = cls.objects.filter(vendedor_id=vendedor_id, dia__gte=inicio).aggregate(total=Sum('total'))
+        return soma['total']
+
+    def __str__(self):
+        return f"Vendas de {self.dia}"
+
+
+class RecalculoPendente(models.Model):
+    """
+    Outbox dos recálculos de percentual de cashback, gravado na mesma transação da compra.
+    É consumido pelo comando processar_recalculos, que remove os registros processados.
+    """
+    vendedor = models.ForeignKey(Vendedor, null=False, blank=False, on_delete=models.CASCADE,
+                                 related_name='recalculos_pendentes')
+    criado_em = models.DateTimeField("Criado em", null=False, blank=False, default=now)
+
+    @classmethod
+    def atraso(cls):
+        """
+        Tempo desde o recálculo pendente mais antigo
+        :return: timedelta (zero se não houver pendências)
+        """
+        mais_antigo = cls.objects.order_by('id').values_list('criado_em', flat=True).first()
+        if mais_antigo is None:
+            return timedelta(0)
+        return now() - mais_antigo
+
+    @classmethod
+    def processar(cls, tamanho_lote):
+        """
+        Processa um lote de recálculos pendentes, agrupando os eventos do mesmo vendedor em um único recálculo
+        :param tamanho_lote: quantidade máxima de eventos lidos
+        :return: tupla (eventos processados, vendedores recalculados)
+        """
+        eventos = list(cls.objects.order_by('id').values_list('id', 'vendedor_id')[:tamanho_lote])
+        if not eventos:
+            return 0, 0
+        ultimo_evento = {}
+        for evento_id, vendedor_id in eventos:
+            ultimo_evento[vendedor_id] = evento_id
+        for vendedor_id, evento_id in ultimo_evento.items():
+            with transaction.atomic():
+                Compra.atualizar_percentual_cashback(vendedor_id)
+                # Remove também eventos do vendedor que já estavam no lote, pois o recálculo cobre todos
+                cls.objects.filter(vendedor_id=vendedor_id, id__lte=evento_id).delete()
+        return len(eventos), len(ultimo_evento)
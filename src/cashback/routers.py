@@ -0,0 +1,108 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.dispatch import receiver
+
+from cashback.cache import CacheDjango
+
+_alias_leitura = ContextVar('alias_leitura', default=None)
+
+
+class ReplicaRouter:
+    """
+    Envia para a réplica apenas as leituras feitas dentro de ler_da_replica (listagem de compras),
+    as demais leituras e todas as escritas ficam no banco primário
+    """
+
+    def db_for_read(self, model, **hints):
+        # Leituras dentro de uma transação de escrita precisam enxergar o que ela já gravou
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return _alias_leitura.get()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # A réplica tem os mesmos dados do primário
+        return True
+
+
+class Fixacoes:
+    """
+    Vendedores que escreveram recentemente e por isso leem do primário durante DATABASE_REPLICA_JANELA_ESCRITA segundos,
+    garantindo que vejam as próprias compras mesmo com atraso na replicação.
+    Guardadas em um cache compartilhado, pois a leitura seguinte pode ser atendida por outro worker
+    """
+    prefixo = 'replica:fixacao:'
+
+    def __init__(self, backend, janela):
+        self.backend = backend
+        self.janela = janela
+
+    @classmethod
+    def from_settings(cls):
+        if settings.DATABASE_REPLICA_BACKEND not in settings.CACHES:
+            raise ImproperlyConfigured(
+                "DATABASE_REPLICA_BACKEND deve ser o alias de um cache em CACHES compartilhado entre os workers")
+        return cls(CacheDjango(settings.DATABASE_REPLICA_BACKEND), settings.DATABASE_REPLICA_JANELA_ESCRITA)
+
+    def chave(self, vendedor_id):
+        return f'{self.prefixo}{vendedor_id}'
+
+    def registrar(self, vendedor_id):
+        if self.janela:
+            self.backend.set(self.chave(vendedor_id), True, self.janela)
+
+    def fixado(self, vendedor_id):
+        return bool(self.backend.get(self.chave(vendedor_id)))
+
+
+_fixacoes = None
+_fixacoes_lock = Lock()
+
+
+def get_fixacoes():
+    global _fixacoes
+    if _fixacoes is None:
+        with _fixacoes_lock:
+            if _fixacoes is None:
+                _fixacoes = Fixacoes.from_settings()
+    return _fixacoes
+
+
+def registrar_escrita(vendedor_id):
+    """Mantém as leituras do vendedor no primário pela janela configurada"""
+    if settings.DATABASE_REPLICA_HABILITADA:
+        get_fixacoes().registrar(vendedor_id)
+
+
+def alias_de_leitura(vendedor_id):
+    """Réplica se estiver habilitada e o vendedor não escreveu dentro da janela, senão o primário"""
+    if settings.DATABASE_REPLICA_HABILITADA and not get_fixacoes().fixado(vendedor_id):
+        return settings.DATABASE_REPLICA_ALIAS
+    return DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def ler_da_replica(vendedor_id):
+    """Direciona as leituras do bloco para o alias_de_leitura do vendedor"""
+    alias = alias_de_leitura(vendedor_id)
+    token = _alias_leitura.set(alias)
+    try:
+        yield alias
+    finally:
+        _alias_leitura.reset(token)
+
+
+@receiver(setting_changed)
+def reset_fixacoes(setting, **kwargs):
+    """Descarta as fixações quando a configuração da réplica ou dos caches é alterada (ex: nos testes)"""
+    global _fixacoes
+    if setting.startswith('DATABASE_REPLICA_') or setting == 'CACHES':
+        _fixacoes = None
@@ -1,18 +1,59 @@
-from datetime import timedelta
+import asyncio
+import csv
+import io
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from pathlib import Path
+from importlib.util import find_spec
+from datetime import date, datetime, timedelta
 from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Barrier, Event, get_ident
+from string import digits
+from time import sleep, perf_counter
+from unittest import skipUnless
 from unittest.mock import patch
 
-from django.test import TestCase
-from django.utils.timezone import now
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import request_started, request_finished
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Sum
+from django.contrib.auth.models import Permission
+from django.core.management import call_command, CommandError
+from django.test import TestCase, TransactionTestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from log_request_id.filters import RequestIDFilter
+from django.utils import timezone
+from django.utils.timezone import now, localdate
 from model_bakery import baker
+from requests.exceptions import ConnectTimeout
 from requests_mock import Mocker
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APIClient
-from rest_framework_simplejwt.tokens import RefreshToken
-
-from cashback.api import ChoiceField
-from cashback.client import SaldoAPI
-from cashback.models import Vendedor, Compra
-from cashback.utils import digito_mod11
+from rest_framework_simplejwt.tokens import RefreshToken, AccessToken
+
+from boticario.handlers import BoticarioASGIHandler
+from cashback.api import ChoiceField, CompraSerializer, CompraListagemSerializer, ComprasFilter
+from cashback.cache import MemoriaLRU, CacheDjango, SaldoCache
+from cashback import views
+from cashback.authentication import VendedorRefreshToken, VendedorToken
+from cashback.client import SaldoAPI, SingleFlight, CircuitBreaker, CircuitoAberto, SingleFlightAsync, get_saldo_api, get_saldo_api_async, get_saldos_executor
+from cashback.instrumentacao import TempoRequisicaoMiddleware, medir, medicao_atual
+from cashback.management.commands.importar_compras import Command
+from cashback import metricas
+from cashback.metricas import ArquivoMmap, ArmazenamentoArquivo, Contador, Histograma, exportar
+from cashback.models import Vendedor, Compra, VendasDiarias, RecalculoPendente
+from cashback.routers import ler_da_replica, Fixacoes
+from cashback.utils import digito_mod11, sanitizar_cpf, validar_cpfs
 
 
 class VendedorTests(TestCase):
@@ -203,6 +244,377 @@ class CompraTests(TestCase):
         compra_trinta_dias.refresh_from_db()
         self.assertEqual(compra_trinta_dias.percentual_cashback, 15)
 
+    def test_save_grava_valor_cashback(self):
+        vendedor = Vendedor.objects.create(cpf="35770006005", username="vendedor")
+        compra = Compra.objects.create(codigo="234570", vendedor=vendedor, valor=Decimal("33.33"), data=now())
+        compra.refresh_from_db()
+        self.assertEqual(compra.valor_cashback, Decimal("3.33"))
+        self.assertEqual(compra.valor_cashback, compra.calcular_valor_cashback())
+
+    def test_mudanca_de_faixa_atualiza_valor_cashback(self):
+        vendedor = Vendedor.objects.create(cpf="35770006005", username="vendedor")
+        compra = Compra.objects.create(codigo="234570", vendedor=vendedor, valor=Decimal("999.99"), data=now())
+        Compra.objects.create(codigo="234571", vendedor=vendedor, valor=Decimal(600), data=now())
+        compra.refresh_from_db()
+        self.assertEqual(compra.percentual_cashback, 20)
+        self.assertEqual(compra.valor_cashback, Decimal("200.00"))
+        self.assertEqual(vendedor.compras.aggregate(total=Sum('valor_cashback'))['total'], Decimal("320.00"))
+
+    def test_mudanca_de_faixa_com_um_unico_update(self):
+        vendedor = Vendedor.objects.create(cpf="35770006005", username="vendedor")
+        for i in range(20):
+            Compra.objects.create(codigo=f"2346{i:02}", vendedor=vendedor, valor=Decimal(40), data=now())
+        with CaptureQueriesContext(connection) as queries:
+            Compra.objects.create(codigo="234699", vendedor=vendedor, valor=Decimal(300), data=now())
+        updates = [q["sql"] for q in queries if q["sql"].startswith('UPDATE "cashback_compra"')]
+        self.assertEqual(len(updates), 1)
+        self.assertFalse([q for q in queries if q["sql"].startswith('SELECT "cashback_compra"."id"')])
+        self.assertEqual(set(vendedor.compras.values_list('percentual_cashback', 'valor_cashback')),
+                         {(15, Decimal("6.00")), (15, Decimal("45.00"))})
+
+    def test_valor_cashback_em_sql_igual_ao_calculado(self):
+        vendedor = Vendedor.objects.create(cpf="35770006005", username="vendedor")
+        # Empates de meio centavo (10.05 e 10.10 com 10% e 15%) e valores aleatórios
+        aleatorio = random.Random(42)
+        valores = [Decimal("10.05"), Decimal("10.10"), Decimal("100.05"), Decimal("33.33"), Decimal("999999.99")]
+        valores += [Decimal(aleatorio.randint(1, 10 ** 8 - 1)) / 100 for _ in range(300)]
+        Compra.objects.bulk_create(Compra(codigo=f"{i:06}", vendedor=vendedor, valor=valor, data=now(), status='V',
+                                          percentual_cashback=0, valor_cashback=0) for i, valor in enumerate(valores))
+        for percentual in (10.0, 15.0, 20.0):
+            Compra.objects.update(percentual_cashback=percentual,
+                                  valor_cashback=Compra.expressao_valor_cashback(percentual))
+            for compra in Compra.objects.all():
+                self.assertEqual(compra.valor_cashback, compra.calcular_valor_cashback(), (compra.valor, percentual))
+
+    def test_criar_em_lote_grava_valor_cashback(self):
+        vendedor = Vendedor.objects.create(cpf="35770006005", username="vendedor")
+        compras = Compra.criar_em_lote([
+            Compra(codigo=f"23457{i}", vendedor=vendedor, valor=Decimal("400.05"), data=now()) for i in range(3)
+        ])
+        self.assertEqual({compra.valor_cashback for compra in compras}, {Decimal("60.01")})
+        self.assertEqual(set(vendedor.compras.values_list('valor_cashback', flat=True)), {Decimal("60.01")})
+
+
+class VendasDiariasTests(TestCase):
+    def setUp(self):
+        self.vendedor = Vendedor.objects.create(cpf="35770006005", username="vendedor")
+
+    def test_save_registra_total_do_dia(self):
+        data = now()
+        Compra.objects.create(codigo="456789", vendedor=self.vendedor, valor=Decimal(100), data=data)
+        Compra.objects.create(codigo="456790", vendedor=self.vendedor, valor=Decimal("50.50"), data=data)
+        vendas = VendasDiarias.objects.get(vendedor=self.vendedor)
+        self.assertEqual(vendas.dia, localdate(data))
+        self.assertEqual(vendas.total, Decimal("150.50"))
+
+    def test_save_alteracao_move_valor_entre_dias(self):
+        ontem = now() - timedelta(days=1)
+        compra = Compra.objects.create(codigo="456789", vendedor=self.vendedor, valor=Decimal(100), data=ontem)
+        compra.data = now()
+        compra.valor = Decimal(300)
+        compra.save()
+        self.assertEqual(VendasDiarias.objects.get(dia=localdate(ontem)).total, 0)
+        self.assertEqual(VendasDiarias.objects.get(dia=localdate(compra.data)).total, 300)
+
+    def test_delete_remove_valor_e_recalcula_percentual(self):
+        compra = Compra.objects.create(codigo="456789", vendedor=self.vendedor, valor=Decimal(900), data=now())
+        outra = Compra.objects.create(codigo="456790", vendedor=self.vendedor, valor=Decimal(200), data=now())
+        self.assertEqual(outra.percentual_cashback, 15)
+        compra.delete()
+        outra.refresh_from_db()
+        self.assertEqual(outra.percentual_cashback, 10)
+        self.assertEqual(VendasDiarias.total_periodo(self.vendedor.id, Compra.inicio_periodo()), 200)
+
+    def test_total_periodo_ignora_dias_anteriores(self):
+        Compra.objects.create(codigo="456789", vendedor=self.vendedor, valor=Decimal(2000),
+                              data=now() - timedelta(days=31))
+        Compra.objects.create(codigo="456790", vendedor=self.vendedor, valor=Decimal(100), data=now())
+        self.assertEqual(VendasDiarias.total_periodo(self.vendedor.id, Compra.inicio_periodo()), 100)
+
+    def test_save_nao_reescreve_percentual_sem_mudanca_de_faixa(self):
+        Compra.objects.create(codigo="456789", vendedor=self.vendedor, valor=Decimal(100), data=now())
+        with CaptureQueriesContext(connection) as queries:
+            Compra.objects.create(codigo="456790", vendedor=self.vendedor, valor=Decimal(100), data=now())
+        updates = [q["sql"] for q in queries if q["sql"].startswith('UPDATE "cashback_compra"')]
+        self.assertEqual(len(updates), 0)
+        self.assertEqual(Compra.objects.exclude(percentual_cashback=10).count(), 0)
+
+    def test_save_soma_o_periodo_uma_vez(self):
+        Compra.objects.create(codigo="456789", vendedor=self.vendedor, valor=Decimal(100), data=now())
+        # SAVEPOINT, UPDATE do livro, SUM do período, INSERT, EXISTS das compras com outra faixa e RELEASE
+        with self.assertNumQueries(6), CaptureQueriesContext(connection) as queries:
+            Compra.objects.create(codigo="456790", vendedor=self.vendedor, valor=Decimal(100), data=now())
+        self.assertEqual(len([q for q in queries if 'SUM(' in q["sql"]]), 1)
+
+    def test_registrar_em_lote_soma_dias_existentes_e_cria_novos(self):
+        outro_vendedor = Vendedor.objects.create(cpf="87103564019", username="outro-vendedor")
+        hoje = localdate()
+        ontem = hoje - timedelta(days=1)
+        VendasDiarias.registrar(self.vendedor.id, hoje, Decimal(100))
+        VendasDiarias.registrar(outro_vendedor.id, ontem, Decimal(10))
+        with CaptureQueriesContext(connection) as queries, transaction.atomic():
+            VendasDiarias.registrar_em_lote({
+                (self.vendedor.id, hoje): Decimal("50.50"),
+                (self.vendedor.id, ontem): Decimal(30),
+                (outro_vendedor.id, hoje): Decimal(20),
+            })
+        self.assertEqual(len([q for q in queries if 'cashback_vendasdiarias' in q["sql"]]), 3)
+        totais = VendasDiarias.objects.values_list('vendedor_id', 'dia', 'total')
+        self.assertEqual({(vendedor_id, dia): total for vendedor_id, dia, total in totais}, {
+            (self.vendedor.id, hoje): Decimal("150.50"),
+            (self.vendedor.id, ontem): Decimal(30),
+            (outro_vendedor.id, hoje): Decimal(20),
+            (outro_vendedor.id, ontem): Decimal(10),
+        })
+
+
+class RecalculoAssincronoTests(TestCase):
+    def setUp(self):
+        self.vendedor = Vendedor.objects.create(cpf="35770006005", username="vendedor")
+        self.outro_vendedor = Vendedor.objects.create(cpf="87103564019", username="outro-vendedor")
+
+    def test_modo_assincrono_grava_outbox_sem_atualizar_compras(self):
+        primeira = Compra.objects.create(codigo="600000", vendedor=self.vendedor, valor=Decimal(900))
+        with self.settings(CASHBACK_RECALCULO_ASSINCRONO=True):
+            segunda = Compra.objects.create(codigo="600001", vendedor=self.vendedor, valor=Decimal(200))
+        self.assertEqual(RecalculoPendente.objects.filter(vendedor=self.vendedor).count(), 1)
+        # A nova compra já sai com o percentual do período, as demais aguardam o worker
+        self.assertEqual(segunda.percentual_cashback, 15)
+        primeira.refresh_from_db()
+        self.assertEqual(primeira.percentual_cashback, 10)
+
+    def test_modo_sincrono_nao_grava_outbox(self):
+        Compra.objects.create(codigo="600000", vendedor=self.vendedor, valor=Decimal(900))
+        self.assertFalse(RecalculoPendente.objects.exists())
+
+    def test_comando_agrupa_eventos_do_mesmo_vendedor(self):
+        with self.settings(CASHBACK_RECALCULO_ASSINCRONO=True):
+            for i in range(3):
+                Compra.objects.create(codigo=f"60000{i}", vendedor=self.vendedor, valor=Decimal(400))
+            Compra.objects.create(codigo="600010", vendedor=self.outro_vendedor, valor=Decimal(100))
+        self.assertEqual(RecalculoPendente.objects.count(), 4)
+
+        with patch.object(Compra, 'atualizar_percentual_cashback',
+                          wraps=Compra.atualizar_percentual_cashback) as atualizar:
+            call_command('processar_recalculos', uma_vez=True)
+        self.assertEqual(sorted(chamada.args[0] for chamada in atualizar.call_args_list),
+                         sorted([self.vendedor.id, self.outro_vendedor.id]))
+        self.assertFalse(RecalculoPendente.objects.exists())
+        self.assertEqual(set(self.vendedor.compras.values_list('percentual_cashback', flat=True)), {15})
+
+    def test_processar_em_lotes(self):
+        with self.settings(CASHBACK_RECALCULO_ASSINCRONO=True):
+            Compra.objects.create(codigo="600000", vendedor=self.vendedor, valor=Decimal(400))
+            Compra.objects.create(codigo="600001", vendedor=self.outro_vendedor, valor=Decimal(100))
+            Compra.objects.create(codigo="600002", vendedor=self.vendedor, valor=Decimal(400))
+        self.assertEqual(RecalculoPendente.processar(tamanho_lote=2), (2, 2))
+        # O evento restante é do vendedor já recalculado, mas fica para o próximo lote
+        self.assertEqual(RecalculoPendente.objects.count(), 1)
+        self.assertEqual(RecalculoPendente.processar(tamanho_lote=2), (1, 1))
+        self.assertEqual(RecalculoPendente.processar(tamanho_lote=2), (0, 0))
+
+    def test_atraso(self):
+        self.assertEqual(RecalculoPendente.atraso(), timedelta(0))
+        RecalculoPendente.objects.create(vendedor=self.vendedor, criado_em=now() - timedelta(minutes=5))
+        self.assertGreaterEqual(RecalculoPendente.atraso(), timedelta(minutes=5))
+
+
+class ImportacaoComprasTest(TestCase):
+    def setUp(self):
+        self.vendedor = Vendedor.objects.create(cpf="35770006005", username="vendedor")
+        self.outro_vendedor = Vendedor.objects.create(cpf="87103564019", username="outro-vendedor")
+        diretorio = tempfile.TemporaryDirectory()
+        self.addCleanup(diretorio.cleanup)
+        self.diretorio = Path(diretorio.name)
+        self.hoje = localdate()
+
+    def escrever_csv(self, linhas, nome='compras.csv'):
+        caminho = self.diretorio / nome
+        with open(caminho, 'w', newline='', encoding='utf-8') as arquivo:
+            writer = csv.writer(arquivo)
+            writer.writerow(['codigo', 'valor', 'data', 'cpf', 'status'])
+            writer.writerows(linhas)
+        return str(caminho)
+
+    def importar(self, caminho, **opcoes):
+        saida, erros = io.StringIO(), io.StringIO()
+        call_command('importar_compras', caminho, stdout=saida, stderr=erros, **opcoes)
+        return saida.getvalue(), erros.getvalue()
+
+    def test_importa_csv_descartando_duplicadas_e_invalidas(self):
+        existente = Compra.objects.create(codigo="700000", vendedor=self.vendedor, valor=Decimal(100))
+        antigo = (self.hoje - timedelta(days=60)).isoformat()
+        caminho = self.escrever_csv([
+            ["700001", "800.00", f"{self.hoje.isoformat()}T10:00:00", "357.700.060-05", ""],
+            ["700002", "800", self.hoje.isoformat(), "35770006005", "A"],
+            ["700003", "1200.00", antigo, "35770006005", "Negado"],
+            ["700004", "50", f"{self.hoje.isoformat()}T09:00:00-03:00", "87103564019", ""],
+            ["700000", "10", self.hoje.isoformat(), "35770006005", ""],  # já existe na tabela
+            ["700001", "10", self.hoje.isoformat(), "35770006005", ""],  # repetida no arquivo
+            ["700005", "10", self.hoje.isoformat(), "35770006004", ""],  # CPF inválido
+            ["700006", "10", self.hoje.isoformat(), "15350946056", ""],  # vendedor inexistente
+            ["700007", "abc", self.hoje.isoformat(), "35770006005", ""],
+            ["700008", "10.001", self.hoje.isoformat(), "35770006005", ""],
+            ["700009", "10", "ontem", "35770006005", ""],
+            ["700010", "10", self.hoje.isoformat(), "35770006005", "X"],
+            ["7000110", "10", self.hoje.isoformat(), "35770006005", ""],
+        ])
+        saida, erros = self.importar(caminho, lote=4, verbosity=2)
+
+        self.assertIn("Importação finalizada: 13 linhas lidas, 4 inseridas, 2 duplicadas, 7 inválidas", saida)
+        self.assertIn("linhas/s", saida)
+        self.assertIn("Linha 8 ignorada: CPF inválido", erros)
+        self.assertIn("Linha 9 ignorada: vendedor não encontrado para o CPF 15350946056", erros)
+        self.assertEqual(erros.count("ignorada"), 7)
+
+        compras = {compra.codigo: compra for compra in Compra.objects.all()}
+        self.assertEqual(sorted(compras), ["700000", "700001", "700002", "700003", "700004"])
+        self.assertEqual(compras["700001"].status, "V")
+        self.assertEqual(compras["700002"].status, "A")
+        self.assertEqual(compras["700003"].status, "N")
+        self.assertEqual(compras["700004"].vendedor, self.outro_vendedor)
+        # Faixa do período recalculada com o histórico importado (100 + 800 + 800), inclusive para a compra existente
+        for codigo in ["700000", "700001", "700002"]:
+            self.assertEqual(compras[codigo].percentual_cashback, 20)
+        self.assertEqual(compras["700001"].valor_cashback, Decimal("160.00"))
+        # Fora da janela de 30 dias fica o percentual do próprio valor
+        self.assertEqual(compras["700003"].percentual_cashback, 15)
+        self.assertEqual(compras["700003"].valor_cashback, Decimal("180.00"))
+        self.assertEqual(compras["700004"].percentual_cashback, 10)
+        existente.refresh_from_db()
+        self.assertEqual(existente.valor_cashback, Decimal("20.00"))
+
+        # Livro de vendas diárias equivalente ao das compras gravadas
+        for vendedor in [self.vendedor, self.outro_vendedor]:
+            esperado = {}
+            for compra in vendedor.compras.all():
+                dia = localdate(compra.data)
+                esperado[dia] = esperado.get(dia, Decimal(0)) + compra.valor
+            self.assertEqual(dict(vendedor.vendas_diarias.values_list('dia', 'total')), esperado)
+
+    def test_importa_ndjson(self):
+        caminho = self.diretorio / 'compras.ndjson'
+        caminho.write_text("\n".join([
+            json.dumps({"codigo": "710000", "valor": "200.00", "data": f"{self.hoje.isoformat()}T12:00:00Z",
+                        "cpf": "35770006005", "percentual_cashback": 20.0, "cashback": "40.00",
+                        "status": "Em Validação"}, ensure_ascii=False),
+            "",
+            "{mal formado",
+            json.dumps(["710001"]),
+            json.dumps({"codigo": 710002, "valor": 300, "data": self.hoje.isoformat(), "cpf": "35770006005"}),
+        ]), encoding='utf-8')
+        saida, _ = self.importar(str(caminho))
+        self.assertIn("4 linhas lidas, 2 inseridas, 0 duplicadas, 2 inválidas", saida)
+        self.assertEqual(list(Compra.objects.order_by('codigo').values_list('codigo', 'status', 'percentual_cashback')),
+                         [("710000", "V", 10), ("710002", "V", 10)])
+        self.assertEqual(VendasDiarias.total_periodo(self.vendedor.id, self.hoje), Decimal(500))
+
+    def test_uma_consulta_de_vendedores_por_lote_e_um_recalculo_por_vendedor(self):
+        linhas = [[f"72{i:04}", "100", self.hoje.isoformat(), cpf, ""]
+                  for i, cpf in enumerate(["35770006005", "87103564019"] * 5)]
+        caminho = self.escrever_csv(linhas)
+        with CaptureQueriesContext(connection) as consultas, \
+                patch.object(Compra, 'atualizar_percentual_cashback',
+                             wraps=Compra.atualizar_percentual_cashback) as atualizar:
+            self.importar(caminho, lote=4)
+        consultas_vendedores = [q for q in consultas.captured_queries
+                                if q['sql'].startswith('SELECT') and 'FROM "cashback_vendedor"' in q['sql']]
+        # Os vendedores do primeiro lote ficam em memória para os lotes seguintes
+        self.assertEqual(len(consultas_vendedores), 1)
+        inserts = [q for q in consultas.captured_queries if q['sql'].startswith('INSERT INTO "cashback_compra"')]
+        self.assertEqual(len(inserts), 3)
+        self.assertEqual(sorted(chamada.args[0] for chamada in atualizar.call_args_list),
+                         sorted([self.vendedor.id, self.outro_vendedor.id]))
+        self.assertEqual(set(Compra.objects.values_list('percentual_cashback', flat=True)), {10})
+
+    def test_data_no_inicio_do_horario_de_verao(self):
+        # A meia-noite de 04/11/2018 não existe em America/Sao_Paulo
+        caminho = self.escrever_csv([["730000", "100", "2018-11-04", "35770006005", ""]])
+        saida, _ = self.importar(caminho)
+        self.assertIn("1 linhas lidas, 1 inseridas", saida)
+        self.assertEqual(localdate(Compra.objects.get(codigo="730000").data).isoformat(), "2018-11-04")
+
+    def test_erro_no_meio_do_arquivo_recalcula_os_lotes_gravados(self):
+        linhas = [[f"74{i:04}", "600", self.hoje.isoformat(), "35770006005", ""] for i in range(4)]
+        caminho = self.escrever_csv(linhas)
+        importar_lote = Command.importar_lote
+        lotes = []
+
+        def falhar_no_segundo_lote(comando, lote):
+            lotes.append(lote)
+            if len(lotes) == 2:
+                raise RuntimeError("falha inesperada")
+            return importar_lote(comando, lote)
+
+        with patch.object(Command, 'importar_lote', falhar_no_segundo_lote), \
+                self.assertRaisesMessage(RuntimeError, "falha inesperada"):
+            self.importar(caminho, lote=2)
+        # O primeiro lote (2 x 600) foi gravado e recalculado para a faixa de 15%
+        self.assertEqual(list(Compra.objects.values_list('percentual_cashback', flat=True)), [15, 15])
+
+    def test_formato_pela_extensao(self):
+        caminho = self.diretorio / 'compras.txt'
+        caminho.write_text("codigo,valor,data,cpf\n", encoding='utf-8')
+        with self.assertRaisesMessage(CommandError, "Formato não suportado: 'txt'"):
+            self.importar(str(caminho))
+        saida, _ = self.importar(str(caminho), formato='csv')
+        self.assertIn("0 linhas lidas", saida)
+
+
+class PlanoDeConsultaTests(TestCase):
+    """Garante que as consultas mais frequentes continuam usando o índice (vendedor, data)"""
+
+    def setUp(self):
+        self.vendedor = Vendedor.objects.create(cpf="35770006005", username="vendedor")
+        self.indice = 'compra_vendedor_data_idx'
+
+    def test_janela_de_30_dias_usa_indice(self):
+        plano = Compra.compras_do_periodo(self.vendedor.id).explain()
+        self.assertIn(self.indice, plano)
+
+    def test_janela_de_30_dias_nao_aplica_funcao_na_coluna(self):
+        sql = str(Compra.compras_do_periodo(self.vendedor.id).query)
+        self.assertNotIn("django_datetime_cast_date", sql)
+
+    def test_listagem_ordenada_usa_indice_sem_ordenacao_temporaria(self):
+        plano = self.vendedor.compras.order_by('-data').explain()
+        self.assertIn(self.indice, plano)
+        self.assertNotIn("TEMP B-TREE", plano)
+
+    def plano_listagem(self, **filtros):
+        filtro = ComprasFilter(filtros, queryset=CompraListagemSerializer.queryset(self.vendedor))
+        self.assertTrue(filtro.is_valid(), filtro.errors)
+        return filtro.qs.explain()
+
+    def test_filtro_por_status_usa_indice_sem_ordenacao_temporaria(self):
+        plano = self.plano_listagem(status='A', data_inicio='2026-01-01', data_fim='2026-01-31')
+        self.assertIn('compra_vendedor_status_idx', plano)
+        self.assertIn('data>? AND data<?', plano.replace('"', ''))
+        self.assertNotIn("TEMP B-TREE", plano)
+
+    def test_filtro_por_periodo_usa_indice_sem_ordenacao_temporaria(self):
+        plano = self.plano_listagem(data_inicio='2026-01-01', data_fim='2026-01-31')
+        self.assertIn(self.indice, plano)
+        self.assertIn('data>? AND data<?', plano.replace('"', ''))
+        self.assertNotIn("TEMP B-TREE", plano)
+
+    def test_janela_de_30_dias_inclui_inicio_do_periodo(self):
+        trinta_dias = now() - timedelta(days=30)
+        trinta_e_um_dias = now() - timedelta(days=31)
+        Compra.objects.create(codigo="567890", vendedor=self.vendedor, valor=Decimal(10), data=trinta_dias)
+        Compra.objects.create(codigo="567891", vendedor=self.vendedor, valor=Decimal(10), data=trinta_e_um_dias)
+        codigos = list(Compra.compras_do_periodo(self.vendedor.id).values_list("codigo", flat=True))
+        self.assertEqual(codigos, ["567890"])
+
+    def test_janela_de_30_dias_comecando_no_inicio_do_horario_de_verao(self):
+        # A meia-noite de 04/11/2018 não existe em America/Sao_Paulo
+        for codigo, data in (("567890", "2018-11-03T23:30:00-03:00"), ("567891", "2018-11-04T01:00:00-02:00")):
+            Compra.objects.create(codigo=codigo, vendedor=self.vendedor, valor=Decimal(10),
+                                  data=datetime.fromisoformat(data))
+        with patch('cashback.models.timezone_today', return_value=date(2018, 12, 4)):
+            codigos = list(Compra.compras_do_periodo(self.vendedor.id).values_list("codigo", flat=True))
+        self.assertEqual(codigos, ["567891"])
+
 
 class UtilsTests(TestCase):
 
@@ -215,6 +627,65 @@ class UtilsTests(TestCase):
         self.assertEqual(digito_mod11(cpf_magico[:10]), cpf_magico[10])
 
 
+class ValidacaoCPFTests(TestCase):
+    """A validação memoizada e em lote deve retornar exatamente o mesmo que o algoritmo original"""
+
+    @staticmethod
+    def sanitizar_cpf_original(cpf):
+        if not cpf:
+            return None
+        algarismos = list(map(int, filter(lambda c: c in digits, cpf)))
+        if len(algarismos) != 11:
+            return None
+        cpf_calculado = algarismos[:9]
+        for i in range(9, 11):
+            digito = digito_mod11(cpf_calculado)
+            cpf_calculado.append(digito)
+            if digito != algarismos[i]:
+                return None
+        return ''.join(map(str, cpf_calculado))
+
+    @classmethod
+    def gerar_amostra(cls):
+        aleatorio = random.Random(42)
+        amostra = ['', None, '15350946056', '153.509.460-56', '000.000.000-00', '1535094605', '153509460561',
+                   '15350946057', '١٥٣٥٠٩٤٦٠٥٦', '153.509.460-5６', ' 153 509 460 56 ', 'abc15350946056xyz']
+        for _ in range(3000):
+            base = [aleatorio.randint(0, 9) for _ in range(9)]
+            base.append(digito_mod11(base))
+            base.append(digito_mod11(base))
+            if aleatorio.random() < 0.3:
+                base[aleatorio.randrange(11)] = aleatorio.randint(0, 9)
+            cpf = ''.join(map(str, base))
+            if aleatorio.random() < 0.5:
+                cpf = f'{cpf[:3]}.{cpf[3:6]}.{cpf[6:9]}-{cpf[9:]}'
+            if aleatorio.random() < 0.1:
+                cpf = cpf[:aleatorio.randrange(len(cpf))]
+            amostra.append(cpf)
+        return amostra
+
+    def setUp(self):
+        self.amostra = self.gerar_amostra()
+        self.esperado = [self.sanitizar_cpf_original(cpf) for cpf in self.amostra]
+
+    def test_sanitizar_cpf_equivalente(self):
+        self.assertEqual([sanitizar_cpf(cpf) for cpf in self.amostra], self.esperado)
+
+    def test_vendedor_sanitizar_cpf_equivalente(self):
+        self.assertEqual([Vendedor.sanitizar_cpf(cpf) for cpf in self.amostra], self.esperado)
+
+    def test_validar_cpfs_equivalente_sem_numpy(self):
+        self.assertEqual(validar_cpfs(self.amostra, vetorizar=False), self.esperado)
+
+    @skipUnless(find_spec("numpy"), "numpy não instalado")
+    def test_validar_cpfs_equivalente_com_numpy(self):
+        self.assertEqual(validar_cpfs(self.amostra, vetorizar=True), self.esperado)
+
+    def test_validar_cpfs_vazio(self):
+        self.assertEqual(validar_cpfs([]), [])
+        self.assertEqual(validar_cpfs(['123', None]), [None, None])
+
+
 class ChoiceFieldTest(TestCase):
     def test_to_representation_allow_blank(self):
         field = ChoiceField(choices=(), allow_blank=True)
@@ -230,6 +701,41 @@ class ChoiceFieldTest(TestCase):
         self.assertEqual(field.to_representation(value), value)
 
 
+class CompraListagemSerializerTest(TestCase):
+    def setUp(self):
+        self.vendedor = Vendedor.objects.create(cpf="15350946056", username="vendedor")
+        aleatorio = random.Random(42)
+        inicio = now()
+        for i in range(60):
+            Compra.objects.create(codigo=f"{i:06}", vendedor=self.vendedor,
+                                  valor=Decimal(aleatorio.randint(1, 99999999)) / 100,
+                                  data=inicio - timedelta(days=aleatorio.randint(0, 29),
+                                                          microseconds=aleatorio.randint(0, 999999)))
+        # Sem microssegundos e com status diferente do inicial
+        Compra.objects.filter(codigo="000000").update(data=inicio.replace(microsecond=0), status='A')
+
+    def renderizar(self, data):
+        return JSONRenderer().render(data)
+
+    def test_json_identico_ao_compra_serializer(self):
+        compras = self.vendedor.compras.order_by('-data')
+        esperado = self.renderizar(CompraSerializer(compras, many=True).data)
+        linhas = CompraListagemSerializer.queryset(self.vendedor)
+        self.assertEqual(self.renderizar(CompraListagemSerializer(linhas, self.vendedor.cpf).data), esperado)
+
+    def test_json_identico_em_outro_fuso(self):
+        compras = self.vendedor.compras.order_by('-data')
+        with timezone.override('America/Sao_Paulo'):
+            esperado = self.renderizar(CompraSerializer(compras, many=True).data)
+            linhas = CompraListagemSerializer.queryset(self.vendedor)
+            self.assertEqual(self.renderizar(CompraListagemSerializer(linhas, self.vendedor.cpf).data), esperado)
+
+    def test_busca_apenas_colunas_da_listagem(self):
+        with CaptureQueriesContext(connection) as queries:
+            list(CompraListagemSerializer.queryset(self.vendedor))
+        self.assertNotIn('"cashback_compra"."vendedor_id"', queries[0]['sql'].split('FROM')[0])
+
+
 class SaldoAPITest(TestCase):
 
     def setUp(self):
@@ -277,6 +783,510 @@ class SaldoAPITest(TestCase):
             request_mocker.get('http://test.com/v1/cashback', json=mocked_response)
             self.assertAlmostEqual(self.client.get_saldo(self.cpf), 23.45)
 
+    def test_log_de_debug_somente_com_nivel_habilitado(self):
+        logger = logging.getLogger('core')
+        with Mocker() as request_mocker, patch.object(logger, 'debug') as debug:
+            request_mocker.get('http://test.com/v1/cashback', status_code=400, text="erro")
+            self.client.get_saldo(self.cpf)
+            debug.assert_not_called()
+
+            nivel = logger.level
+            logger.setLevel(logging.DEBUG)
+            self.addCleanup(logger.setLevel, nivel)
+            self.client.get_saldo(self.cpf)
+            debug.assert_called_once()
+            self.assertEqual(debug.call_args.kwargs["extra"]["body"], b"erro")
+
+
+class SaldoAPIStub:
+    """
+    Servidor HTTP local que simula o SaldoAPI.
+    Registra as requisições recebidas e as conexões (porta de origem) utilizadas.
+    """
+
+    def __init__(self, credit=2345, atraso=0, status_codes=None):
+        self.credit = credit
+        self.atraso = atraso
+        self.status_codes = list(status_codes or [])
+        self.requisicoes = []
+        self.conexoes = set()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Mantém a conexão aberta (keep-alive)
+
+            def do_GET(self):
+                stub.requisicoes.append(self.path)
+                stub.conexoes.add(self.client_address)
+                if stub.atraso:
+                    sleep(stub.atraso)
+                status_code = stub.status_codes.pop(0) if stub.status_codes else 200
+                body = json.dumps({"statusCode": 200, "body": {"credit": stub.credit}}).encode()
+                self.send_response(status_code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def __enter__(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SaldoAPIPoolTest(TestCase):
+
+    def test_cliente_compartilhado_pelo_processo(self):
+        self.assertIs(get_saldo_api(), get_saldo_api())
+
+    def test_cliente_recriado_quando_configuracao_muda(self):
+        cliente = get_saldo_api()
+        with self.settings(SALDO_API='http://example.com'):
+            self.assertIsNot(get_saldo_api(), cliente)
+            self.assertEqual(get_saldo_api().base_url, 'http://example.com')
+
+    def test_reaproveita_conexao_entre_requisicoes(self):
+        with SaldoAPIStub() as stub, self.settings(SALDO_API=stub.url, SALDO_CACHE_TTL=0):
+            for _ in range(5):
+                self.assertAlmostEqual(get_saldo_api().get_saldo("15350946056"), Decimal("23.45"))
+        self.assertEqual(len(stub.requisicoes), 5)
+        self.assertEqual(len(stub.conexoes), 1)
+
+    def test_timeout_de_leitura_retorna_none(self):
+        with SaldoAPIStub(atraso=0.5) as stub, self.settings(SALDO_API=stub.url, SALDO_API_TIMEOUT_LEITURA=0.1):
+            inicio = perf_counter()
+            self.assertIsNone(get_saldo_api().get_saldo("15350946056"))
+            self.assertLess(perf_counter() - inicio, 0.5)
+        self.assertEqual(len(stub.requisicoes), 1)
+
+    def test_retentativa_com_backoff_em_erro_do_servidor(self):
+        with SaldoAPIStub(status_codes=[503, 503]) as stub, self.settings(SALDO_API=stub.url, SALDO_API_BACKOFF=0):
+            self.assertAlmostEqual(get_saldo_api().get_saldo("15350946056"), Decimal("23.45"))
+        self.assertEqual(len(stub.requisicoes), 3)
+
+    def test_retentativas_limitadas(self):
+        with SaldoAPIStub(status_codes=[503] * 10) as stub, \
+                self.settings(SALDO_API=stub.url, SALDO_API_BACKOFF=0, SALDO_API_RETENTATIVAS=1):
+            self.assertIsNone(get_saldo_api().get_saldo("15350946056"))
+        self.assertEqual(len(stub.requisicoes), 2)
+
+
+class MemoriaLRUTest(TestCase):
+
+    def test_descarta_item_usado_ha_mais_tempo(self):
+        backend = MemoriaLRU(max_itens=2)
+        backend.set("a", 1, 60)
+        backend.set("b", 2, 60)
+        backend.get("a")
+        backend.set("c", 3, 60)
+        self.assertEqual(backend.get("a"), 1)
+        self.assertIsNone(backend.get("b"))
+        self.assertEqual(backend.get("c"), 3)
+
+    def test_item_expirado(self):
+        backend = MemoriaLRU(max_itens=2)
+        backend.set("a", 1, 0)
+        self.assertIsNone(backend.get("a"))
+
+
+class SaldoCacheTest(TestCase):
+
+    def setUp(self):
+        self.cpf = "15350946056"
+        self.consultas = []
+
+    def consultar(self, cpf):
+        self.consultas.append(cpf)
+        return Decimal(len(self.consultas))
+
+    def test_hit_e_miss(self):
+        cache = SaldoCache(MemoriaLRU(10), ttl=60)
+        self.assertEqual(cache.obter(self.cpf, self.consultar), 1)
+        self.assertEqual(cache.obter(self.cpf, self.consultar), 1)
+        self.assertEqual(self.consultas, [self.cpf])
+        self.assertEqual(cache.estatisticas(), {"hits": 1, "misses": 1, "stale": 0})
+
+    def test_estatisticas_com_varias_threads(self):
+        cache = SaldoCache(MemoriaLRU(10), ttl=60)
+        cache.obter(self.cpf, self.consultar)
+        barreira = Barrier(8)
+
+        def consultar_varias_vezes():
+            barreira.wait()
+            for _ in range(2000):
+                cache.obter(self.cpf, self.consultar)
+
+        threads = [Thread(target=consultar_varias_vezes) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache.estatisticas(), {"hits": 8 * 2000, "misses": 1, "stale": 0})
+
+    def test_ttl_zero_desabilita_cache(self):
+        cache = SaldoCache(MemoriaLRU(10), ttl=0)
+        cache.obter(self.cpf, self.consultar)
+        cache.obter(self.cpf, self.consultar)
+        self.assertEqual(len(self.consultas), 2)
+
+    def test_falha_nao_e_guardada(self):
+        cache = SaldoCache(MemoriaLRU(10), ttl=60)
+        self.assertIsNone(cache.obter(self.cpf, lambda cpf: None))
+        self.assertEqual(cache.obter(self.cpf, self.consultar), 1)
+
+    def test_serve_valor_antigo_e_atualiza_em_background(self):
+        cache = SaldoCache(MemoriaLRU(10), ttl=60, stale=60)
+        cache.backend.set(cache.chave(self.cpf), (Decimal(10), 0), 60)  # Criado há muito tempo
+        self.assertEqual(cache.obter(self.cpf, self.consultar), 10)
+        for thread in list(cache.atualizacoes.values()):
+            thread.join()
+        self.assertEqual(cache.obter(self.cpf, self.consultar), 1)
+        self.assertEqual(cache.estatisticas(), {"hits": 1, "misses": 0, "stale": 1})
+
+    def test_invalidar(self):
+        cache = SaldoCache(MemoriaLRU(10), ttl=60)
+        cache.obter(self.cpf, self.consultar)
+        cache.invalidar(self.cpf)
+        self.assertEqual(cache.obter(self.cpf, self.consultar), 2)
+
+    def test_consulta_iniciada_antes_da_invalidacao_nao_e_guardada(self):
+        cache = SaldoCache(MemoriaLRU(10), ttl=60)
+
+        def consultar_durante_a_compra(cpf):
+            # A compra invalida o cache enquanto o SaldoAPI ainda responde com o saldo anterior
+            cache.invalidar(cpf)
+            return Decimal(10)
+
+        self.assertEqual(cache.obter(self.cpf, consultar_durante_a_compra), 10)
+        self.assertEqual(cache.obter(self.cpf, self.consultar), 1)
+        self.assertEqual(cache.obter(self.cpf, self.consultar), 1)
+
+    def test_atualizacao_em_background_depois_da_invalidacao_nao_e_guardada(self):
+        cache = SaldoCache(MemoriaLRU(10), ttl=60, stale=60)
+        cache.backend.set(cache.chave(self.cpf), (Decimal(10), 0), 60)  # Criado há muito tempo
+        consultando = Event()
+        compra_registrada = Event()
+
+        def consultar_lento(cpf):
+            consultando.set()
+            compra_registrada.wait(5)
+            return Decimal(10)
+
+        self.assertEqual(cache.obter(self.cpf, consultar_lento), 10)
+        consultando.wait(5)
+        cache.invalidar(self.cpf)
+        compra_registrada.set()
+        for thread in list(cache.atualizacoes.values()):
+            thread.join()
+        self.assertEqual(cache.obter(self.cpf, self.consultar), 1)
+
+    def test_atualizacao_assincrona_depois_da_invalidacao_nao_e_guardada(self):
+        cache = SaldoCache(MemoriaLRU(10), ttl=60)
+
+        async def consultar_durante_a_compra(cpf):
+            cache.invalidar(cpf)
+            return Decimal(10)
+
+        async def obter():
+            return await cache.obter_async(self.cpf, consultar_durante_a_compra)
+
+        self.assertEqual(async_to_sync(obter)(), 10)
+        self.assertIsNone(cache.consultar_cache(self.cpf))
+
+    def test_assincrono_com_cache_do_django_fora_do_event_loop(self):
+        threads = []
+
+        class CacheDjangoRegistrado(CacheDjango):
+            def get(self, chave):
+                threads.append(get_ident())
+                return super().get(chave)
+
+            def set(self, chave, valor, timeout):
+                threads.append(get_ident())
+                super().set(chave, valor, timeout)
+
+        cache = SaldoCache(CacheDjangoRegistrado('default'), ttl=60)
+        cache.invalidar(self.cpf)
+        threads.clear()
+
+        async def consultar(cpf):
+            return Decimal(1)
+
+        async def obter():
+            return get_ident(), await cache.obter_async(self.cpf, consultar), await cache.obter_async(self.cpf, consultar)
+
+        thread_do_loop, primeiro, segundo = async_to_sync(obter)()
+        self.assertEqual((primeiro, segundo), (1, 1))
+        # consultar_cache, geração, guardar (geração, set, geração) e consultar_cache
+        self.assertEqual(len(threads), 6)
+        self.assertNotIn(thread_do_loop, threads)
+        cache.invalidar(self.cpf)
+
+    def test_backend_django_cache(self):
+        cache = SaldoCache(CacheDjango('default'), ttl=60)
+        cache.invalidar(self.cpf)
+        cache.obter(self.cpf, self.consultar)
+        self.assertEqual(SaldoCache(CacheDjango('default'), ttl=60).obter(self.cpf, self.consultar), 1)
+        cache.invalidar(self.cpf)
+
+    def test_cliente_usa_cache(self):
+        with SaldoAPIStub() as stub, self.settings(SALDO_API=stub.url):
+            get_saldo_api().get_saldo(self.cpf)
+            get_saldo_api().get_saldo(self.cpf)
+        self.assertEqual(len(stub.requisicoes), 1)
+
+
+class SaldoCacheInvalidacaoTest(TransactionTestCase):
+
+    def test_compra_invalida_saldo_do_vendedor(self):
+        cpf = "15350946056"
+        vendedor = Vendedor.objects.create(cpf=cpf, username="vendedor")
+        with SaldoAPIStub() as stub, self.settings(SALDO_API=stub.url):
+            get_saldo_api().get_saldo(cpf)
+            Compra.objects.create(codigo="800000", vendedor=vendedor, valor=Decimal(10))
+            get_saldo_api().get_saldo(cpf)
+        self.assertEqual(len(stub.requisicoes), 2)
+
+
+class SingleFlightTest(TestCase):
+
+    def executar_concorrente(self, quantidade, funcao):
+        barreira = Barrier(quantidade)
+        resultados = []
+
+        def chamar():
+            barreira.wait()
+            resultados.append(funcao())
+
+        threads = [Thread(target=chamar) for _ in range(quantidade)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return resultados
+
+    def test_chamadas_concorrentes_compartilham_resultado(self):
+        single_flight = SingleFlight()
+        chamadas = []
+
+        def consultar():
+            chamadas.append(1)
+            sleep(0.2)
+            return len(chamadas)
+
+        resultados = self.executar_concorrente(10, lambda: single_flight.executar("cpf", consultar))
+        self.assertEqual(len(chamadas), 1)
+        self.assertEqual(resultados, [1] * 10)
+        self.assertEqual(single_flight.chamadas, {})
+
+    def test_erro_e_repassado_para_todos(self):
+        single_flight = SingleFlight()
+
+        def consultar():
+            sleep(0.1)
+            raise ValueError("falha")
+
+        def chamar():
+            try:
+                single_flight.executar("cpf", consultar)
+            except ValueError as ex:
+                return str(ex)
+
+        self.assertEqual(self.executar_concorrente(5, chamar), ["falha"] * 5)
+
+    def test_chamadas_sequenciais_nao_sao_agrupadas(self):
+        single_flight = SingleFlight()
+        self.assertEqual(single_flight.executar("cpf", lambda: 1), 1)
+        self.assertEqual(single_flight.executar("cpf", lambda: 2), 2)
+
+    def test_consultas_concorrentes_ao_saldo_api_fazem_uma_requisicao(self):
+        with SaldoAPIStub(atraso=0.3) as stub, self.settings(SALDO_API=stub.url, SALDO_CACHE_TTL=0):
+            cliente = get_saldo_api()
+            resultados = self.executar_concorrente(8, lambda: cliente.get_saldo("15350946056"))
+        self.assertEqual(len(stub.requisicoes), 1)
+        self.assertEqual(len(resultados), 8)
+        self.assertEqual(len(set(resultados)), 1)
+        self.assertAlmostEqual(resultados[0], Decimal("23.45"))
+
+    @skipUnless(find_spec("eventlet"), "eventlet não instalado")
+    def test_agrupa_greenlets_com_eventlet(self):
+        # Roda em outro processo pois o monkey patch do eventlet é global, como no worker do gunicorn
+        script = """
+import eventlet
+eventlet.monkey_patch()
+from time import sleep
+from cashback.client import SingleFlight
+single_flight = SingleFlight()
+chamadas = []
+def consultar():
+    chamadas.append(1)
+    sleep(0.2)
+    return 42
+pool = eventlet.GreenPool()
+resultados = list(pool.imap(lambda _: single_flight.executar("cpf", consultar), range(20)))
+print(len(chamadas), sum(resultados))
+"""
+        with tempfile.TemporaryDirectory() as diretorio:
+            env = dict(os.environ, DJANGO_SETTINGS_MODULE="boticario.settings",
+                       DATABASE_NAME=os.path.join(diretorio, 'db.sqlite3'))
+            saida = subprocess.run([sys.executable, "-W", "ignore", "-c", script], capture_output=True, text=True,
+                                   cwd=settings.BASE_DIR, env=env, timeout=60)
+        self.assertEqual(saida.stdout.split(), ["1", str(42 * 20)], saida.stderr)
+
+
+class CircuitBreakerTest(TestCase):
+
+    def setUp(self):
+        self.agora = 0
+        self.circuito = CircuitBreaker(limite_falhas=3, tempo_aberto=10, tentativas_semiaberto=1,
+                                       relogio=lambda: self.agora)
+
+    def falhar(self, vezes=1):
+        for _ in range(vezes):
+            self.circuito.verificar()
+            self.circuito.registrar_falha()
+
+    def abrir(self):
+        self.falhar(3)
+
+    def test_abre_apos_falhas_consecutivas(self):
+        self.falhar(2)
+        self.assertEqual(self.circuito.estado, CircuitBreaker.FECHADO)
+        self.falhar()
+        self.assertEqual(self.circuito.estado, CircuitBreaker.ABERTO)
+
+    def test_sucesso_zera_falhas(self):
+        self.falhar(2)
+        self.circuito.verificar()
+        self.circuito.registrar_sucesso()
+        self.falhar(2)
+        self.assertEqual(self.circuito.estado, CircuitBreaker.FECHADO)
+        self.assertEqual(self.circuito.falhas_consecutivas, 2)
+
+    def test_aberto_falha_imediatamente(self):
+        self.abrir()
+        with self.assertRaises(CircuitoAberto):
+            self.circuito.verificar()
+        self.assertEqual(self.circuito.inspecionar()["rejeitadas"], 1)
+
+    def test_semiaberto_permite_tentativas_limitadas(self):
+        self.abrir()
+        self.agora = 10
+        self.assertTrue(self.circuito.permitir())
+        self.assertEqual(self.circuito.estado, CircuitBreaker.SEMIABERTO)
+        self.assertFalse(self.circuito.permitir())
+
+    def test_semiaberto_sucesso_fecha(self):
+        self.abrir()
+        self.agora = 10
+        self.circuito.verificar()
+        self.circuito.registrar_sucesso()
+        self.assertEqual(self.circuito.inspecionar(), {"estado": CircuitBreaker.FECHADO, "falhas_consecutivas": 0,
+                                                       "aberto_ha": None, "rejeitadas": 0})
+
+    def test_semiaberto_falha_abre_novamente(self):
+        self.abrir()
+        self.agora = 10
+        self.falhar()
+        self.assertEqual(self.circuito.estado, CircuitBreaker.ABERTO)
+        self.agora = 15
+        self.assertFalse(self.circuito.permitir())
+        self.assertEqual(self.circuito.inspecionar()["aberto_ha"], 5)
+
+
+class SaldoAPICircuitoTest(TestCase):
+
+    def setUp(self):
+        self.cpf = "15350946056"
+        self.configuracao = dict(SALDO_CACHE_TTL=0, SALDO_API_RETENTATIVAS=0, SALDO_API_CIRCUITO_FALHAS=2,
+                                 SALDO_API_CIRCUITO_TEMPO_ABERTO=0.3)
+
+    def test_circuito_aberto_nao_chama_upstream_e_retorna_ultimo_saldo(self):
+        with SaldoAPIStub(status_codes=[200, 500, 500]) as stub, self.settings(SALDO_API=stub.url, **self.configuracao):
+            cliente = get_saldo_api()
+            ultimo_saldo = cliente.get_saldo(self.cpf)
+            self.assertIsNone(cliente.get_saldo(self.cpf))
+            self.assertIsNone(cliente.get_saldo(self.cpf))
+            self.assertEqual(cliente.circuito.estado, CircuitBreaker.ABERTO)
+
+            inicio = perf_counter()
+            self.assertEqual(cliente.get_saldo(self.cpf), ultimo_saldo)
+            self.assertLess(perf_counter() - inicio, 0.1)
+            self.assertEqual(len(stub.requisicoes), 3)
+
+            # Depois do tempo aberto a chamada de teste vai ao upstream (que já se recuperou) e fecha o circuito
+            sleep(0.3)
+            self.assertEqual(cliente.get_saldo(self.cpf), ultimo_saldo)
+            self.assertEqual(len(stub.requisicoes), 4)
+            self.assertEqual(cliente.circuito.estado, CircuitBreaker.FECHADO)
+
+    def test_circuito_aberto_sem_ultimo_saldo_retorna_none(self):
+        with SaldoAPIStub(status_codes=[500, 500]) as stub, \
+                self.settings(SALDO_API=stub.url, SALDO_API_CIRCUITO_ULTIMO_SALDO=False, **self.configuracao):
+            cliente = get_saldo_api()
+            cliente.get_saldo(self.cpf)
+            cliente.get_saldo(self.cpf)
+            self.assertIsNone(cliente.get_saldo(self.cpf))
+        self.assertEqual(len(stub.requisicoes), 2)
+
+    def test_erros_de_um_cpf_nao_abrem_o_circuito(self):
+        url = f'http://saldo/v1/cashback?cpf={self.cpf}'
+        with Mocker() as mock, self.settings(SALDO_API='http://saldo', **self.configuracao):
+            cliente = get_saldo_api()
+            mock.get(url, [{'status_code': 404}, {'status_code': 400},
+                           {'json': {"statusCode": 400, "body": {"message": "CPF inválido"}}}])
+            for _ in range(3):
+                self.assertIsNone(cliente.get_saldo(self.cpf))
+            self.assertEqual(cliente.circuito.estado, CircuitBreaker.FECHADO)
+            self.assertEqual(cliente.circuito.falhas_consecutivas, 0)
+
+            # Timeout e 5xx indicam indisponibilidade do serviço
+            mock.get(url, [{'exc': ConnectTimeout}, {'status_code': 503}])
+            cliente.get_saldo(self.cpf)
+            cliente.get_saldo(self.cpf)
+            self.assertEqual(cliente.circuito.estado, CircuitBreaker.ABERTO)
+
+    def test_excecao_inesperada_conta_como_falha(self):
+        with self.settings(SALDO_API='http://saldo', **self.configuracao):
+            cliente = get_saldo_api()
+            with patch.object(cliente, 'requisitar_saldo', side_effect=ValueError):
+                for _ in range(2):
+                    with self.assertRaises(ValueError):
+                        cliente.get_saldo(self.cpf)
+            self.assertEqual(cliente.circuito.estado, CircuitBreaker.ABERTO)
+
+    def test_cliente_assincrono_erro_4xx_nao_abre_o_circuito(self):
+        with SaldoAPIStub(status_codes=[404, 404, 404]) as stub, self.settings(SALDO_API=stub.url, **self.configuracao):
+            async def consultar():
+                return await get_saldo_api_async().get_saldo(self.cpf)
+
+            for _ in range(3):
+                self.assertIsNone(async_to_sync(consultar)())
+            self.assertEqual(get_saldo_api().circuito.estado, CircuitBreaker.FECHADO)
+        self.assertEqual(len(stub.requisicoes), 3)
+
+    def test_cliente_assincrono_compartilha_circuito(self):
+        with SaldoAPIStub(status_codes=[500, 500]) as stub, self.settings(SALDO_API=stub.url, **self.configuracao):
+            cliente = get_saldo_api()
+            cliente.get_saldo(self.cpf)
+            cliente.get_saldo(self.cpf)
+
+            async def consultar():
+                return await get_saldo_api_async().get_saldo(self.cpf)
+
+            self.assertIsNone(async_to_sync(consultar)())
+        self.assertEqual(len(stub.requisicoes), 2)
+
 
 class APITest(TestCase):
 
@@ -295,7 +1305,7 @@ class APITest(TestCase):
         if not vendedor:
             vendedor = Vendedor.objects.create_user(username='Foo', email='foo@example.com', password='foo@bar',
                                                     cpf=cpf)
-        refresh = RefreshToken.for_user(vendedor)
+        refresh = VendedorRefreshToken.for_user(vendedor)
         client.credentials(HTTP_AUTHORIZATION=f'Bearer {refresh.access_token}')
 
     def test_criar_vendedor_sucesso(self):
@@ -489,6 +1499,105 @@ class APITest(TestCase):
         self.assertIn("cashback", data)
         self.assertIn("valor", data)
 
+    def test_compra_lote_precisa_de_login(self):
+        response = self.client.post('/v1/compra/lote', [self.payload_compra], format="json")
+        self.assertEqual(response.status_code, 401)
+
+    def test_compra_lote_sucesso_recalcula_percentual_do_lote(self):
+        self.autenticate_client()
+        payload = [{"codigo": f"70000{i}", "valor": "300", "cpf": "153.509.460-56"} for i in range(4)]
+        response = self.client.post('/v1/compra/lote', payload, format="json")
+        data = response.json()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(data["erros"], [])
+        self.assertEqual(len(data["compras"]), 4)
+        # Total do lote é 1200, portanto todas as compras ficam com 15%
+        self.assertEqual({compra["percentual_cashback"] for compra in data["compras"]}, {15})
+        self.assertEqual(Compra.objects.filter(percentual_cashback=15).count(), 4)
+        self.assertEqual(VendasDiarias.objects.get().total, 1200)
+
+    def test_compra_lote_erros_por_item_sem_abortar_validos(self):
+        self.autenticate_client()
+        vendedor = Vendedor.objects.get(cpf="15350946056")
+        Compra.objects.create(codigo="700000", vendedor=vendedor, valor=Decimal(10))
+        payload = [
+            {"codigo": "700000", "valor": "100", "cpf": "15350946056"},  # Código já existente
+            {"codigo": "700001", "valor": "100", "cpf": "123"},  # CPF inválido
+            {"codigo": "700002", "valor": "100", "cpf": "15350946056"},
+            {"codigo": "700002", "valor": "100", "cpf": "15350946056"},  # Código repetido no lote
+            {"codigo": "700003", "valor": "100", "cpf": "15350946056",
+             "data": (now() - timedelta(days=31)).isoformat()},  # Mais de 30 dias
+        ]
+        response = self.client.post('/v1/compra/lote', payload, format="json")
+        data = response.json()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([compra["codigo"] for compra in data["compras"]], ["700002"])
+        self.assertEqual([erro["indice"] for erro in data["erros"]], [0, 1, 3, 4])
+        self.assertEqual(data["erros"][1]["erros"], {"cpf": ["CPF 123 inválido"]})
+        self.assertEqual(Compra.objects.count(), 2)
+
+    def test_compra_lote_conflito_de_codigo_concorrente_grava_os_demais(self):
+        self.autenticate_client()
+        vendedor = Vendedor.objects.get(cpf="15350946056")
+        criar_em_lote = Compra.criar_em_lote
+
+        def outra_requisicao_grava_primeiro(compras):
+            if not Compra.objects.filter(codigo="700001").exists():
+                Compra.objects.create(codigo="700001", vendedor=vendedor, valor=Decimal(10))
+            return criar_em_lote(compras)
+
+        payload = [
+            {"codigo": "700000", "valor": "300", "cpf": "15350946056"},
+            {"codigo": "700001", "valor": "300", "cpf": "15350946056"},
+            {"codigo": "700002", "valor": "100", "cpf": "123"},  # CPF inválido
+            {"codigo": "700003", "valor": "300", "cpf": "15350946056"},
+        ]
+        with patch.object(Compra, 'criar_em_lote', side_effect=outra_requisicao_grava_primeiro) as criar:
+            response = self.client.post('/v1/compra/lote', payload, format="json")
+        data = response.json()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(criar.call_count, 2)
+        self.assertEqual([compra["codigo"] for compra in data["compras"]], ["700000", "700003"])
+        self.assertEqual([erro["indice"] for erro in data["erros"]], [1, 2])
+        self.assertIn("codigo", data["erros"][0]["erros"])
+        self.assertEqual(set(Compra.objects.values_list("codigo", flat=True)), {"700000", "700001", "700003"})
+        # O livro de vendas não soma as compras da tentativa desfeita
+        self.assertEqual(VendasDiarias.objects.get().total, 610)
+
+    def test_compra_lote_todos_em_conflito_concorrente_retorna_400(self):
+        self.autenticate_client()
+        vendedor = Vendedor.objects.get(cpf="15350946056")
+        criar_em_lote = Compra.criar_em_lote
+
+        def outra_requisicao_grava_primeiro(compras):
+            Compra.objects.create(codigo="700000", vendedor=vendedor, valor=Decimal(10))
+            return criar_em_lote(compras)
+
+        with patch.object(Compra, 'criar_em_lote', side_effect=outra_requisicao_grava_primeiro):
+            response = self.client.post('/v1/compra/lote', [{"codigo": "700000", "valor": "100", "cpf": "15350946056"}],
+                                        format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["compras"], [])
+        self.assertEqual([erro["indice"] for erro in response.json()["erros"]], [0])
+
+    def test_compra_lote_sem_itens_validos_retorna_400(self):
+        self.autenticate_client()
+        response = self.client.post('/v1/compra/lote', [{"codigo": "700000"}], format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Compra.objects.count(), 0)
+
+    def test_compra_lote_precisa_ser_lista(self):
+        self.autenticate_client()
+        response = self.client.post('/v1/compra/lote', self.payload_compra, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"erro": "É necessário enviar uma lista de compras"})
+
+    def test_compra_lote_tamanho_maximo(self):
+        self.autenticate_client()
+        with self.settings(COMPRA_LOTE_TAMANHO_MAXIMO=1):
+            response = self.client.post('/v1/compra/lote', [self.payload_compra] * 2, format="json")
+        self.assertEqual(response.status_code, 400)
+
     def test_listagem_compras_do_vendedor_precisa_autenticacao(self):
         cpf = '08948135015'
         response = self.client.get(f'/v1/vendedor/{cpf}/compras')
@@ -528,6 +1637,171 @@ class APITest(TestCase):
         self.assertIn("cashback", results[0])
         self.assertIn("status", results[0])
 
+    def criar_compras_listagem(self, cpf, quantidade):
+        vendedor = Vendedor.objects.filter(cpf=cpf).first()
+        data = now()
+        # Duas compras por data para garantir o desempate pelo id
+        Compra.objects.bulk_create(
+            Compra(codigo=f"{i:06}", vendedor=vendedor, valor=Decimal(10), data=data - timedelta(hours=i // 2),
+                   status="V", percentual_cashback=10)
+            for i in range(quantidade)
+        )
+        return list(vendedor.compras.order_by('-data', '-id').values_list('codigo', flat=True))
+
+    def test_listagem_compras_cursor_sem_count(self):
+        cpf = '08948135015'
+        self.autenticate_client(cpf=cpf)
+        self.criar_compras_listagem(cpf, 5)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/v1/vendedor/{cpf}/compras?paginacao=cursor&page_size=2')
+        data = response.json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(data.keys()), {"next", "previous", "results"})
+        self.assertIsNone(data["previous"])
+        self.assertFalse([q for q in queries if "COUNT(" in q["sql"]])
+
+    def test_listagem_compras_cursor_navega_ida_e_volta(self):
+        cpf = '08948135015'
+        self.autenticate_client(cpf=cpf)
+        esperado = self.criar_compras_listagem(cpf, 7)
+
+        paginas = []
+        url = f'/v1/vendedor/{cpf}/compras?paginacao=cursor&page_size=3'
+        while url:
+            data = self.client.get(url).json()
+            paginas.append([compra["codigo"] for compra in data["results"]])
+            url = data["next"]
+        self.assertEqual(paginas, [esperado[0:3], esperado[3:6], esperado[6:7]])
+
+        anterior = self.client.get(data["previous"]).json()
+        self.assertEqual([compra["codigo"] for compra in anterior["results"]], esperado[3:6])
+        primeira = self.client.get(anterior["previous"]).json()
+        self.assertEqual([compra["codigo"] for compra in primeira["results"]], esperado[0:3])
+        self.assertIsNone(primeira["previous"])
+
+    def test_listagem_compras_cursor_invalido(self):
+        cpf = '08948135015'
+        self.autenticate_client(cpf=cpf)
+        response = self.client.get(f'/v1/vendedor/{cpf}/compras?cursor=invalido')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {"detail": "Cursor inválido"})
+
+    def test_listagem_compras_paginacao_por_pagina_continua_padrao(self):
+        cpf = '08948135015'
+        self.autenticate_client(cpf=cpf)
+        self.criar_compras_listagem(cpf, 3)
+        data = self.client.get(f'/v1/vendedor/{cpf}/compras?page=2&page_size=2').json()
+        self.assertEqual(data["count"], 3)
+        self.assertEqual(len(data["results"]), 1)
+
+    def test_listagem_compras_quantidade_de_consultas_independe_da_pagina(self):
+        cpf = '08948135015'
+        self.autenticate_client(cpf=cpf)
+        self.criar_compras_listagem(cpf, 50)
+        # COUNT e a página, a autenticação não consulta o banco
+        for page_size in (1, 10, 50):
+            with self.assertNumQueries(2):
+                response = self.client.get(f'/v1/vendedor/{cpf}/compras?page_size={page_size}')
+            self.assertEqual(len(response.json()["results"]), page_size)
+
+    def test_listagem_compras_cursor_quantidade_de_consultas_independe_da_pagina(self):
+        cpf = '08948135015'
+        self.autenticate_client(cpf=cpf)
+        self.criar_compras_listagem(cpf, 50)
+        # Apenas a página, a autenticação não consulta o banco
+        for page_size in (1, 10, 50):
+            with self.assertNumQueries(1):
+                response = self.client.get(f'/v1/vendedor/{cpf}/compras?paginacao=cursor&page_size={page_size}')
+            self.assertEqual(len(response.json()["results"]), page_size)
+
+    def test_listagem_compras_page_size_invalido_igual_nas_duas_paginacoes(self):
+        cpf = '08948135015'
+        self.autenticate_client(cpf=cpf)
+        self.criar_compras_listagem(cpf, 60)
+        for page_size, esperado in (("0", 10), ("-1", 10), ("abc", 10), ("", 10), ("100", 50)):
+            for paginacao in ("", "&paginacao=cursor"):
+                response = self.client.get(f'/v1/vendedor/{cpf}/compras?page_size={page_size}{paginacao}')
+                self.assertEqual(len(response.json()["results"]), esperado, (page_size, paginacao))
+
+    def test_listagem_compras_cpf_de_cada_compra(self):
+        cpf = '08948135015'
+        self.autenticate_client(cpf=cpf)
+        self.criar_compras_listagem(cpf, 3)
+        data = self.client.get(f'/v1/vendedor/{cpf}/compras').json()
+        self.assertEqual({compra["cpf"] for compra in data["results"]}, {cpf})
+
+    def criar_compras_filtro(self, cpf):
+        vendedor = Vendedor.objects.get(cpf=cpf)
+        hoje = localdate()
+        for i, (dias, status) in enumerate([(0, 'V'), (1, 'A'), (2, 'A'), (3, 'N'), (10, 'A')]):
+            data = timezone.make_aware(datetime.combine(hoje - timedelta(days=dias), datetime.min.time()))
+            Compra.objects.create(codigo=f"95000{i}", vendedor=vendedor, valor=Decimal(10), data=data, status=status)
+        return hoje
+
+    def test_listagem_compras_filtro_por_status(self):
+        cpf = '08948135015'
+        self.autenticate_client(cpf=cpf)
+        self.criar_compras_filtro(cpf)
+        data = self.client.get(f'/v1/vendedor/{cpf}/compras?status=A').json()
+        self.assertEqual([compra["codigo"] for compra in data["results"]], ["950001", "950002", "950004"])
+        self.assertEqual({compra["status"] for compra in data["results"]}, {"Aprovado"})
+
+    def test_listagem_compras_filtro_por_descricao_do_status(self):
+        cpf = '08948135015'
+        self.autenticate_client(cpf=cpf)
+        self.criar_compras_filtro(cpf)
+        for codigo, descricao in (("A", "Aprovado"), ("V", "Em Validação")):
+            por_codigo = self.client.get(f'/v1/vendedor/{cpf}/compras', {"status": codigo}).json()
+            por_descricao = self.client.get(f'/v1/vendedor/{cpf}/compras', {"status": descricao}).json()
+            self.assertTrue(por_descricao["results"])
+            self.assertEqual(por_descricao["results"], por_codigo["results"])
+            self.assertEqual({compra["status"] for compra in por_descricao["results"]}, {descricao})
+
+    def test_listagem_compras_filtro_por_periodo_inclui_extremos(self):
+        cpf = '08948135015'
+        self.autenticate_client(cpf=cpf)
+        hoje = self.criar_compras_filtro(cpf)
+        inicio = (hoje - timedelta(days=3)).isoformat()
+        fim = (hoje - timedelta(days=1)).isoformat()
+        data = self.client.get(f'/v1/vendedor/{cpf}/compras?data_inicio={inicio}&data_fim={fim}').json()
+        self.assertEqual(data["count"], 3)
+        self.assertEqual([compra["codigo"] for compra in data["results"]], ["950001", "950002", "950003"])
+
+    def test_listagem_compras_filtro_no_inicio_do_horario_de_verao(self):
+        # A meia-noite de 04/11/2018 não existe em America/Sao_Paulo
+        cpf = '08948135015'
+        self.autenticate_client(cpf=cpf)
+        vendedor = Vendedor.objects.get(cpf=cpf)
+        for codigo, data in (("960001", "2018-11-03T23:30:00-03:00"), ("960002", "2018-11-04T12:00:00-02:00")):
+            Compra.objects.create(codigo=codigo, vendedor=vendedor, valor=Decimal(10), data=datetime.fromisoformat(data))
+
+        response = self.client.get(f'/v1/vendedor/{cpf}/compras?data_inicio=2018-11-04')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([compra["codigo"] for compra in response.json()["results"]], ["960002"])
+        response = self.client.get(f'/v1/vendedor/{cpf}/compras?data_fim=2018-11-03')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([compra["codigo"] for compra in response.json()["results"]], ["960001"])
+
+    def test_listagem_compras_filtros_combinados_com_cursor(self):
+        cpf = '08948135015'
+        self.autenticate_client(cpf=cpf)
+        hoje = self.criar_compras_filtro(cpf)
+        inicio = (hoje - timedelta(days=5)).isoformat()
+        url = f'/v1/vendedor/{cpf}/compras?status=A&data_inicio={inicio}&paginacao=cursor&page_size=1'
+        with self.assertNumQueries(1):
+            data = self.client.get(url).json()
+        self.assertEqual([compra["codigo"] for compra in data["results"]], ["950001"])
+        data = self.client.get(data["next"]).json()
+        self.assertEqual([compra["codigo"] for compra in data["results"]], ["950002"])
+        self.assertIsNone(data["next"])
+
+    def test_listagem_compras_filtro_invalido(self):
+        cpf = '08948135015'
+        self.autenticate_client(cpf=cpf)
+        response = self.client.get(f'/v1/vendedor/{cpf}/compras?status=X&data_inicio=ontem')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.json().keys()), {"status", "data_inicio"})
+
     def test_listagem_compras_outro_vendedor(self):
         cpf = '08948135015'
         cpf_outro_vendedor = "41615628029"
@@ -573,3 +1847,717 @@ class APITest(TestCase):
         response = self.client.get(f'/v1/vendedor/{cpf}/saldo')
         self.assertEqual(response.status_code, 200)
         self.assertIn("saldo", response.json())
+
+    def test_acumulado_cashback_stub(self):
+        cpf = '15350946056'
+        self.autenticate_client(cpf=cpf)
+        with SaldoAPIStub() as stub, self.settings(SALDO_API=stub.url):
+            response = self.client.get(f'/v1/vendedor/{cpf}/saldo')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"saldo": 23.45})
+
+
+class AutenticacaoTest(TestCase):
+    def setUp(self):
+        self.cpf = '15350946056'
+        self.vendedor = Vendedor.objects.create_user(username='Foo', password='foo@bar', cpf=self.cpf)
+        self.client = APIClient()
+
+    def test_login_inclui_cpf_nas_claims(self):
+        response = self.client.post('/v1/vendedor/login', {"login": "Foo", "senha": "foo@bar"}, format='json')
+        self.assertEqual(AccessToken(response.json()["access"])["cpf"], self.cpf)
+
+    def logins_gravados(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/v1/vendedor/login', {"login": "Foo", "senha": "foo@bar"}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return len([q for q in queries if q["sql"].startswith('UPDATE "cashback_vendedor"')])
+
+    def test_login_grava_ultimo_acesso_por_padrao(self):
+        self.assertEqual(self.logins_gravados(), 1)
+        self.assertEqual(self.logins_gravados(), 1)
+        self.vendedor.refresh_from_db()
+        self.assertIsNotNone(self.vendedor.last_login)
+
+    def test_login_dentro_do_intervalo_nao_grava_ultimo_acesso(self):
+        with self.settings(LOGIN_INTERVALO_ULTIMO_ACESSO=300):
+            self.assertEqual(self.logins_gravados(), 1)
+            self.vendedor.refresh_from_db()
+            ultimo_acesso = self.vendedor.last_login
+            self.assertEqual(self.logins_gravados(), 0)
+        self.vendedor.refresh_from_db()
+        self.assertEqual(self.vendedor.last_login, ultimo_acesso)
+
+    def test_login_apos_intervalo_grava_ultimo_acesso(self):
+        Vendedor.objects.filter(pk=self.vendedor.pk).update(last_login=now() - timedelta(seconds=301))
+        with self.settings(LOGIN_INTERVALO_ULTIMO_ACESSO=300):
+            self.assertEqual(self.logins_gravados(), 1)
+        self.vendedor.refresh_from_db()
+        self.assertLess(now() - self.vendedor.last_login, timedelta(seconds=5))
+
+    def test_refresh_mantem_cpf_nas_claims(self):
+        refresh = str(VendedorRefreshToken.for_user(self.vendedor))
+        response = self.client.post('/v1/vendedor/refresh_token', {"refresh": refresh}, format='json')
+        self.assertEqual(AccessToken(response.json()["access"])["cpf"], self.cpf)
+
+    def test_saldo_sem_consultas_de_autenticacao(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {VendedorRefreshToken.for_user(self.vendedor).access_token}')
+        with SaldoAPIStub() as stub, self.settings(SALDO_API=stub.url, SALDO_CACHE_TTL=0):
+            with self.assertNumQueries(0):
+                response = self.client.get(f'/v1/vendedor/{self.cpf}/saldo')
+        self.assertEqual(response.status_code, 200)
+
+    def test_token_sem_cpf_consulta_o_banco(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.vendedor).access_token}')
+        with self.assertNumQueries(2):  # Vendedor e a página
+            response = self.client.get(f'/v1/vendedor/{self.cpf}/compras?paginacao=cursor')
+        self.assertEqual(response.status_code, 200)
+
+    def test_cache_do_vendedor_carregado_do_banco(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.vendedor).access_token}')
+        url = f'/v1/vendedor/{self.cpf}/compras?paginacao=cursor'
+        with self.settings(AUTENTICACAO_CACHE_TTL=60):
+            self.client.get(url)
+            with self.assertNumQueries(1):  # Apenas a página
+                response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_vendedor_token_carrega_permissoes_do_banco(self):
+        token = VendedorToken(VendedorRefreshToken.for_user(self.vendedor).access_token)
+        self.assertEqual(token.cpf, self.cpf)
+        self.assertFalse(token.has_perm('cashback.consultar_saldos'))
+        self.vendedor.user_permissions.add(Permission.objects.get(codename='consultar_saldos'))
+        token = VendedorToken(VendedorRefreshToken.for_user(self.vendedor).access_token)
+        self.assertTrue(token.has_perm('cashback.consultar_saldos'))
+
+    def test_view_assincrona_sem_consultas_de_autenticacao(self):
+        token = f'Bearer {VendedorRefreshToken.for_user(self.vendedor).access_token}'
+        request = RequestFactory(HTTP_AUTHORIZATION=token).get(f'/v1/vendedor/{self.cpf}/saldo')
+        with self.assertNumQueries(0):
+            usuario = async_to_sync(views.autenticar)(request)
+        self.assertEqual(usuario.cpf, self.cpf)
+
+
+class RegistrosHandler(logging.Handler):
+    """Guarda os registros do logger com o request_id preenchido como no handler de console"""
+
+    def __init__(self):
+        super(RegistrosHandler, self).__init__()
+        self.addFilter(RequestIDFilter())
+        self.registros = []
+
+    def emit(self, record):
+        self.registros.append(record)
+
+
+class TempoRequisicaoTest(TestCase):
+
+    def setUp(self):
+        self.cpf = '15350946056'
+        self.vendedor = Vendedor.objects.create_user(username='Foo', password='foo@bar', cpf=self.cpf)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {VendedorRefreshToken.for_user(self.vendedor).access_token}')
+        self.handler = RegistrosHandler()
+        logger = logging.getLogger('core')
+        logger.addHandler(self.handler)
+        self.addCleanup(logger.removeHandler, self.handler)
+
+    def fases(self, response):
+        return {metrica.split(';')[0]: metrica for metrica in response['Server-Timing'].split(', ')}
+
+    def registro(self):
+        registros = [r for r in self.handler.registros if r.getMessage() == "Requisição finalizada"]
+        self.assertEqual(len(registros), 1)
+        return registros[0]
+
+    def test_server_timing_e_log_da_listagem(self):
+        baker.make('cashback.Compra', vendedor=self.vendedor, _quantity=3)
+        with CaptureQueriesContext(connection) as consultas:
+            response = self.client.get(f'/v1/vendedor/{self.cpf}/compras', HTTP_X_REQUEST_ID='abc123')
+        self.assertEqual(response.status_code, 200)
+
+        fases = self.fases(response)
+        self.assertEqual(set(fases), {'auth', 'serializacao', 'db', 'total'})
+        self.assertRegex(fases['db'], rf'^db;dur=\d+\.\d{{2}};desc="{len(consultas)} consultas"$')
+        self.assertRegex(fases['total'], r'^total;dur=\d+\.\d{2}$')
+
+        registro = self.registro()
+        self.assertEqual(registro.request_id, 'abc123')
+        self.assertEqual(registro.method, 'GET')
+        self.assertEqual(registro.path, f'/v1/vendedor/{self.cpf}/compras')
+        self.assertEqual(registro.status, 200)
+        self.assertEqual(registro.queries, len(consultas))
+        self.assertEqual(set(registro.fases), {'auth', 'serializacao', 'db'})
+        self.assertGreaterEqual(registro.duration, sum(registro.fases.values()) - registro.fases['db'])
+
+    def test_fase_de_recalculo_na_inclusao_da_compra(self):
+        response = self.client.post('/v1/compra', {"codigo": "123456", "valor": "100", "cpf": self.cpf},
+                                    format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertIn('recalculo', self.fases(response))
+        self.assertEqual(self.registro().status, 201)
+
+    def test_fase_do_saldo_api(self):
+        with SaldoAPIStub() as stub, self.settings(SALDO_API=stub.url, SALDO_CACHE_TTL=0):
+            response = self.client.get(f'/v1/vendedor/{self.cpf}/saldo')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('saldo_api', self.fases(response))
+
+    def test_fase_do_saldo_api_na_consulta_em_lote(self):
+        self.vendedor.user_permissions.add(Permission.objects.get(codename='consultar_saldos'))
+        cpfs = ['08948135015', '41615628029', '35770006005']
+        with SaldoAPIStub(atraso=0.05) as stub, self.settings(SALDO_API=stub.url, SALDO_CACHE_TTL=0):
+            response = self.client.post('/v1/vendedor/saldos', {"cpfs": cpfs}, format='json')
+        self.assertEqual(len(response.json()["saldos"]), 3)
+        self.assertIn('saldo_api', self.fases(response))
+        # As consultas feitas em paralelo nas threads do pool são somadas
+        self.assertGreaterEqual(self.registro().fases['saldo_api'], 3 * 50)
+
+    def test_sem_server_timing(self):
+        with self.settings(TEMPO_REQUISICAO_SERVER_TIMING=False):
+            response = self.client.get(f'/v1/vendedor/{self.cpf}/compras')
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(self.registro().status, 200)
+
+    def test_desabilitado(self):
+        with self.settings(TEMPO_REQUISICAO=False):
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=self.client._credentials['HTTP_AUTHORIZATION'])
+            response = client.get(f'/v1/vendedor/{self.cpf}/compras')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(self.handler.registros, [])
+
+    def test_fora_da_requisicao_nao_mede(self):
+        self.assertIsNone(medicao_atual())
+        with medir('auth'):
+            Compra.objects.count()
+        self.assertIsNone(medicao_atual())
+
+    def test_middleware_assincrono(self):
+        async def view(request):
+            with medir('saldo_api'):
+                await asyncio.sleep(0.01)
+            # Consulta feita na thread do sync_to_async também é contabilizada
+            await sync_to_async(Compra.objects.count)()
+            return views.resposta_json({"saldo": 1})
+
+        middleware = TempoRequisicaoMiddleware(view)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        request = RequestFactory().get('/v1/vendedor/15350946056/saldo')
+        request.id = 'assincrona'
+        response = async_to_sync(middleware)(request)
+
+        fases = self.fases(response)
+        self.assertEqual(set(fases), {'saldo_api', 'serializacao', 'db', 'total'})
+        self.assertIn('desc="1 consultas"', fases['db'])
+        self.assertGreaterEqual(self.registro().fases['saldo_api'], 10)
+        self.assertEqual(self.registro().request_id, 'assincrona')
+
+
+class MetricasTest(TestCase):
+
+    def setUp(self):
+        # Métricas de teste fora do registro global, para não aparecerem na exportação dos demais testes
+        self.addCleanup(setattr, metricas, 'METRICAS', list(metricas.METRICAS))
+        self.contador = Contador('teste_total', 'Contador de teste', ['rota'])
+        self.histograma = Histograma('teste_segundos', 'Histograma de teste', buckets=[0.1, 1])
+
+    def amostras(self):
+        linhas = exportar().splitlines()
+        return {linha.rsplit(' ', 1)[0]: float(linha.rsplit(' ', 1)[1]) for linha in linhas if not linha.startswith('#')}
+
+    def test_contador_e_histograma(self):
+        with self.settings(METRICAS_DIRETORIO=''):
+            self.contador.incrementar(rota='a')
+            self.contador.incrementar(2, rota='a')
+            self.contador.incrementar(rota='b"\\')
+            for valor in (0.05, 0.5, 0.7, 3):
+                self.histograma.observar(valor)
+            texto = exportar()
+            amostras = self.amostras()
+
+        self.assertIn('# HELP teste_total Contador de teste\n# TYPE teste_total counter\n', texto)
+        self.assertIn('# TYPE teste_segundos histogram\n', texto)
+        self.assertEqual(amostras['teste_total{rota="a"}'], 3)
+        self.assertEqual(amostras['teste_total{rota="b\\"\\\\"}'], 1)
+        # Buckets acumulados
+        self.assertEqual(amostras['teste_segundos_bucket{le="0.1"}'], 1)
+        self.assertEqual(amostras['teste_segundos_bucket{le="1.0"}'], 3)
+        self.assertEqual(amostras['teste_segundos_bucket{le="+Inf"}'], 4)
+        self.assertEqual(amostras['teste_segundos_count'], 4)
+        self.assertAlmostEqual(amostras['teste_segundos_sum'], 4.25)
+
+    def test_labels_obrigatorios(self):
+        with self.assertRaises(ValueError):
+            self.contador.incrementar(status=200)
+
+    def test_desabilitado(self):
+        with self.settings(METRICAS=False, METRICAS_DIRETORIO=''):
+            self.contador.incrementar(rota='a')
+            self.assertNotIn('teste_total{', exportar())
+
+    def test_arquivo_cresce_e_reabre(self):
+        with tempfile.TemporaryDirectory() as diretorio:
+            caminho = str(Path(diretorio) / 'metricas_1.db')
+            with patch.object(ArquivoMmap, 'tamanho_inicial', 4096):
+                arquivo = ArquivoMmap(caminho)
+                for i in range(1000):
+                    arquivo.incrementar(f'chave{i}', i)
+            arquivo.incrementar('chave1', 0.5)
+            self.assertGreater(arquivo.tamanho, 4096)
+            arquivo.fechar()
+
+            valores = dict(ArquivoMmap.ler(caminho))
+            self.assertEqual(len(valores), 1000)
+            self.assertEqual(valores['chave1'], 1.5)
+            self.assertEqual(valores['chave999'], 999)
+            # Reaberto pelo mesmo processo continua de onde parou
+            arquivo = ArquivoMmap(caminho)
+            arquivo.incrementar('chave1', 1)
+            arquivo.fechar()
+            self.assertEqual(dict(ArquivoMmap.ler(caminho))['chave1'], 2.5)
+
+    def test_um_arquivo_por_processo(self):
+        with tempfile.TemporaryDirectory() as diretorio:
+            armazenamento = ArmazenamentoArquivo(diretorio)
+            armazenamento.incrementar('chave', 1)
+            # Worker criado por fork depois do primeiro registro
+            with patch('cashback.metricas.os.getpid', return_value=-1):
+                armazenamento.incrementar('chave', 2)
+            self.assertEqual(sorted(p.name for p in Path(diretorio).iterdir()),
+                             sorted([f'metricas_{os.getpid()}.db', 'metricas_-1.db']))
+            self.assertEqual(armazenamento.coletar(), {'chave': 3})
+
+    def test_soma_os_workers(self):
+        script = """
+import django
+django.setup()
+from cashback.metricas import requisicoes
+for _ in range(5):
+    requisicoes.incrementar(rota='vendedor-saldo', metodo='GET', status=200)
+"""
+        with tempfile.TemporaryDirectory() as diretorio:
+            env = dict(os.environ, DJANGO_SETTINGS_MODULE="boticario.settings", METRICAS_DIRETORIO=diretorio,
+                       DATABASE_NAME=os.path.join(diretorio, 'db.sqlite3'))
+            for _ in range(2):
+                saida = subprocess.run([sys.executable, "-W", "ignore", "-c", script], capture_output=True, text=True,
+                                       cwd=settings.BASE_DIR, env=env, timeout=60)
+                self.assertEqual(saida.returncode, 0, saida.stderr)
+            self.assertEqual(len(list(Path(diretorio).glob('metricas_*'))), 2)
+            with self.settings(METRICAS_DIRETORIO=diretorio):
+                amostras = self.amostras()
+        self.assertEqual(amostras['http_requisicoes_total{metodo="GET",rota="vendedor-saldo",status="200"}'], 10)
+
+
+class MetricasAPITest(TestCase):
+
+    def setUp(self):
+        self.cpf = '15350946056'
+        self.vendedor = Vendedor.objects.create_user(username='Foo', password='foo@bar', cpf=self.cpf)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {VendedorRefreshToken.for_user(self.vendedor).access_token}')
+        # Armazenamento em memória novo a cada teste
+        metricas_em_memoria = self.settings(METRICAS_DIRETORIO='', METRICAS_TOKEN='segredo')
+        metricas_em_memoria.enable()
+        self.addCleanup(metricas_em_memoria.disable)
+
+    def amostras(self):
+        response = APIClient().get('/metrics', HTTP_AUTHORIZATION='Bearer segredo')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], metricas.CONTENT_TYPE)
+        linhas = response.content.decode().splitlines()
+        return {linha.rsplit(' ', 1)[0]: float(linha.rsplit(' ', 1)[1]) for linha in linhas if not linha.startswith('#')}
+
+    def test_metricas_das_requisicoes(self):
+        baker.make('cashback.Compra', vendedor=self.vendedor, _quantity=3)
+        consultas = 0
+        # Cada requisição descarta as consultas registradas na conexão (request_started), então são contadas uma a uma
+        for client, cpf in ((self.client, self.cpf), (self.client, self.cpf), (self.client, '00000000000'),
+                            (APIClient(), self.cpf)):
+            with CaptureQueriesContext(connection) as capturadas:
+                client.get(f'/v1/vendedor/{cpf}/compras')
+            consultas += len(capturadas)
+
+        amostras = self.amostras()
+        self.assertEqual(amostras['http_requisicoes_total{metodo="GET",rota="vendedor-compras",status="200"}'], 2)
+        self.assertEqual(amostras['http_requisicoes_total{metodo="GET",rota="vendedor-compras",status="400"}'], 1)
+        self.assertEqual(amostras['http_requisicoes_total{metodo="GET",rota="vendedor-compras",status="401"}'], 1)
+        self.assertEqual(amostras['http_requisicao_duracao_segundos_count{metodo="GET",rota="vendedor-compras"}'], 4)
+        self.assertEqual(
+            amostras['http_requisicao_duracao_segundos_bucket{metodo="GET",rota="vendedor-compras",le="+Inf"}'], 4)
+        self.assertEqual(amostras['db_consultas_total{rota="vendedor-compras"}'], consultas)
+
+    def test_rota_nao_encontrada(self):
+        self.client.get('/nao/existe')
+        self.assertEqual(self.amostras()['http_requisicoes_total{metodo="GET",rota="nao_encontrada",status="404"}'], 1)
+
+    def test_metricas_do_saldo_api(self):
+        with SaldoAPIStub(status_codes=[500]) as stub, \
+                self.settings(SALDO_API=stub.url, SALDO_CACHE_TTL=0, SALDO_API_RETENTATIVAS=0):
+            self.client.get(f'/v1/vendedor/{self.cpf}/saldo')
+            self.client.get(f'/v1/vendedor/{self.cpf}/saldo')
+
+        amostras = self.amostras()
+        self.assertEqual(amostras['saldo_api_consultas_total{resultado="indisponivel"}'], 1)
+        self.assertEqual(amostras['saldo_api_consultas_total{resultado="sucesso"}'], 1)
+        self.assertEqual(amostras['saldo_api_duracao_segundos_count{resultado="sucesso"}'], 1)
+
+    def test_metricas_do_recalculo(self):
+        response = self.client.post('/v1/compra', {"codigo": "123456", "valor": "100", "cpf": self.cpf},
+                                    format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.amostras()['cashback_recalculo_duracao_segundos_count'], 1)
+
+    def test_somente_metricas(self):
+        with self.settings(TEMPO_REQUISICAO=False):
+            response = APIClient().get('/nao/existe')
+            self.assertNotIn('Server-Timing', response)
+            self.assertIn('http_requisicoes_total{metodo="GET",rota="nao_encontrada",status="404"}', self.amostras())
+
+    def test_token(self):
+        self.assertEqual(APIClient().get('/metrics').status_code, 403)
+        self.assertEqual(APIClient().get('/metrics', HTTP_AUTHORIZATION='Bearer outro').status_code, 403)
+        self.assertIn('# TYPE http_requisicoes_total counter', APIClient().get(
+            '/metrics', HTTP_AUTHORIZATION='Bearer segredo').content.decode())
+
+    def test_sem_token_configurado_nega_acesso(self):
+        with self.settings(METRICAS_TOKEN=''):
+            self.assertEqual(APIClient().get('/metrics').status_code, 403)
+            self.assertEqual(APIClient().get('/metrics', HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+
+
+class ExportacaoComprasTest(TestCase):
+
+    def setUp(self):
+        self.cpf = '15350946056'
+        self.vendedor = Vendedor.objects.create_user(username='Foo', password='foo@bar', cpf=self.cpf)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {VendedorRefreshToken.for_user(self.vendedor).access_token}')
+        self.url = f'/v1/vendedor/{self.cpf}/compras/exportar'
+
+    def criar_compras(self, quantidade):
+        data = now()
+        Compra.objects.bulk_create(
+            (Compra(codigo=f"{i:06}", vendedor=self.vendedor, valor=Decimal(i + 1), data=data - timedelta(minutes=i),
+                    status="AVN"[i % 3], percentual_cashback=10, valor_cashback=Decimal(i + 1) / 10)
+             for i in range(quantidade)),
+            batch_size=5000,
+        )
+
+    def conteudo(self, response):
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_ndjson_mesmas_linhas_da_listagem(self):
+        self.criar_compras(25)
+        linhas = self.conteudo(self.client.get(self.url)).splitlines()
+        listagem = self.client.get(f'/v1/vendedor/{self.cpf}/compras?page_size=50').json()["results"]
+        self.assertEqual([json.loads(linha) for linha in linhas], listagem)
+
+    def test_csv_com_cabecalho(self):
+        self.criar_compras(3)
+        response = self.client.get(f'{self.url}?formato=csv')
+        self.assertEqual(response['Content-Disposition'], f'attachment; filename="compras-{self.cpf}.csv"')
+        linhas = list(csv.reader(io.StringIO(self.conteudo(response))))
+        self.assertEqual(linhas[0], ['codigo', 'valor', 'data', 'cpf', 'percentual_cashback', 'cashback', 'status'])
+        self.assertEqual([linha[0] for linha in linhas[1:]], ["000000", "000001", "000002"])
+        self.assertEqual(linhas[1][1:2] + linhas[1][3:], ["1.00", self.cpf, "10.0", "0.10", "Aprovado"])
+
+    def test_streaming_no_modo_asgi(self):
+        self.criar_compras(25)
+        esperado = self.conteudo(self.client.get(self.url)).encode()
+        mensagens = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(mensagem):
+            mensagens.append(mensagem)
+
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': self.url, 'query_string': b'', 'scheme': 'http',
+            'headers': [(b'host', b'testserver'), (b'authorization', self.client._credentials['HTTP_AUTHORIZATION'].encode())],
+        }
+        # Como no test client, a conexão da transação do teste não pode ser fechada pelos sinais da requisição
+        for sinal in (request_started, request_finished):
+            sinal.disconnect(close_old_connections)
+            self.addCleanup(sinal.connect, close_old_connections)
+        with self.settings(EXPORTACAO_TAMANHO_BLOCO=10):
+            async_to_sync(BoticarioASGIHandler())(scope, receive, send)
+
+        self.assertEqual(mensagens[0]['status'], 200)
+        corpos = [mensagem.get('body', b'') for mensagem in mensagens[1:]]
+        self.assertEqual(len(corpos), 4)  # 3 blocos e a mensagem final
+        self.assertEqual(b''.join(corpos), esperado)
+
+    def test_aplica_filtros_da_listagem(self):
+        self.criar_compras(9)
+        linhas = self.conteudo(self.client.get(f'{self.url}?status=V')).splitlines()
+        self.assertEqual([json.loads(linha)["codigo"] for linha in linhas], ["000001", "000004", "000007"])
+
+    def test_historico_vazio(self):
+        self.assertEqual(self.conteudo(self.client.get(self.url)), '')
+
+    def test_formato_invalido(self):
+        response = self.client.get(f'{self.url}?formato=xml')
+        self.assertEqual(response.status_code, 400)
+
+    def test_outro_vendedor(self):
+        response = self.client.get('/v1/vendedor/08948135015/compras/exportar')
+        self.assertEqual(response.status_code, 400)
+
+    def test_precisa_autenticacao(self):
+        self.assertEqual(APIClient().get(self.url).status_code, 401)
+
+    def pico_de_memoria(self, quantidade):
+        Compra.objects.all().delete()
+        self.criar_compras(quantidade)
+        tracemalloc.start()
+        try:
+            response = self.client.get(self.url)
+            linhas = sum(bloco.count(b'\n') for bloco in response.streaming_content)
+            _, pico = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(linhas, quantidade)
+        return pico
+
+    def test_memoria_nao_depende_do_tamanho_do_historico(self):
+        with self.settings(EXPORTACAO_TAMANHO_BLOCO=200):
+            pequeno = self.pico_de_memoria(1000)
+            grande = self.pico_de_memoria(10000)
+        # O histórico completo teria alguns MB, o pico deve ser próximo ao de um histórico 10x menor
+        self.assertLess(grande, pequeno * 1.5)
+
+
+class ReplicaLeituraTest(TransactionTestCase):
+    """Dois bancos SQLite: a réplica não recebe as escritas, simulando o atraso da replicação"""
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        # Cache compartilhado em memória, vazio a cada teste
+        cache_compartilhado = self.settings(CACHES={
+            'default': settings.CACHES['default'],
+            'compartilhado': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'replica'},
+        })
+        cache_compartilhado.enable()
+        self.addCleanup(cache_compartilhado.disable)
+        caches['compartilhado'].clear()
+        self.cpf = '15350946056'
+        self.vendedor = Vendedor.objects.create(username='Foo', cpf=self.cpf)
+        Vendedor.objects.using('replica').create(pk=self.vendedor.pk, username='Foo', cpf=self.cpf)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {VendedorRefreshToken.for_user(self.vendedor).access_token}')
+        self.url = f'/v1/vendedor/{self.cpf}/compras'
+
+    def criar_na_replica(self, codigo):
+        Compra.objects.using('replica').bulk_create([
+            Compra(codigo=codigo, vendedor_id=self.vendedor.pk, valor=Decimal(10), data=now(), status='V',
+                   percentual_cashback=10)
+        ])
+
+    def codigos(self):
+        return [compra["codigo"] for compra in self.client.get(self.url).json()["results"]]
+
+    def test_listagem_le_da_replica(self):
+        self.criar_na_replica("900000")
+        with self.settings(DATABASE_REPLICA_HABILITADA=True):
+            self.assertEqual(self.codigos(), ["900000"])
+
+    def test_desabilitada_le_do_primario(self):
+        self.criar_na_replica("900000")
+        self.assertEqual(self.codigos(), [])
+
+    def test_vendedor_le_do_primario_apos_escrever(self):
+        with self.settings(DATABASE_REPLICA_HABILITADA=True):
+            Compra.objects.create(codigo="900001", vendedor=self.vendedor, valor=Decimal(10))
+            self.assertEqual(self.codigos(), ["900001"])
+
+    def test_volta_para_replica_apos_a_janela(self):
+        with self.settings(DATABASE_REPLICA_HABILITADA=True, DATABASE_REPLICA_JANELA_ESCRITA=0):
+            Compra.objects.create(codigo="900001", vendedor=self.vendedor, valor=Decimal(10))
+            self.assertEqual(self.codigos(), [])
+
+    def test_escrita_de_outro_vendedor_nao_fixa_no_primario(self):
+        outro = Vendedor.objects.create(username='Bar', cpf='08948135015')
+        with self.settings(DATABASE_REPLICA_HABILITADA=True):
+            Compra.objects.create(codigo="900001", vendedor=outro, valor=Decimal(10))
+            self.assertEqual(self.codigos(), [])
+
+    def test_fixacao_compartilhada_entre_workers(self):
+        with self.settings(DATABASE_REPLICA_HABILITADA=True):
+            Compra.objects.create(codigo="900001", vendedor=self.vendedor, valor=Decimal(10))
+            # Outro worker tem as próprias fixações, lidas do mesmo cache
+            self.assertTrue(Fixacoes.from_settings().fixado(self.vendedor.pk))
+
+    def test_backend_por_processo_nao_e_aceito(self):
+        with self.settings(DATABASE_REPLICA_HABILITADA=True, DATABASE_REPLICA_BACKEND='memoria'):
+            with self.assertRaises(ImproperlyConfigured):
+                self.codigos()
+
+    def test_escritas_vao_para_o_primario(self):
+        with self.settings(DATABASE_REPLICA_HABILITADA=True):
+            with ler_da_replica(self.vendedor.pk) as alias:
+                self.assertEqual(alias, 'replica')
+                Compra.objects.create(codigo="900001", vendedor=self.vendedor, valor=Decimal(10))
+        self.assertTrue(Compra.objects.using('default').filter(codigo="900001").exists())
+        self.assertFalse(Compra.objects.using('replica').filter(codigo="900001").exists())
+        self.assertEqual(VendasDiarias.total_periodo(self.vendedor.pk, Compra.inicio_periodo()), 10)
+
+
+class SaldosEmLoteTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.gerente = Vendedor.objects.create_user(username='gerente', password='gerente@123', cpf='15350946056')
+        self.gerente.user_permissions.add(Permission.objects.get(codename='consultar_saldos'))
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {VendedorRefreshToken.for_user(self.gerente).access_token}')
+        self.cpfs = ['08948135015', '41615628029', '35770006005', '87103564019', '67674926044']
+        self.configuracao = dict(SALDO_CACHE_TTL=0, SALDO_API_RETENTATIVAS=0, SALDO_LOTE_CONCORRENCIA=5)
+
+    def test_precisa_permissao(self):
+        vendedor = Vendedor.objects.create_user(username='vendedor', password='vendedor@123', cpf='08948135015')
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {VendedorRefreshToken.for_user(vendedor).access_token}')
+        response = client.post('/v1/vendedor/saldos', {"cpfs": ['08948135015']}, format='json')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json(), {"detail": "Não é permitido consultar o saldo de outros vendedores"})
+
+    def test_precisa_autenticacao(self):
+        response = APIClient().post('/v1/vendedor/saldos', {"cpfs": self.cpfs}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+    def test_lista_obrigatoria(self):
+        response = self.client.post('/v1/vendedor/saldos', {"cpfs": []}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_tamanho_maximo(self):
+        with self.settings(SALDO_LOTE_TAMANHO_MAXIMO=2):
+            response = self.client.post('/v1/vendedor/saldos', {"cpfs": self.cpfs}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_resultados_parciais_com_erros_por_cpf(self):
+        with SaldoAPIStub() as stub, self.settings(SALDO_API=stub.url, **self.configuracao):
+            response = self.client.post('/v1/vendedor/saldos', {"cpfs": ['089.481.350-15', '123']}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"saldos": {"08948135015": 23.45}, "erros": {"123": "CPF 123 inválido"}})
+
+    def test_falha_do_upstream_por_cpf(self):
+        with SaldoAPIStub(status_codes=[500] * 5) as stub, self.settings(SALDO_API=stub.url, **self.configuracao):
+            response = self.client.post('/v1/vendedor/saldos', {"cpfs": self.cpfs[:2]}, format='json')
+        self.assertEqual(response.json(), {"saldos": {}, "erros": {cpf: "Não foi possível obter o saldo"
+                                                                   for cpf in self.cpfs[:2]}})
+
+    def test_latencia_proxima_da_consulta_mais_lenta(self):
+        with SaldoAPIStub(atraso=0.3) as stub, self.settings(SALDO_API=stub.url, **self.configuracao):
+            inicio = perf_counter()
+            response = self.client.post('/v1/vendedor/saldos', {"cpfs": self.cpfs}, format='json')
+            duracao = perf_counter() - inicio
+        self.assertEqual(len(response.json()["saldos"]), 5)
+        self.assertEqual(len(stub.requisicoes), 5)
+        self.assertLess(duracao, 0.3 * 3)  # Sequencialmente seriam 1.5s
+
+    def test_prazo_do_lote(self):
+        with SaldoAPIStub(atraso=1) as stub, self.settings(SALDO_API=stub.url, SALDO_LOTE_PRAZO=0.2,
+                                                           **self.configuracao):
+            inicio = perf_counter()
+            response = self.client.post('/v1/vendedor/saldos', {"cpfs": self.cpfs[:2]}, format='json')
+            duracao = perf_counter() - inicio
+        self.assertLess(duracao, 1)
+        self.assertEqual(response.json()["erros"], {cpf: "Tempo esgotado ao consultar o saldo" for cpf in self.cpfs[:2]})
+
+    def test_prazo_libera_as_threads_do_pool(self):
+        configuracao = dict(self.configuracao, SALDO_LOTE_CONCORRENCIA=2)
+        with SaldoAPIStub(atraso=1) as stub, self.settings(SALDO_API=stub.url, SALDO_LOTE_PRAZO=0.2, **configuracao):
+            self.client.post('/v1/vendedor/saldos', {"cpfs": self.cpfs[:2]}, format='json')
+            # As chamadas abandonadas terminam pelo timeout limitado ao prazo, e não pelo atraso de 1s do SaldoAPI
+            inicio = perf_counter()
+            get_saldos_executor().submit(lambda: None).result(timeout=0.5)
+            self.assertLess(perf_counter() - inicio, 0.5)
+
+
+class ViewsAssincronasTest(TestCase):
+    """As views assíncronas (modo ASGI) devem responder exatamente como as actions do VendedorViewset"""
+
+    def setUp(self):
+        self.cpf = '15350946056'
+        self.vendedor = Vendedor.objects.create_user(username='Foo', password='foo@bar', cpf=self.cpf)
+        self.token = f'Bearer {VendedorRefreshToken.for_user(self.vendedor).access_token}'
+        self.factory = RequestFactory(HTTP_AUTHORIZATION=self.token)
+        self.api = APIClient()
+        self.api.credentials(HTTP_AUTHORIZATION=self.token)
+
+    def chamar(self, view, url, cpf=None, method='get', **extra):
+        request = getattr(self.factory, method)(url, **extra)
+        return async_to_sync(view)(request, pk=cpf or self.cpf)
+
+    def test_compras_mesmo_json_da_api(self):
+        for i in range(3):
+            Compra.objects.create(codigo=f"90000{i}", vendedor=self.vendedor, valor=Decimal(100 * (i + 1)),
+                                  data=now() - timedelta(days=i))
+        for parametros in ('', '?page_size=2&page=2', '?paginacao=cursor&page_size=2', '?status=V&data_inicio=2020-01-01'):
+            url = f'/v1/vendedor/{self.cpf}/compras{parametros}'
+            response = self.chamar(views.compras, url)
+            esperado = self.api.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, esperado.content)
+
+    def test_compras_filtro_invalido_mesmo_json_da_api(self):
+        url = f'/v1/vendedor/{self.cpf}/compras?status=X'
+        response = self.chamar(views.compras, url)
+        esperado = self.api.get(url)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, esperado.content)
+
+    def test_compras_outro_vendedor(self):
+        response = self.chamar(views.compras, '/v1/vendedor/41615628029/compras', cpf='41615628029')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content),
+                         {"erro": "Não é possível acessar a listagem de vendas de outro vendedor"})
+
+    def test_precisa_autenticacao(self):
+        request = RequestFactory().get(f'/v1/vendedor/{self.cpf}/saldo')
+        response = async_to_sync(views.saldo)(request, pk=self.cpf)
+        self.assertEqual(response.status_code, 401)
+        self.assertIn('WWW-Authenticate', response)
+
+    def test_apenas_get(self):
+        response = self.chamar(views.saldo, f'/v1/vendedor/{self.cpf}/saldo', method='post')
+        self.assertEqual(response.status_code, 405)
+
+    def test_saldo_mesmo_json_da_api(self):
+        url = f'/v1/vendedor/{self.cpf}/saldo'
+        with SaldoAPIStub() as stub, self.settings(SALDO_API=stub.url, SALDO_CACHE_TTL=0):
+            response = self.chamar(views.saldo, url)
+            esperado = self.api.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, esperado.content)
+
+    def test_saldo_falha_upstream_retorna_500(self):
+        with SaldoAPIStub(status_codes=[500]) as stub, self.settings(SALDO_API=stub.url, SALDO_CACHE_TTL=0):
+            response = self.chamar(views.saldo, f'/v1/vendedor/{self.cpf}/saldo')
+        self.assertEqual(response.status_code, 500)
+
+    def test_cliente_assincrono_agrupa_consultas_concorrentes(self):
+        async def consultar():
+            cliente = get_saldo_api_async()
+            return await asyncio.gather(*(cliente.get_saldo(self.cpf) for _ in range(10)))
+
+        with SaldoAPIStub(atraso=0.2) as stub, self.settings(SALDO_API=stub.url, SALDO_CACHE_TTL=0):
+            resultados = async_to_sync(consultar)()
+        self.assertEqual(len(stub.requisicoes), 1)
+        self.assertEqual(len(set(resultados)), 1)
+
+    def test_single_flight_async_repassa_erro(self):
+        async def falhar():
+            await asyncio.sleep(0.05)
+            raise ValueError("falha")
+
+        async def executar():
+            single_flight = SingleFlightAsync()
+            return await asyncio.gather(*(single_flight.executar("cpf", falhar) for _ in range(3)),
+                                        return_exceptions=True)
+
+        resultados = async_to_sync(executar)()
+        self.assertEqual([str(erro) for erro in resultados], ["falha"] * 3)
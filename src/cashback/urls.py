@@ -1,7 +1,21 @@
+from django.conf import settings
 from django.urls import path, include
 
+from cashback import views
+from cashback.metricas import metricas
 from cashback.api import v1_router
 
-urlpatterns = [
+urlpatterns = []
+
+if settings.VIEWS_ASSINCRONAS:
+    # Precisam vir antes do router para substituir as actions equivalentes do VendedorViewset
+    urlpatterns += [
+        path('v1/vendedor/<str:pk>/saldo', views.saldo, name='vendedor-saldo'),
+        path('v1/vendedor/<str:pk>/compras', views.compras, name='vendedor-compras'),
+    ]
+
+urlpatterns += [
     path('v1/', include(v1_router.urls)),
+    # Endpoint interno, no formato do Prometheus, com as métricas somadas de todos os workers
+    path('metrics', metricas, name='metricas'),
 ]
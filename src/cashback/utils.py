@@ -1,3 +1,18 @@
+import re
+from functools import lru_cache
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+# Pesos do módulo 11 (equivalentes ao digito_mod11) para o primeiro e o segundo dígito verificador do CPF
+PESOS_DIGITO_1 = tuple(range(1, 10))
+PESOS_DIGITO_2 = tuple(range(0, 10))
+# Apenas algarismos ASCII, como o string.digits utilizado originalmente
+NAO_DIGITOS = re.compile('[^0-9]')
+
+
 def digito_mod11(digitos):
     # https://pt.wikipedia.org/wiki/D%C3%ADgito_verificador#M%C3%B3dulo_11
     algarismos = digitos[::-1]
@@ -6,3 +21,64 @@ def digito_mod11(digitos):
         digito += algarismos[i] * (9 - (i % 10))
     digito = digito % 11 % 10
     return digito
+
+
+def normalizar_cpf(cpf):
+    """Remove a formatação do CPF, retorna None se não sobrarem 11 algarismos"""
+    if not cpf:
+        return None
+    cpf = NAO_DIGITOS.sub('', cpf)
+    if len(cpf) != 11:
+        return None
+    return cpf
+
+
+def digitos_conferem(cpf):
+    """Confere os dígitos verificadores de um CPF já normalizado (11 algarismos)"""
+    algarismos = [ord(c) - 48 for c in cpf]
+    if sum(d * p for d, p in zip(algarismos, PESOS_DIGITO_1)) % 11 % 10 != algarismos[9]:
+        return False
+    return sum(d * p for d, p in zip(algarismos, PESOS_DIGITO_2)) % 11 % 10 == algarismos[10]
+
+
+@lru_cache(maxsize=4096)
+def sanitizar_cpf(cpf):
+    """
+    Valida o CPF pelo tamanho e digito e retorna o CPF limpo de formatação se for valido.
+    Retorna None se CPF for inválido. Memoizado para o caminho das requisições.
+    :param cpf: CPF a ser validado
+    :return: string or None
+    """
+    cpf = normalizar_cpf(cpf)
+    if cpf is None or not digitos_conferem(cpf):
+        return None
+    return cpf
+
+
+def validar_cpfs(cpfs, vetorizar=None):
+    """
+    Valida uma sequência de CPFs de uma vez, com o mesmo resultado de sanitizar_cpf para cada item.
+    Se o numpy estiver instalado a conferência dos dígitos é vetorizada.
+    :param cpfs: sequência de CPFs (formatados ou não)
+    :param vetorizar: força (True) ou desabilita (False) o uso do numpy. Por padrão usa se disponível
+    :return: lista com o CPF limpo ou None na mesma ordem da entrada
+    """
+    if vetorizar is None:
+        vetorizar = numpy is not None
+    normalizados = [normalizar_cpf(cpf) for cpf in cpfs]
+    if not vetorizar:
+        return [cpf if cpf is not None and digitos_conferem(cpf) else None for cpf in normalizados]
+
+    posicoes = [i for i, cpf in enumerate(normalizados) if cpf is not None]
+    resultado = [None] * len(normalizados)
+    if not posicoes:
+        return resultado
+    texto = ''.join(normalizados[i] for i in posicoes).encode('ascii')
+    algarismos = (numpy.frombuffer(texto, dtype=numpy.uint8).reshape(-1, 11) - 48).astype(numpy.int32)
+    digito_1 = algarismos[:, :9] @ numpy.array(PESOS_DIGITO_1, dtype=numpy.int32) % 11 % 10
+    digito_2 = algarismos[:, :10] @ numpy.array(PESOS_DIGITO_2, dtype=numpy.int32) % 11 % 10
+    validos = (digito_1 == algarismos[:, 9]) & (digito_2 == algarismos[:, 10])
+    for i, valido in zip(posicoes, validos.tolist()):
+        if valido:
+            resultado[i] = normalizados[i]
+    return resultado
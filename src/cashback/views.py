@@ -0,0 +1,101 @@
+"""
+Views assíncronas das rotas de I/O (saldo e listagem de compras), utilizadas no modo ASGI.
+Retornam o mesmo JSON das actions equivalentes do VendedorViewset.
+"""
+import logging
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from rest_framework import status
+from rest_framework.exceptions import APIException, NotAuthenticated, MethodNotAllowed
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from cashback.api import ComprasPagination, ComprasCursorPagination, CompraListagemSerializer, ComprasFilter
+from cashback.authentication import CLAIM_CPF, VendedorJWTAuthentication, VendedorToken
+from cashback.client import get_saldo_api_async
+from cashback.instrumentacao import medir
+from cashback.routers import ler_da_replica
+
+logger = logging.getLogger('core')
+
+
+def resposta_json(data, status_code=status.HTTP_200_OK):
+    with medir('serializacao'):
+        conteudo = JSONRenderer().render(data)
+    return HttpResponse(conteudo, status=status_code, content_type='application/json')
+
+
+async def autenticar(request):
+    with medir('auth'):
+        autenticacao = VendedorJWTAuthentication()
+        header = autenticacao.get_header(request)
+        raw_token = autenticacao.get_raw_token(header) if header is not None else None
+        if raw_token is None:
+            raise NotAuthenticated()
+        token = autenticacao.get_validated_token(raw_token)
+        # Com o CPF nas claims o usuário é montado sem acessar o banco, e não precisa sair do event loop
+        if CLAIM_CPF in token:
+            return VendedorToken(token)
+        return await sync_to_async(autenticacao.get_user)(token)
+
+
+def api_assincrona(view):
+    """Equivalente ao APIView do DRF para as views assíncronas: aceita apenas GET, exige JWT e trata APIException"""
+
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        try:
+            if request.method != 'GET':
+                raise MethodNotAllowed(request.method)
+            request.user = await autenticar(request)
+            return await view(request, *args, **kwargs)
+        except APIException as ex:
+            # Mesmo formato do exception handler do DRF
+            data = ex.detail if isinstance(ex.detail, (list, dict)) else {"detail": ex.detail}
+            response = resposta_json(data, ex.status_code)
+            if ex.status_code == status.HTTP_401_UNAUTHORIZED:
+                response['WWW-Authenticate'] = VendedorJWTAuthentication().authenticate_header(request)
+            return response
+
+    return wrapper
+
+
+@api_assincrona
+async def saldo(request, pk):
+    if request.user.cpf != pk:
+        logger.info("Usuário tentou acessar saldo de cashback de outro vendedor",
+                    extra={"cpf_usuario": request.user.cpf, "cpf_listagem": pk})
+        return resposta_json({"erro": "Não é possível acessar o saldo de outro vendedor"},
+                             status.HTTP_400_BAD_REQUEST)
+    saldo = await get_saldo_api_async().get_saldo(pk)
+    if not saldo:
+        logger.error("Não foi possível obter o saldo", extra={"cpf": pk})
+        return resposta_json({}, status.HTTP_500_INTERNAL_SERVER_ERROR)
+    return resposta_json({"saldo": saldo})
+
+
+def listar_compras(request, vendedor):
+    request = Request(request)
+    if ComprasCursorPagination.solicitada(request):
+        paginator = ComprasCursorPagination()
+    else:
+        paginator = ComprasPagination()
+    compras = ComprasFilter.filtrar(request, CompraListagemSerializer.queryset(vendedor))
+    with ler_da_replica(vendedor.pk):
+        page = paginator.paginate_queryset(compras, request)
+    serializer = CompraListagemSerializer(page, vendedor.cpf)
+    return paginator.get_paginated_response(serializer.data).data
+
+
+@api_assincrona
+async def compras(request, pk):
+    if request.user.cpf != pk:
+        logger.info("Usuário tentou acessar listagem de vendas de outro vendedor",
+                    extra={"cpf_usuario": request.user.cpf, "cpf_listagem": pk})
+        return resposta_json({"erro": "Não é possível acessar a listagem de vendas de outro vendedor"},
+                             status.HTTP_400_BAD_REQUEST)
+    # O ORM é síncrono, então a consulta roda na thread do sync_to_async sem bloquear o event loop
+    data = await sync_to_async(listar_compras)(request, request.user)
+    return resposta_json(data)